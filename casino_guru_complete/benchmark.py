@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный бенчмарк мок сервера Banana Bonanza
+
+Запускает ASGI-приложение mock_server_flask в том же процессе и гоняет по нему
+асинхронных клиентов без сети: HTTP-игроки проходят сценарий
+token -> offline_user -> enter -> спины с опросом истории -> cashout -> leave,
+WebSocket-клиенты шлют ping и game_action, участники crash-раундов ставят в
+каждый общий раунд и ждут его исхода по push-событиям. По каждому эндпоинту считаются
+p50/p90/p99, пропускная способность и прирост RSS; результат сохраняется в JSON
+и может сравниваться с предыдущим прогоном (--compare).
+
+    python benchmark.py --players 50 --spins 200 --sockets 50 --output bench.json
+    python benchmark.py --compare bench.json --fail-on-regression
+    python benchmark.py --players 0 --sockets 0 --crash-bettors 2000 --crash-rounds 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import mock_server_flask as server
+
+OFFLINE_USER_PATH = '/staging.playzia.com/games/playzia-bananabonanza/offline_user'
+RSS_SAMPLE_EVERY = 16  # RSS читается вокруг каждого N-го запроса эндпоинта
+
+# Ускоренные crash-раунды для прогона: рост x10 примерно за 2.3 с
+CRASH_BENCH_GROWTH = 1.0
+CRASH_BENCH_TICK = 0.05
+CRASH_BENCH_BETTING = 1.0
+CRASH_BENCH_PAUSE = 0.2
+
+try:
+    _STATM = open('/proc/self/statm', 'rb', buffering=0)
+    _PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+except OSError:  # не Linux - RSS не измеряется
+    _STATM = None
+
+
+def rss_kb():
+    """Текущий RSS процесса в КБ (0, если недоступен)"""
+    if _STATM is None:
+        return 0
+    _STATM.seek(0)
+    return int(_STATM.read().split()[1]) * _PAGE_KB
+
+
+def peak_rss_kb():
+    """Пиковый RSS процесса в КБ"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(ordered, q):
+    """Перцентиль q из отсортированного списка"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class EndpointStats:
+    """Задержки, ошибки и прирост RSS одного эндпоинта"""
+
+    __slots__ = ('latencies', 'errors', 'rss_growth')
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.rss_growth = 0
+
+    def summary(self, elapsed):
+        ordered = sorted(self.latencies)
+        return {
+            'count': len(ordered),
+            'errors': self.errors,
+            'throughput': round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+            'p90_ms': round(percentile(ordered, 0.90) * 1000, 3),
+            'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+            'max_ms': round(ordered[-1] * 1000, 3) if ordered else 0.0,
+            'rss_growth_kb': self.rss_growth
+        }
+
+
+class Recorder:
+    """Сбор замеров по эндпоинтам"""
+
+    def __init__(self):
+        self.endpoints = {}
+
+    async def measure(self, name, awaitable):
+        """Выполняет запрос и записывает его задержку; результат - пара (успех, ответ)"""
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = EndpointStats()
+        sample = len(stats.latencies) % RSS_SAMPLE_EVERY == 0
+        before = rss_kb() if sample else 0
+        started = time.perf_counter()
+        result = await awaitable
+        stats.latencies.append(time.perf_counter() - started)
+        if sample:
+            stats.rss_growth += max(0, rss_kb() - before)
+        if not result[0]:
+            stats.errors += 1
+        return result
+
+
+class AsgiClient:
+    """HTTP и WebSocket клиент, вызывающий ASGI-приложение в том же процессе"""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _scope(kind, path, headers):
+        path, _, query = path.partition('?')
+        headers = list(headers)
+        if not any(name == b'host' for name, _ in headers):
+            headers.insert(0, (b'host', b'benchmark'))
+        return {
+            'type': kind,
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'scheme': 'http' if kind == 'http' else 'ws',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'root_path': '',
+            'headers': headers,
+            'client': ('127.0.0.1', 0),
+            'server': ('benchmark', 80),
+        }
+
+    async def request(self, method, path, body=None, headers=None):
+        """(успех, JSON ответа или None)
+
+        body - объект для JSON или готовые байты тела; headers - пары (имя, значение) в байтах.
+        """
+        if isinstance(body, bytes):
+            payload = body
+        else:
+            payload = json.dumps(body).encode() if body is not None else b''
+        if headers is None:
+            headers = [(b'content-type', b'application/json')] if body is not None else []
+        scope = self._scope('http', path, headers)
+        scope['method'] = method
+        delivered = False
+        status = 0
+        chunks = []
+
+        async def receive():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {'type': 'http.request', 'body': payload, 'more_body': False}
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            else:
+                chunks.append(message.get('body', b''))
+
+        await self.app(scope, receive, send)
+        data = b''.join(chunks)
+        try:
+            parsed = json.loads(data) if data else None
+        except ValueError:
+            parsed = None
+        return 200 <= status < 400, parsed
+
+    def websocket(self, path, headers=()):
+        return AsgiWebSocketClient(self.app, self._scope('websocket', path, headers))
+
+
+class AsgiWebSocketClient:
+    """WebSocket соединение с ASGI-приложением через пару очередей"""
+
+    def __init__(self, app, scope):
+        self.app = app
+        self.scope = scope
+        self.inbound = asyncio.Queue()   # кадры клиента -> приложение
+        self.outbound = asyncio.Queue()  # кадры приложения -> клиент
+        self.accepted = asyncio.Event()
+        self.pending = []  # push-события из уже разобранных пачек
+        self.task = None
+
+    async def _receive(self):
+        return await self.inbound.get()
+
+    async def _send(self, message):
+        kind = message['type']
+        if kind == 'websocket.accept':
+            self.accepted.set()
+        elif kind == 'websocket.send':
+            text = message.get('text')
+            await self.outbound.put(text if text is not None else message.get('bytes'))
+        elif kind == 'websocket.close':
+            self.accepted.set()
+            await self.outbound.put(None)
+
+    async def connect(self):
+        await self.inbound.put({'type': 'websocket.connect'})
+        self.task = asyncio.ensure_future(self.app(self.scope, self._receive, self._send))
+        await self.accepted.wait()
+        return json.loads(await self.outbound.get())
+
+    async def send(self, data):
+        await self.inbound.put({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def recv_reply(self, request_id):
+        """Ответ на сообщение с данным id; push-события подписки пропускаются"""
+        while True:
+            frame = await self.outbound.get()
+            if frame is None:
+                return False, None
+            message = json.loads(frame)
+            if isinstance(message, dict) and message.get('id') == request_id:
+                return message.get('type') != 'error', message
+
+    async def request(self, data):
+        await self.send(data)
+        return await self.recv_reply(data['id'])
+
+    async def wait_event(self, match):
+        """Ближайшее push-событие, для которого match(event) истинно; пачки событий разбираются"""
+        while True:
+            while self.pending:
+                event = self.pending.pop(0)
+                if isinstance(event, dict) and match(event):
+                    return True, event
+            frame = await self.outbound.get()
+            if frame is None:
+                return False, None
+            message = json.loads(frame)
+            if isinstance(message, dict):
+                # Массивы - ответы на пачки запросов, push-пачка приходит конвертом events
+                self.pending = message['events'] if message.get('type') == 'events' else [message]
+
+    async def close(self):
+        await self.inbound.put({'type': 'websocket.disconnect', 'code': 1000})
+        await self.task
+
+
+async def http_player(client, recorder, index, spins, history_every):
+    """Сценарий игрока: вход, серия спинов с опросом истории, вывод и выход"""
+    token = f'bench_{index}'
+    query = f'?token={token}'
+    await recorder.measure('GET /api/token', client.request('GET', '/api/token' + query))
+    await recorder.measure('GET offline_user', client.request('GET', OFFLINE_USER_PATH + query))
+    await recorder.measure('POST /api/game/enter', client.request('POST', '/api/game/enter', {'token': token}))
+    since = 0
+    for spin in range(1, spins + 1):
+        await recorder.measure(
+            'POST /api/game/spin', client.request('POST', '/api/game/spin', {'token': token, 'bet': 1.0})
+        )
+        if spin % history_every == 0:
+            ok, page = await recorder.measure(
+                'GET /api/game/history', client.request('GET', f'/api/game/history{query}&since={since}')
+            )
+            if ok and page:
+                since = page.get('latest') or since
+    await recorder.measure('POST /api/game/cashout', client.request('POST', '/api/game/cashout', {'token': token}))
+    await recorder.measure('POST /api/game/leave', client.request('POST', '/api/game/leave', {'token': token}))
+
+
+async def ws_player(client, recorder, index, messages):
+    """WebSocket клиент: ping и игровые действия с подпиской на push-события"""
+    socket = client.websocket(f'/ws?token=bench_ws_{index}')
+    await recorder.measure('WS connect', _connected(socket.connect()))
+    for n in range(messages):
+        if n % 2:
+            name, message = 'WS game_action', {'type': 'game_action', 'action': 'spin', 'bet': 1.0, 'id': n}
+        else:
+            name, message = 'WS ping', {'type': 'ping', 'id': n}
+        await recorder.measure(name, socket.request(message))
+    await socket.close()
+
+
+def _crash_phase(phase):
+    return lambda event: event.get('type') == 'crash_round' and event.get('phase') == phase
+
+
+def _crash_outcome(event):
+    return event.get('type') in ('crash_cashout', 'crash_lost')
+
+
+async def crash_bettor(client, recorder, index, rounds):
+    """Участник общих crash-раундов: ставка с автовыводом в каждый раунд и ожидание исхода"""
+    socket = client.websocket(f'/ws?token=bench_crash_{index}')
+    await recorder.measure('WS connect', _connected(socket.connect()))
+    await socket.request({'type': 'subscribe', 'channel': 'crash', 'id': 'subscribe'})
+    target = round(1.1 + (index % 40) * 0.05, 2)
+    for n in range(rounds):
+        await socket.wait_event(_crash_phase('betting'))
+        ok, _ = await recorder.measure('WS crash_bet', socket.request({
+            'type': 'game_action', 'action': 'crash_bet', 'bet': 1.0, 'autoCashout': target, 'id': n
+        }))
+        if ok:
+            # Задержка от ставки до исхода: приём ставок, полёт и проводка
+            await recorder.measure('crash round', socket.wait_event(_crash_outcome))
+    await socket.close()
+
+
+async def _connected(awaitable):
+    welcome = await awaitable
+    return welcome.get('status') == 'connected', welcome
+
+
+async def run(args):
+    """Один прогон бенчмарка; возвращает отчёт"""
+    client = AsgiClient(server.asgi_app)
+    recorder = Recorder()
+    rss_start = rss_kb()
+    # Бенчмарк меряет сервер, а не лимит сессии: по умолчанию лимит снят
+    server.rate_limiter.rate = args.rate_limit
+    if args.crash_bettors:
+        server.crash_engine.stop()
+        server.crash_engine = server.CrashEngine(
+            seed=0, growth=CRASH_BENCH_GROWTH, tick=CRASH_BENCH_TICK,
+            betting_time=CRASH_BENCH_BETTING, pause=CRASH_BENCH_PAUSE
+        )
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(http_player(client, recorder, i, args.spins, args.history_every) for i in range(args.players)),
+        *(ws_player(client, recorder, i, args.ws_messages) for i in range(args.sockets)),
+        *(crash_bettor(client, recorder, i, args.crash_rounds) for i in range(args.crash_bettors))
+    )
+    elapsed = time.perf_counter() - started
+    server.crash_engine.stop()
+    endpoints = {name: stats.summary(elapsed) for name, stats in sorted(recorder.endpoints.items())}
+    total = sum(stats['count'] for stats in endpoints.values())
+    return {
+        'meta': {
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'json_backend': server.json_backend.name,
+            'session_backend': server.SESSION_BACKEND,
+            'asgi_threads': server.ASGI_THREADS,
+            'players': args.players,
+            'spins': args.spins,
+            'history_every': args.history_every,
+            'sockets': args.sockets,
+            'ws_messages': args.ws_messages,
+            'crash_bettors': args.crash_bettors,
+            'crash_rounds': args.crash_rounds,
+            'rate_limit': args.rate_limit,
+            'switch_interval_ms': sys.getswitchinterval() * 1000
+        },
+        'elapsed_s': round(elapsed, 3),
+        'requests': total,
+        'throughput': round(total / elapsed, 1),
+        'rss_kb': {'start': rss_start, 'end': rss_kb(), 'peak': peak_rss_kb()},
+        'endpoints': endpoints
+    }
+
+
+def compare(report, baseline, threshold):
+    """Сравнение с прошлым прогоном; возвращает список регрессий"""
+    regressions = []
+    print(f"\nСравнение с прогоном {baseline['meta'].get('timestamp')}:")
+    for name, current in report['endpoints'].items():
+        previous = baseline['endpoints'].get(name)
+        if not previous or not previous['throughput'] or not previous['p99_ms']:
+            continue
+        throughput = (current['throughput'] / previous['throughput'] - 1) * 100
+        p99 = (current['p99_ms'] / previous['p99_ms'] - 1) * 100
+        regressed = throughput < -threshold or p99 > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"  {name:<24} throughput {throughput:+7.1f}%  p99 {p99:+7.1f}%{'  РЕГРЕССИЯ' if regressed else ''}")
+    return regressions
+
+
+def print_report(report):
+    print(f"\nЗапросов: {report['requests']} за {report['elapsed_s']} с ({report['throughput']} req/s)")
+    rss = report['rss_kb']
+    print(f"RSS: {rss['start']} -> {rss['end']} КБ, пик {rss['peak']} КБ\n")
+    print(f"  {'эндпоинт':<24} {'count':>7} {'err':>4} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'rss КБ':>7}")
+    for name, stats in report['endpoints'].items():
+        print(
+            f"  {name:<24} {stats['count']:>7} {stats['errors']:>4} {stats['throughput']:>9} "
+            f"{stats['p50_ms']:>8} {stats['p99_ms']:>8} {stats['rss_growth_kb']:>7}"
+        )
+
+
+def parse_args():
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description='Бенчмарк мок сервера Banana Bonanza')
+    parser.add_argument('--players', type=int, default=50, help='одновременных HTTP-игроков')
+    parser.add_argument('--spins', type=int, default=200, help='спинов на игрока')
+    parser.add_argument('--history-every', type=int, default=10, help='опрос истории раз в N спинов')
+    parser.add_argument('--sockets', type=int, default=50, help='одновременных WebSocket клиентов')
+    parser.add_argument('--ws-messages', type=int, default=200, help='сообщений на WebSocket клиента')
+    parser.add_argument('--crash-bettors', type=int, default=0,
+                        help='участников общих crash-раундов (WebSocket)')
+    parser.add_argument('--crash-rounds', type=int, default=3, help='раундов на участника crash')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='лимит запросов сессии в секунду (0 - без лимита)')
+    parser.add_argument('--switch-interval', type=float,
+                        help='интервал переключения GIL, мс (Flask-потоки и event loop делят GIL)')
+    parser.add_argument('--output', help='сохранить отчёт в JSON')
+    parser.add_argument('--compare', help='JSON отчёт прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='допуск регрессии throughput/p99, %%')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='код возврата 1 при регрессии')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.switch_interval:
+        sys.setswitchinterval(args.switch_interval / 1000)
+    report = asyncio.run(run(args))
+    print_report(report)
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nОтчёт сохранён: {args.output}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
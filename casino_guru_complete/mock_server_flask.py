@@ -5,152 +5,3396 @@
 Адаптирован для Vercel serverless функций
 """
 
-from flask import Flask, jsonify, request, send_from_directory, send_file
+import time
+STARTUP_BEGAN = time.perf_counter()  # отсчёт холодного старта
+
+from flask import Flask, Response, g, jsonify, request, send_from_directory, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.exceptions import MethodNotAllowed
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 import os
-import time
-import random
 import json
+import math
+import hashlib
+import secrets
+import struct
+import base64
+import re
+import urllib.parse
+import mimetypes
+import gzip
+import tempfile
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import OrderedDict, deque
 from pathlib import Path
 import threading
 import socket
-import asyncio
-import websockets
+import io
+import sys
+import argparse
+import atexit
+import sqlite3
+import logging
+import logging.handlers
+import queue
+import importlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту
+
+    На Vercel WebSocket-стек и numpy не нужны, поэтому их импорт не
+    должен входить во время холодного старта.
+    """
+
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(f'{self._name}.{submodule}')
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        setattr(self, attr, value)  # следующие обращения минуют __getattr__
+        return value
+
+
+def optional_module(name, *submodules):
+    """Отложенный импорт необязательной зависимости; None, если она не установлена"""
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name, submodules)
+
+
+asyncio = LazyModule('asyncio')
+websockets = LazyModule('websockets', ('exceptions',))
+np = optional_module('numpy')        # нужен только для массовой симуляции
+msgpack = optional_module('msgpack')  # нужен только для бинарного WebSocket протокола
+brotli = optional_module('brotli')    # без brotli статика сжимается только gzip
+IMPORTS_DONE = time.perf_counter()
+
+try:
+    import orjson
+except ImportError:  # без orjson ответы кодируются стандартным json
+    orjson = None
+
+app = Flask(__name__)
+CORS(app)  # Включаем CORS для всех запросов
+
+# Настройки для Vercel
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+
+# Настройки хранилища сессий
+DEFAULT_TOKEN = 'offline_mock_token_12345'
+DEFAULT_SESSION_ID = 'offline_session_12345'
+DEFAULT_BALANCE = 1000000.0
+DEFAULT_CURRENCY = 'EUR'
+MAX_SESSIONS = int(os.getenv('MOCK_MAX_SESSIONS', '10000'))
+SESSION_IDLE_TTL = float(os.getenv('MOCK_SESSION_IDLE_TTL', '1800'))
+HISTORY_DEPTH = int(os.getenv('MOCK_HISTORY_DEPTH', '50'))
+HISTORY_PAGE_LIMIT = 50
+HISTORY_PAGE_MAX = 1000
+
+# Параметры мок-модели выплат
+WIN_CHANCE = 0.7
+MIN_MULTIPLIER = 1.0
+MAX_MULTIPLIER = 50.0
+BIG_WIN_MULTIPLIER = 10
+
+# Ставки, которые объявляет /gameapi/bananabonanza/interface
+BET_LEVELS = (0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0)
+DEFAULT_BET = 1.0
+
+# Модели исходов
+OUTCOME_MODEL = os.getenv('MOCK_OUTCOME_MODEL', 'uniform')
+MOCK_SEED = os.getenv('MOCK_SEED')  # общий seed для воспроизводимых прогонов
+CRASH_HOUSE_EDGE = 0.03
+CRASH_MAX_MULTIPLIER = 1000.0
+CRASH_DEFAULT_TARGET = 2.0
+# Общие crash-раунды: m(t) = e^(CRASH_GROWTH * t), t в секундах
+CRASH_GROWTH = 0.06
+CRASH_TICK = float(os.getenv('MOCK_CRASH_TICK_MS', '100')) / 1000
+CRASH_BETTING_TIME = float(os.getenv('MOCK_CRASH_BETTING_MS', '5000')) / 1000
+CRASH_PAUSE = float(os.getenv('MOCK_CRASH_PAUSE_MS', '3000')) / 1000
+CRASH_TIMER_SLOTS = 512
+CRASH_RECENT_ROUNDS = 20
+PAYTABLE = (
+    (0.0, 30.0), (1.5, 25.0), (2.0, 20.0), (5.0, 15.0),
+    (10.0, 7.0), (25.0, 2.5), (50.0, 0.5)
+)
+
+# Настройки массовой симуляции
+SIMULATE_DEFAULT_SPINS = 100000
+SIMULATE_MAX_SPINS = int(os.getenv('MOCK_SIMULATE_MAX_SPINS', '100000000'))
+SIMULATE_CHUNK = 1 << 20
+
+RESULT_TYPES = ('lose', 'win', 'big_win')
+
+# Персистентность: путь к SQLite базе состояния (пусто - только память)
+STATE_DB = os.getenv('MOCK_STATE_DB', '')
+PERSIST_FLUSH_INTERVAL = float(os.getenv('MOCK_PERSIST_FLUSH_MS', '50')) / 1000
+PERSIST_BATCH = 1024
+PERSIST_COMPACT_INTERVAL = float(os.getenv('MOCK_PERSIST_COMPACT_INTERVAL', '60'))
+
+# Общее состояние сессий для нескольких воркеров: memory или sqlite:<путь к файлу>
+SESSION_BACKEND = os.getenv('MOCK_SESSION_BACKEND', 'memory')
+SESSION_CAS_RETRIES = 16
+
+# Ключи идемпотентности спинов и выводов
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('MOCK_IDEMPOTENCY_CACHE_SIZE', '100000'))
+IDEMPOTENCY_TTL = float(os.getenv('MOCK_IDEMPOTENCY_TTL', '3600'))
+WORKER_ID = os.getenv('MOCK_WORKER_ID', '')
+
+# Запись входящего трафика для replay.py: путь к файлу (пусто - запись выключена)
+CAPTURE_FILE = os.getenv('MOCK_CAPTURE', '')
+CAPTURE_FLUSH_INTERVAL = float(os.getenv('MOCK_CAPTURE_FLUSH_MS', '200')) / 1000
+CAPTURE_HEADERS = ('Content-Type', 'Accept-Encoding', 'If-None-Match', 'Idempotency-Key',
+                   'X-Session-Token', 'X-Session-Id')
+CAPTURE_SKIP_PREFIXES = ('/metrics', '/debug/')
+
+# Логи, метрики и профилировщик
+LOG_LEVEL = os.getenv('MOCK_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('MOCK_LOG_FORMAT', 'json')  # json или text
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+PROFILER_INTERVAL = float(os.getenv('MOCK_PROFILER_INTERVAL_MS', '5')) / 1000
+PROFILER_ON_START = os.getenv('MOCK_PROFILER') == '1'
+
+# Защита горячих маршрутов от перегрузки (0 - ограничение выключено)
+RATE_LIMIT_RPS = float(os.getenv('MOCK_RATE_LIMIT_RPS', '50'))
+RATE_LIMIT_BURST = float(os.getenv('MOCK_RATE_LIMIT_BURST', '100'))
+MAX_INFLIGHT = int(os.getenv('MOCK_MAX_INFLIGHT', '32'))
+ADMISSION_QUEUE = int(os.getenv('MOCK_ADMISSION_QUEUE', '64'))
+ADMISSION_TIMEOUT = float(os.getenv('MOCK_ADMISSION_TIMEOUT_MS', '100')) / 1000
+
+# Потоковая статистика раундов: скетч квантилей, окна по времени, слияние воркеров
+STATS_SKETCH_ACCURACY = 0.01
+STATS_QUANTILES = (0.5, 0.9, 0.99)
+STATS_BUCKET_SECONDS = 60
+STATS_WINDOW_BUCKETS = 60
+STATS_DEFAULT_WINDOW = 300
+STATS_PUBLISH_INTERVAL = float(os.getenv('MOCK_STATS_PUBLISH_S', '5'))
+
+# Бэкенд сериализации JSON: auto (orjson, если установлен), orjson или stdlib
+JSON_BACKEND = os.getenv('MOCK_JSON_BACKEND', 'auto')
+
+
+# ==================== СЕРИАЛИЗАЦИЯ JSON ====================
+
+@dataclass(slots=True)
+class RoundEvent:
+    """Push-событие сыгранного раунда"""
+
+    type: str = field(default='round', init=False)
+    gameId: str
+    round: int
+    bet: float
+    win: float
+    multiplier: float
+    result: str
+    timestamp: int
+
+
+@dataclass(slots=True)
+class BalanceEvent:
+    """Push-событие текущего баланса сессии"""
+
+    type: str = field(default='balance', init=False)
+    balance: float
+    currency: str
+    timestamp: int
+
+
+@dataclass(slots=True)
+class CrashTick:
+    """Push-событие текущего множителя crash-раунда"""
+
+    type: str = field(default='crash_tick', init=False)
+    round: int
+    multiplier: float
+    elapsed: float
+
+
+def encode_default(obj):
+    """Поля типизированных событий для кодеков без поддержки dataclass"""
+    if isinstance(obj, (RoundEvent, BalanceEvent, CrashTick)):
+        return {name: getattr(obj, name) for name in obj.__slots__}
+    if np is not None and 'numpy' in sys.modules and isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class StdlibJsonBackend:
+    """Стандартный json модуль"""
+
+    name = 'stdlib'
+    decode_error = json.JSONDecodeError
+
+    @staticmethod
+    def dumps(data, sort_keys=False):
+        return json.dumps(data, sort_keys=sort_keys, separators=(',', ':'), default=encode_default).encode()
+
+    @staticmethod
+    def dumps_text(data):
+        return json.dumps(data, default=encode_default)
+
+    @staticmethod
+    def loads(text):
+        return json.loads(text)
+
+
+class OrjsonBackend:
+    """orjson: кодирует dataclass и numpy значения напрямую в bytes"""
+
+    name = 'orjson'
+    decode_error = json.JSONDecodeError  # orjson.JSONDecodeError - его подкласс
+    _OPTIONS = 0
+
+    @classmethod
+    def dumps(cls, data, sort_keys=False):
+        options = cls._OPTIONS | orjson.OPT_SORT_KEYS if sort_keys else cls._OPTIONS
+        return orjson.dumps(data, default=encode_default, option=options)
+
+    @classmethod
+    def dumps_text(cls, data):
+        return orjson.dumps(data, default=encode_default, option=cls._OPTIONS).decode()
+
+    @staticmethod
+    def loads(text):
+        return orjson.loads(text)
+
+
+if orjson is not None:
+    OrjsonBackend._OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+JSON_BACKENDS = {StdlibJsonBackend.name: StdlibJsonBackend}
+if orjson is not None:
+    JSON_BACKENDS[OrjsonBackend.name] = OrjsonBackend
+
+
+def get_json_backend(name=None):
+    """Бэкенд по имени; при отсутствии orjson - стандартный json"""
+    name = name or JSON_BACKEND
+    if name == 'auto':
+        name = OrjsonBackend.name if orjson is not None else StdlibJsonBackend.name
+    return JSON_BACKENDS.get(name, StdlibJsonBackend)
+
+
+json_backend = get_json_backend()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON провайдер Flask поверх выбранного бэкенда
+
+    Через него проходят jsonify и request.get_json во всех маршрутах.
+    Ответы всегда компактные (как задано JSONIFY_PRETTYPRINT_REGULAR).
+    """
+
+    def dumps(self, obj, **kwargs):
+        return json_backend.dumps(obj, sort_keys=self.sort_keys).decode()
+
+    def loads(self, s, **kwargs):
+        return json_backend.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            json_backend.dumps(obj, sort_keys=self.sort_keys) + b'\n', mimetype=self.mimetype
+        )
+
+
+app.json = FastJSONProvider(app)
+
+
+# ==================== ЛОГИ И МЕТРИКИ ====================
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, сообщение и поля события"""
+
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'msg': record.getMessage()
+        }
+        payload.update(getattr(record, 'fields', None) or {})
+        return json_backend.dumps_text(payload)
+
+
+class TextLogFormatter(logging.Formatter):
+    """Читаемая строка с полями события в виде key=value"""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        line = f'{self.formatTime(record)} {record.levelname} {record.getMessage()}'
+        return line + ''.join(f' {key}={value}' for key, value in fields.items())
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Буферизованные логи: запись кладётся в очередь, в поток вывода пишет отдельный поток"""
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonLogFormatter() if fmt == 'json' else TextLogFormatter())
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logger = logging.getLogger('banana_mock')
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+log = setup_logging()
+
+
+def log_event(level, message, **fields):
+    """Запись с полями; при отключённом уровне ничего не форматируется"""
+    if log.isEnabledFor(level):
+        log.log(level, message, extra={'fields': fields})
+
+
+class StartupTimer:
+    """Разбивка холодного старта по фазам, в секундах от запуска интерпретатора модуля"""
+
+    def __init__(self, began):
+        self.began = began
+        self.last = began
+        self.phases = {}
+        self.details = {}
+        self.first_request = None
+
+    def mark(self, phase, now=None):
+        """Фаза от предыдущей отметки до now"""
+        now = now or time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def record(self, phase, seconds, **details):
+        """Отложенная фаза, выполненная позже (например, индекс статики)"""
+        self.phases[phase] = seconds
+        if details:
+            self.details[phase] = details
+
+    def request_done(self):
+        if self.first_request is None:
+            self.first_request = time.perf_counter() - self.began
+
+    def report(self):
+        return {
+            'phases': {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+            'details': self.details,
+            'firstRequest': round(self.first_request, 6) if self.first_request is not None else None
+        }
+
+
+startup = StartupTimer(STARTUP_BEGAN)
+startup.mark('imports', IMPORTS_DONE)
+
+
+class MetricCounter:
+    """Монотонный счётчик"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter', f'{self.name} {self.value}']
+
+
+class MetricGauge:
+    """Текущее значение: задаётся inc/dec или вычисляется callback при выгрузке"""
+
+    def __init__(self, name, help_text, callback=None):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def render(self):
+        value = self.callback() if self.callback is not None else self.value
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами для каждого набора меток"""
+
+    def __init__(self, name, help_text, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # значения меток -> [счётчики корзин, сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, seconds):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += seconds
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for label_values, counts, total in sorted(snapshot):
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class ServerMetrics:
+    """Метрики сервера в текстовом формате Prometheus (/metrics)"""
+
+    def __init__(self):
+        self.http_latency = LatencyHistogram(
+            'mock_http_request_duration_seconds', 'Время обработки HTTP запроса', ('route', 'method')
+        )
+        self.ws_latency = LatencyHistogram(
+            'mock_websocket_frame_duration_seconds', 'Время обработки WebSocket кадра', ('type',)
+        )
+        self.spins = MetricCounter('mock_spins_total', 'Сыгранные спины')
+        self.cashouts = MetricCounter('mock_cashouts_total', 'Проведённые выводы выигрыша')
+        self.ws_messages = MetricCounter('mock_websocket_frames_total', 'Принятые WebSocket кадры')
+        self.ws_connections = MetricGauge('mock_websocket_connections', 'Открытые WebSocket соединения')
+        self.static_hits = MetricCounter('mock_static_cache_hits_total', 'Попадания в кэш статики')
+        self.static_misses = MetricCounter('mock_static_cache_misses_total', 'Промахи кэша статики')
+        self.rate_limited = MetricCounter('mock_rate_limited_total', 'Запросы, отклонённые лимитом сессии (429)')
+        self.shed = MetricCounter('mock_shed_total', 'Запросы, сброшенные при перегрузке (503)')
+        self.coalesced = MetricCounter('mock_coalesced_total', 'Запросы, получившие ответ одновременного запроса')
+        self.metrics = [
+            self.http_latency, self.ws_latency, self.spins, self.cashouts,
+            self.ws_messages, self.ws_connections, self.static_hits, self.static_misses,
+            self.rate_limited, self.shed, self.coalesced,
+            MetricGauge('mock_inflight_requests', 'Выполняемые запросы горячих маршрутов', lambda: admission.inflight),
+            MetricGauge('mock_sessions_active', 'Сессии в памяти процесса', lambda: len(sessions)),
+            MetricGauge('mock_static_cache_bytes', 'Размер кэша статики', lambda: static_cache.size),
+            MetricGauge('mock_static_cache_hit_ratio', 'Доля попаданий в кэш статики', self._static_hit_ratio),
+        ]
+
+    def _static_hit_ratio(self):
+        lookups = self.static_hits.value + self.static_misses.value
+        return round(self.static_hits.value / lookups, 4) if lookups else 0.0
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append('# HELP mock_startup_seconds Фазы холодного старта')
+        lines.append('# TYPE mock_startup_seconds gauge')
+        for phase, seconds in list(startup.phases.items()):
+            lines.append(f'mock_startup_seconds{{phase="{phase}"}} {seconds:.6f}')
+        if startup.first_request is not None:
+            lines.append(f'mock_startup_seconds{{phase="first_request"}} {startup.first_request:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = ServerMetrics()
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик, включаемый на ходу
+
+    Фоновый поток раз в interval снимает стеки всех потоков через
+    sys._current_frames и считает одинаковые стеки. Результат - свёрнутые
+    стеки (формат flamegraph.pl / speedscope). Пока профилировщик выключен,
+    он ничего не стоит.
+    """
+
+    def __init__(self):
+        self.interval = PROFILER_INTERVAL
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None):
+        """Запускает сбор; False, если уже запущен"""
+        if self.running:
+            return False
+        self.interval = interval or PROFILER_INTERVAL
+        with self._lock:
+            self.samples = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                with self._lock:
+                    self.samples[key] = self.samples.get(key, 0) + 1
+
+    def collapsed(self):
+        """Свёрнутые стеки, от частых к редким"""
+        with self._lock:
+            ordered = sorted(self.samples.items(), key=lambda item: -item[1])
+        return ''.join(f'{stack} {count}\n' for stack, count in ordered)
+
+
+profiler = SamplingProfiler()
+if PROFILER_ON_START:
+    profiler.start()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Задержка запроса в гистограмму по шаблону маршрута"""
+    started = g.get('request_started')
+    if started is not None:
+        pattern = g.get('route')
+        if pattern is None:
+            rule = request.url_rule
+            pattern = rule.rule if rule is not None else 'unmatched'
+        metrics.http_latency.observe((pattern, request.method), time.perf_counter() - started)
+    if startup.first_request is None:
+        startup.request_done()
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/debug/startup', methods=['GET'])
+def startup_report():
+    """Разбивка холодного старта по фазам"""
+    return jsonify(startup.report())
+
+
+@app.route('/debug/profiler', methods=['GET'])
+def profiler_report():
+    """Свёрнутые стеки текущего или последнего сеанса профилирования"""
+    return Response(profiler.collapsed(), mimetype='text/plain', headers={
+        'X-Profiler-Running': str(profiler.running).lower()
+    })
+
+
+@app.route('/debug/profiler/start', methods=['POST'])
+def profiler_start():
+    """Включает сэмплирующий профилировщик (?interval=<мс>)"""
+    interval = request.args.get('interval', type=float)
+    started = profiler.start(interval / 1000 if interval else None)
+    return jsonify({
+        'status': 'started' if started else 'running',
+        'interval': profiler.interval,
+        'timestamp': int(time.time())
+    })
+
+
+@app.route('/debug/profiler/stop', methods=['POST'])
+def profiler_stop():
+    """Выключает профилировщик и возвращает свёрнутые стеки"""
+    profiler.stop()
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+
+# ==================== МОДЕЛИ ИСХОДОВ ====================
+
+class OutcomeError(ValueError):
+    """Некорректная ставка или модель исходов"""
+
+
+_ROUND_KEY = struct.Struct('<QQ')
+_UNIFORM_PAIR = struct.Struct('<QQ')
+_UNIFORM_SCALE = 1.0 / (1 << 53)
+
+
+def session_seed(token):
+    """Seed потока случайных чисел сессии
+
+    При заданном MOCK_SEED seed выводится из токена, и прогоны с теми же
+    токенами повторяются один в один.
+    """
+    if MOCK_SEED is None:
+        return secrets.randbits(63)
+    digest = hashlib.blake2b(f'{MOCK_SEED}:{token}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+def round_uniforms(seed, round_no):
+    """Два равномерных числа из [0, 1) для раунда (seed, round_no)
+
+    Счётчиковый генератор: любой раунд вычисляется за O(1) без прохода
+    по предыдущим раундам и без хранения истории.
+    """
+    digest = hashlib.blake2b(_ROUND_KEY.pack(seed, round_no), digest_size=16).digest()
+    a, b = _UNIFORM_PAIR.unpack(digest)
+    return (a >> 11) * _UNIFORM_SCALE, (b >> 11) * _UNIFORM_SCALE
+
+
+def result_type(multiplier):
+    """Тип результата по множителю выплаты"""
+    if multiplier <= 0:
+        return 'lose'
+    return 'big_win' if multiplier > BIG_WIN_MULTIPLIER else 'win'
+
+
+class OutcomeModel:
+    """Модель исходов: множитель выплаты из равномерных случайных чисел"""
+
+    name = None
+
+    def multiplier(self, u1, u2, target=None):
+        """Множитель одного раунда (0.0 - проигрыш)"""
+        raise NotImplementedError
+
+    def multipliers(self, rng, size, target=None):
+        """Векторная версия multiplier() для массовой симуляции"""
+        raise NotImplementedError
+
+    def histogram_range(self, target=None):
+        """Диапазон множителей для гистограммы симуляции"""
+        raise NotImplementedError
+
+    def describe(self):
+        return {'name': self.name}
+
+
+class UniformModel(OutcomeModel):
+    """Исходная мок-модель: шанс выигрыша и равномерный множитель"""
+
+    name = 'uniform'
+
+    def __init__(self, win_chance=WIN_CHANCE, min_multiplier=MIN_MULTIPLIER,
+                 max_multiplier=MAX_MULTIPLIER):
+        self.win_chance = win_chance
+        self.min_multiplier = min_multiplier
+        self.max_multiplier = max_multiplier
+
+    def multiplier(self, u1, u2, target=None):
+        if u1 >= self.win_chance:
+            return 0.0
+        span = self.max_multiplier - self.min_multiplier
+        return round(self.min_multiplier + u2 * span, 2)
+
+    def multipliers(self, rng, size, target=None):
+        is_win = rng.random(size) < self.win_chance
+        multipliers = np.round(rng.uniform(self.min_multiplier, self.max_multiplier, size), 2)
+        multipliers *= is_win
+        return multipliers
+
+    def histogram_range(self, target=None):
+        return self.min_multiplier, self.max_multiplier
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'winChance': self.win_chance,
+            'minMultiplier': self.min_multiplier,
+            'maxMultiplier': self.max_multiplier
+        }
+
+
+class CrashModel(OutcomeModel):
+    """Crash-кривая: P(crash >= x) = (1 - house_edge) / x
+
+    Игрок выигрывает целевой множитель автокешаута, если раунд
+    не разбился раньше него.
+    """
+
+    name = 'crash'
+
+    def __init__(self, house_edge=CRASH_HOUSE_EDGE, max_multiplier=CRASH_MAX_MULTIPLIER,
+                 default_target=CRASH_DEFAULT_TARGET):
+        self.house_edge = house_edge
+        self.max_multiplier = max_multiplier
+        self.default_target = default_target
+
+    def crash_point(self, u):
+        """Точка краша раунда, округлённая вниз до сотых"""
+        point = math.floor((1 - self.house_edge) / (1 - u) * 100) / 100
+        return min(self.max_multiplier, max(1.0, point))
+
+    def _target(self, target):
+        target = target or self.default_target
+        if not 1.0 < target <= self.max_multiplier:
+            raise OutcomeError(f'target must be between 1.0 and {self.max_multiplier}')
+        return target
+
+    def multiplier(self, u1, u2, target=None):
+        target = self._target(target)
+        return target if self.crash_point(u1) >= target else 0.0
+
+    def multipliers(self, rng, size, target=None):
+        target = self._target(target)
+        points = np.floor((1 - self.house_edge) / (1 - rng.random(size)) * 100) / 100
+        return np.where(points >= target, target, 0.0)
+
+    def histogram_range(self, target=None):
+        return 1.0, self._target(target)
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'houseEdge': self.house_edge,
+            'maxMultiplier': self.max_multiplier,
+            'defaultTarget': self.default_target
+        }
+
+
+class PaytableModel(OutcomeModel):
+    """Дискретная таблица выплат (множитель, вес)"""
+
+    name = 'paytable'
+
+    def __init__(self, table=PAYTABLE):
+        total = sum(weight for _, weight in table)
+        self.payouts = [multiplier for multiplier, _ in table]
+        self.cumulative = []
+        acc = 0.0
+        for _, weight in table:
+            acc += weight / total
+            self.cumulative.append(acc)
+        self.cumulative[-1] = 1.0
+
+    def multiplier(self, u1, u2, target=None):
+        return self.payouts[bisect_right(self.cumulative, u1)]
+
+    def multipliers(self, rng, size, target=None):
+        index = np.searchsorted(self.cumulative, rng.random(size), side='right')
+        return np.asarray(self.payouts)[index]
+
+    def histogram_range(self, target=None):
+        return min(m for m in self.payouts if m > 0), max(self.payouts)
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'paytable': [
+                {'multiplier': m, 'probability': round(c - p, 6)}
+                for m, c, p in zip(self.payouts, self.cumulative, [0.0] + self.cumulative)
+            ]
+        }
+
+
+OUTCOME_MODELS = {
+    model.name: model
+    for model in (UniformModel(), CrashModel(), PaytableModel())
+}
+
+
+def get_outcome_model(name=None):
+    """Модель исходов по имени (по умолчанию MOCK_OUTCOME_MODEL)"""
+    try:
+        return OUTCOME_MODELS[name or OUTCOME_MODEL]
+    except KeyError:
+        raise OutcomeError(f'unknown outcome model: {name}')
+
+
+def validate_bet(bet):
+    """Проверяет, что ставка входит в объявленные betLevels"""
+    try:
+        bet = float(bet)
+    except (TypeError, ValueError):
+        raise OutcomeError('bet must be a number')
+    if bet not in BET_LEVELS:
+        raise OutcomeError(f'bet must be one of {list(BET_LEVELS)}')
+    return bet
+
+
+def play_round(model, seed, round_no, bet, target=None):
+    """Детерминированный исход раунда по (seed, round_no)"""
+    u1, u2 = round_uniforms(seed, round_no)
+    multiplier = model.multiplier(u1, u2, target)
+    return {
+        'id': f'game_{round_no}',
+        'round': round_no,
+        'bet': bet,
+        'win': round(multiplier * bet, 2),
+        'multiplier': multiplier,
+        'result': result_type(multiplier)
+    }
+
+
+# ==================== ПЕРСИСТЕНТНОСТЬ ====================
+
+_SESSION_COLUMNS = (
+    'token', 'session_id', 'balance', 'currency', 'total_spins', 'total_wins',
+    'total_losses', 'biggest_win', 'total_wagered', 'total_won', 'seed', 'model',
+    'pending_win', 'active_round'
+)
+
+
+class StateJournal:
+    """Журнал состояния сессий в SQLite (WAL)
+
+    Спины и выводы не ждут диска: записи копятся в памяти и фоновый поток
+    сбрасывает их пачкой в одной транзакции (group commit) раз в
+    PERSIST_FLUSH_INTERVAL или при накоплении PERSIST_BATCH записей. Вместе
+    с пачкой обновляется снимок строки сессии; периодическое уплотнение
+    оставляет в журнале только последние HISTORY_DEPTH раундов сессии.
+    Сессии восстанавливаются лениво - при первом обращении к токену.
+    """
+
+    def __init__(self, path, flush_interval=PERSIST_FLUSH_INTERVAL,
+                 batch=PERSIST_BATCH, compact_interval=PERSIST_COMPACT_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self.compact_interval = compact_interval
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._rounds = []
+        self._cashouts = []
+        self._snapshots = {}  # token -> строка сессии на момент последней записи
+        self._compact_tokens = set()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._init_schema()
+        self._writer = threading.Thread(target=self._run, name='state-journal', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _init_schema(self):
+        with self._db_lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # В WAL режиме NORMAL не делает fsync на каждый коммит - только на checkpoint
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    token TEXT PRIMARY KEY, session_id TEXT UNIQUE, balance REAL,
+                    currency TEXT, total_spins INTEGER, total_wins INTEGER,
+                    total_losses INTEGER, biggest_win REAL, total_wagered REAL,
+                    total_won REAL, seed INTEGER, model TEXT,
+                    pending_win REAL, active_round INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS rounds (
+                    token TEXT, round INTEGER, timestamp INTEGER, bet REAL, win REAL,
+                    multiplier REAL, result TEXT, PRIMARY KEY (token, round)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS cashouts (
+                    id INTEGER PRIMARY KEY, token TEXT, timestamp INTEGER, amount REAL
+                );
+                CREATE INDEX IF NOT EXISTS cashouts_token ON cashouts (token, id);
+            ''')
+
+    @staticmethod
+    def session_row(session):
+        """Снимок полей сессии (вызывается под блокировкой сессии)"""
+        return (
+            session.token, session.session_id, session.balance, session.currency,
+            session.total_spins, session.total_wins, session.total_losses,
+            session.biggest_win, session.total_wagered, session.total_won,
+            session.seed, session.model, session.pending_win, session.active_round
+        )
+
+    def _enqueue(self, session, records, record):
+        with self._pending_lock:
+            if record is not None:
+                records.append(record)
+            self._snapshots[session.token] = self.session_row(session)
+            full = len(self._rounds) + len(self._cashouts) >= self.batch
+        if full:
+            self._wakeup.set()
+
+    def record_round(self, session, round_no, timestamp, bet, win, multiplier, result):
+        """Раунд сессии в очередь на запись"""
+        self._enqueue(session, self._rounds, (session.token, round_no, timestamp, bet, win, multiplier, result))
+
+    def record_cashout(self, session, timestamp, amount):
+        """Вывод средств в очередь на запись"""
+        self._enqueue(session, self._cashouts, (session.token, timestamp, amount))
+
+    def touch(self, session):
+        """Сохраняет изменённые поля сессии (seed, модель) без новой записи"""
+        self._enqueue(session, None, None)
+
+    def flush(self):
+        """Записывает накопленные записи одной транзакцией
+
+        Пачка забирается под блокировкой базы, чтобы снимки сессий ложились
+        в порядке записи. Если транзакция не прошла, пачка возвращается в
+        начало очереди и уйдёт со следующим сбросом; более новые снимки тех
+        же сессий, накопленные за это время, остаются в силе.
+        """
+        placeholders = ', '.join('?' * len(_SESSION_COLUMNS))
+        with self._db_lock:
+            with self._pending_lock:
+                if not self._snapshots:
+                    return 0
+                rounds, self._rounds = self._rounds, []
+                cashouts, self._cashouts = self._cashouts, []
+                snapshots, self._snapshots = self._snapshots, {}
+            try:
+                self._db.execute('BEGIN')
+                self._db.executemany(
+                    f'INSERT OR REPLACE INTO sessions ({", ".join(_SESSION_COLUMNS)}) VALUES ({placeholders})',
+                    snapshots.values()
+                )
+                self._db.executemany('INSERT OR REPLACE INTO rounds VALUES (?, ?, ?, ?, ?, ?, ?)', rounds)
+                self._db.executemany('INSERT INTO cashouts (token, timestamp, amount) VALUES (?, ?, ?)', cashouts)
+                self._db.execute('COMMIT')
+            except BaseException:
+                if self._db.in_transaction:
+                    self._db.execute('ROLLBACK')
+                with self._pending_lock:
+                    self._rounds[:0] = rounds
+                    self._cashouts[:0] = cashouts
+                    self._snapshots = {**snapshots, **self._snapshots}
+                raise
+            self._compact_tokens.update(snapshots)
+        return len(rounds) + len(cashouts)
+
+    def compact(self):
+        """Удаляет раунды и выводы старше глубины истории и усекает WAL"""
+        with self._db_lock:
+            tokens, self._compact_tokens = self._compact_tokens, set()
+            self._db.execute('BEGIN')
+            for token in tokens:
+                self._db.execute(
+                    'DELETE FROM rounds WHERE token = ? AND round <= '
+                    '(SELECT total_spins FROM sessions WHERE token = ?) - ?',
+                    (token, token, HISTORY_DEPTH)
+                )
+                self._db.execute(
+                    'DELETE FROM cashouts WHERE token = ? AND id NOT IN '
+                    '(SELECT id FROM cashouts WHERE token = ? ORDER BY id DESC LIMIT ?)',
+                    (token, token, HISTORY_DEPTH)
+                )
+            self._db.execute('COMMIT')
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def load(self, token=None, session_id=None):
+        """Сохранённая сессия: (строка сессии, раунды от старых к новым) или None"""
+        self.flush()  # сессия могла быть вытеснена из памяти до записи на диск
+        column, key = ('token', token) if token is not None else ('session_id', session_id)
+        with self._db_lock:
+            row = self._db.execute(
+                f'SELECT {", ".join(_SESSION_COLUMNS)} FROM sessions WHERE {column} = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            rounds = self._db.execute(
+                'SELECT round, timestamp, bet, win, multiplier, result FROM rounds '
+                'WHERE token = ? AND round > ? ORDER BY round',
+                (row[0], row[4] - HISTORY_DEPTH)
+            ).fetchall()
+        return dict(zip(_SESSION_COLUMNS, row)), rounds
+
+    def _run(self):
+        last_compact = time.monotonic()
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.monotonic() - last_compact >= self.compact_interval:
+                    self.compact()
+                    last_compact = time.monotonic()
+            except sqlite3.Error as e:
+                log_event(logging.ERROR, 'Ошибка записи состояния', error=str(e))
+
+    def close(self):
+        """Сбрасывает хвост журнала при остановке процесса"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join(timeout=5)
+        self.flush()
+        self.compact()
+        with self._db_lock:
+            self._db.close()
+
+
+state_journal = StateJournal(STATE_DB) if STATE_DB else None
+
+
+# ==================== ОБЩЕЕ СОСТОЯНИЕ СЕССИЙ ====================
+
+class SessionConflict(RuntimeError):
+    """Сессию одновременно меняют другие воркеры, повторы исчерпаны"""
+
+
+class _MemoryRow:
+    """Версия и снимок полей одной сессии со своей блокировкой"""
+
+    __slots__ = ('version', 'row', 'lock')
+
+    def __init__(self, row):
+        self.version = 0
+        self.row = row
+        self.lock = threading.Lock()
+
+
+class MemorySessionBackend:
+    """Состояние сессий в памяти процесса (один воркер, тесты)
+
+    Хранит версию и снимок полей каждой сессии; обновления проходят через
+    compare_and_set, как и в общих бэкендах. Проверка версии берёт только
+    блокировку строки сессии, общая блокировка нужна лишь для создания и
+    удаления строк. Раунды живут только в кольцевом буфере GameHistory
+    самой сессии: процесс один, и второй копии истории здесь не нужно.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._rows = {}  # token -> _MemoryRow
+        self._by_session_id = {}
+        self._lock = threading.Lock()
+
+    def load(self, token=None, session_id=None):
+        """(версия, снимок, None) или None; раунды не хранятся - история сессии остаётся своей"""
+        if token is None:
+            token = self._by_session_id.get(session_id)
+        entry = self._rows.get(token)
+        if entry is None:
+            return None
+        with entry.lock:
+            return entry.version, dict(entry.row), None
+
+    def version(self, token):
+        entry = self._rows.get(token)
+        return entry.version if entry is not None else None
+
+    def insert(self, row, rounds=()):
+        """Создаёт сессию с версией 0; False, если её уже создал другой воркер"""
+        with self._lock:
+            if row['token'] in self._rows:
+                return False
+            self._rows[row['token']] = _MemoryRow(dict(row))
+            self._by_session_id[row['session_id']] = row['token']
+            return True
+
+    def receipt(self, token, key, ttl=IDEMPOTENCY_TTL):
+        """Квитанции процесса целиком в IdempotencyCache хранилища"""
+        return None
+
+    def discard_receipt(self, token, key):
+        pass
+
+    def compare_and_set(self, token, version, changes, round_row=None, receipt=None, ttl=IDEMPOTENCY_TTL):
+        """Применяет изменения, если версия не изменилась; новая версия или None"""
+        entry = self._rows.get(token)
+        if entry is None:
+            return None
+        with entry.lock:
+            if entry.version != version:
+                return None
+            entry.version = version + 1
+            entry.row.update(changes)
+            return entry.version
+
+    def discard(self, token):
+        """Забывает сессию, вытесненную из хранилища процесса"""
+        with self._lock:
+            entry = self._rows.pop(token, None)
+            if entry is not None:
+                self._by_session_id.pop(entry.row['session_id'], None)
+
+    def publish_stats(self, worker, payload, now):
+        """В памяти процесса воркер один - снимки статистики не нужны"""
+
+    def worker_stats(self):
+        return []
+
+
+class SqliteSessionBackend:
+    """Общее состояние сессий в SQLite файле для нескольких процессов
+
+    Локальная замена Redis: все воркеры открывают один файл, а обновление
+    проходит, только если версия сессии не изменилась с момента чтения
+    (UPDATE ... WHERE version = ?).
+    """
+
+    shared = True
+
+    def __init__(self, path, history_depth=HISTORY_DEPTH):
+        self.path = path
+        self.history_depth = history_depth
+        self._local = threading.local()
+        self._update_sql = {}
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS shared_sessions (
+                token TEXT PRIMARY KEY, session_id TEXT UNIQUE, version INTEGER NOT NULL,
+                balance REAL, currency TEXT, total_spins INTEGER, total_wins INTEGER,
+                total_losses INTEGER, biggest_win REAL, total_wagered REAL,
+                total_won REAL, seed INTEGER, model TEXT,
+                pending_win REAL, active_round INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS shared_rounds (
+                token TEXT, round INTEGER, timestamp INTEGER, bet REAL, win REAL,
+                multiplier REAL, result TEXT, PRIMARY KEY (token, round)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS worker_stats (
+                worker TEXT PRIMARY KEY, updated REAL, payload TEXT
+            );
+            CREATE TABLE IF NOT EXISTS shared_receipts (
+                token TEXT, key TEXT, created REAL, fingerprint TEXT, result TEXT,
+                PRIMARY KEY (token, key)
+            ) WITHOUT ROWID;
+        ''')
+
+    def _db(self):
+        """Соединение текущего потока"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def load(self, token=None, session_id=None):
+        """(версия, снимок, раунды от старых к новым) или None"""
+        db = self._db()
+        column, key = ('token', token) if token is not None else ('session_id', session_id)
+        row = db.execute(
+            f'SELECT version, {", ".join(_SESSION_COLUMNS)} FROM shared_sessions WHERE {column} = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        rounds = db.execute(
+            'SELECT round, timestamp, bet, win, multiplier, result FROM shared_rounds '
+            'WHERE token = ? ORDER BY round DESC LIMIT ?', (row[1], self.history_depth)
+        ).fetchall()
+        rounds.reverse()
+        return row[0], dict(zip(_SESSION_COLUMNS, row[1:])), rounds
+
+    def version(self, token):
+        row = self._db().execute('SELECT version FROM shared_sessions WHERE token = ?', (token,)).fetchone()
+        return row[0] if row is not None else None
+
+    def insert(self, row, rounds=()):
+        """Создаёт сессию с версией 0; False, если её уже создал другой воркер"""
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(
+                f'INSERT INTO shared_sessions (version, {", ".join(row)}) VALUES (0{", ?" * len(row)})',
+                tuple(row.values())
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO shared_rounds VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(row['token'], *entry) for entry in rounds]
+            )
+        except sqlite3.IntegrityError:
+            db.execute('ROLLBACK')
+            return False
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return True
+
+    def receipt(self, token, key, ttl=IDEMPOTENCY_TTL):
+        """(отпечаток, результат) операции с ключом идемпотентности или None"""
+        row = self._db().execute(
+            'SELECT fingerprint, result FROM shared_receipts WHERE token = ? AND key = ? AND created > ?',
+            (token, key, time.time() - ttl)
+        ).fetchone()
+        return (row[0], json_backend.loads(row[1])) if row is not None else None
+
+    def discard_receipt(self, token, key):
+        """Удаляет квитанцию операции, отменённой после проводки"""
+        self._db().execute('DELETE FROM shared_receipts WHERE token = ? AND key = ?', (token, key))
+
+    def compare_and_set(self, token, version, changes, round_row=None, receipt=None, ttl=IDEMPOTENCY_TTL):
+        """Применяет изменения, если версия не изменилась; новая версия или None
+
+        receipt - (ключ, отпечаток, результат) операции с ключом идемпотентности:
+        квитанция пишется в той же транзакции, что и изменения, поэтому повтор
+        ключа на другом воркере видит её, как только видит новую версию сессии.
+        """
+        names = tuple(changes)
+        sql = self._update_sql.get(names)
+        if sql is None:
+            assignments = ''.join(f'{name} = ?, ' for name in names)
+            sql = self._update_sql[names] = (
+                f'UPDATE shared_sessions SET {assignments}version = version + 1 '
+                'WHERE token = ? AND version = ?'
+            )
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if db.execute(sql, (*changes.values(), token, version)).rowcount != 1:
+                db.execute('ROLLBACK')
+                return None
+            if round_row is not None:
+                db.execute('INSERT OR REPLACE INTO shared_rounds VALUES (?, ?, ?, ?, ?, ?, ?)', (token, *round_row))
+                db.execute(
+                    'DELETE FROM shared_rounds WHERE token = ? AND round <= ?',
+                    (token, round_row[0] - self.history_depth)
+                )
+            if receipt is not None:
+                now = time.time()
+                db.execute('DELETE FROM shared_receipts WHERE token = ? AND created <= ?', (token, now - ttl))
+                key, fingerprint, result = receipt
+                db.execute(
+                    'INSERT INTO shared_receipts VALUES (?, ?, ?, ?, ?)',
+                    (token, key, now, fingerprint, json_backend.dumps(result))
+                )
+        except sqlite3.IntegrityError:
+            # Ключ уже провёл другой воркер: вызывающий перечитает сессию и квитанцию
+            db.execute('ROLLBACK')
+            return None
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return version + 1
+
+    def discard(self, token):
+        """Общее состояние переживает вытеснение сессии из памяти воркера"""
+
+    def publish_stats(self, worker, payload, now):
+        """Сохраняет снимок статистики воркера (заменяет предыдущий)"""
+        self._db().execute('INSERT OR REPLACE INTO worker_stats VALUES (?, ?, ?)', (worker, now, payload))
+
+    def worker_stats(self):
+        """Снимки статистики всех воркеров, включая завершившиеся"""
+        return self._db().execute('SELECT worker, payload FROM worker_stats').fetchall()
+
+
+def get_session_backend(spec=None):
+    """Бэкенд состояния сессий по строке memory | sqlite:<путь>"""
+    kind, _, path = (spec or SESSION_BACKEND).partition(':')
+    if kind == 'memory':
+        return MemorySessionBackend()
+    if kind == 'sqlite' and path:
+        return SqliteSessionBackend(path)
+    raise ValueError(f'unknown session backend: {spec or SESSION_BACKEND}')
+
+
+class IdempotencyMismatch(RuntimeError):
+    """Ключ идемпотентности уже использован другой операцией или с другими параметрами"""
+
+
+def operation_fingerprint(operation):
+    """Отпечаток операции и её параметров для ключа идемпотентности"""
+    return hashlib.blake2b(repr(operation).encode(), digest_size=8).hexdigest()
+
+
+class IdempotencyCache:
+    """Результаты операций по ключу идемпотентности (LRU с TTL)
+
+    Повтор запроса с тем же ключом возвращает сохранённый результат
+    и не списывает/не начисляет средства второй раз. Вместе с результатом
+    хранится отпечаток операции: ключ, повторённый с другой операцией или
+    другими параметрами, не получает чужую квитанцию (IdempotencyMismatch).
+    """
+
+    def __init__(self, capacity=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (token, ключ) -> (время записи, отпечаток, результат)
+        self._lock = threading.Lock()
+
+    def get(self, key, fingerprint):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            if entry[1] != fingerprint:
+                raise IdempotencyMismatch(f'idempotency key {key[1]!r} was used for a different request')
+            return entry[2]
+
+    def put(self, key, fingerprint, result):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), fingerprint, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def affinity_key(token):
+    """Ключ привязки сессии к воркеру для балансировщика"""
+    return hashlib.blake2b(token.encode(), digest_size=8).hexdigest()
+
+
+def worker_id():
+    """Имя воркера: MOCK_WORKER_ID или <hostname>-<pid>
+
+    Одно имя для X-Worker-Id, снимков статистики и id соединений записи
+    трафика; pid берётся при каждом вызове, потому что воркеры форкаются
+    после импорта модуля.
+    """
+    return WORKER_ID or f'{socket.gethostname()}-{os.getpid()}'
+
+
+# ==================== СТАТИСТИКА ====================
+
+class QuantileSketch:
+    """Сливаемый скетч квантилей с относительной точностью (DDSketch)
+
+    Значение x > 0 попадает в корзину ceil(log_gamma(x)), нули считаются
+    отдельно. Квантиль восстанавливается с относительной ошибкой не больше
+    accuracy, а число корзин растёт с логарифмом диапазона значений, не с
+    числом раундов. Слияние - сложение счётчиков корзин, поэтому скетчи
+    окон и воркеров объединяются без потери точности.
+    """
+
+    __slots__ = ('accuracy', 'log_gamma', 'bins', 'zeros', 'count', 'max')
+
+    def __init__(self, accuracy=STATS_SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.log_gamma = math.log((1 + accuracy) / (1 - accuracy))
+        self.bins = {}  # индекс корзины -> число значений
+        self.zeros = 0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError('cannot merge sketches with different accuracy')
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantiles(self, qs):
+        """Оценки квантилей qs (по возрастанию) за один проход по корзинам"""
+        if not self.count:
+            return [None] * len(qs)
+        result = []
+        keys = iter(sorted(self.bins))
+        seen = self.zeros
+        key = None
+        for q in qs:
+            rank = q * (self.count - 1)
+            if rank < self.zeros:
+                result.append(0.0)
+                continue
+            while seen <= rank:
+                key = next(keys, None)
+                if key is None:
+                    break
+                seen += self.bins[key]
+            if key is None:
+                result.append(self.max)
+            else:
+                # Середина корзины (gamma^(k-1), gamma^k] в смысле относительной ошибки
+                estimate = 2 * math.exp(key * self.log_gamma) / (1 + math.exp(self.log_gamma))
+                result.append(round(min(estimate, self.max), 2))
+        return result
+
+    def to_dict(self):
+        return {'accuracy': self.accuracy, 'zeros': self.zeros, 'count': self.count,
+                'max': self.max, 'bins': [[key, count] for key, count in self.bins.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['accuracy'])
+        sketch.bins = {key: count for key, count in data['bins']}
+        sketch.zeros = data['zeros']
+        sketch.count = data['count']
+        sketch.max = data['max']
+        return sketch
+
+
+class RoundStats:
+    """Накопитель статистики раундов: суммы, скетч множителей и разбивка по ставкам
+
+    Обновляется по одному раунду за O(1) и сливается с другим накопителем,
+    поэтому один и тот же тип служит для сессии, окна времени и воркера.
+    """
+
+    __slots__ = ('rounds', 'wins', 'wagered', 'won', 'biggest_win', 'multipliers', 'by_bet')
+
+    def __init__(self):
+        self.rounds = 0
+        self.wins = 0
+        self.wagered = 0.0
+        self.won = 0.0
+        self.biggest_win = 0.0
+        self.multipliers = QuantileSketch()
+        self.by_bet = {}  # ставка -> [раунды, поставлено, выиграно]
+
+    def add(self, bet, win, multiplier):
+        self.rounds += 1
+        self.wagered += bet
+        if win > 0:
+            self.wins += 1
+            self.won += win
+            if win > self.biggest_win:
+                self.biggest_win = win
+        self.multipliers.add(multiplier)
+        level = self.by_bet.get(bet)
+        if level is None:
+            level = self.by_bet[bet] = [0, 0.0, 0.0]
+        level[0] += 1
+        level[1] += bet
+        level[2] += win
+
+    def merge(self, other):
+        self.rounds += other.rounds
+        self.wins += other.wins
+        self.wagered += other.wagered
+        self.won += other.won
+        self.biggest_win = max(self.biggest_win, other.biggest_win)
+        self.multipliers.merge(other.multipliers)
+        for bet, (rounds, wagered, won) in other.by_bet.items():
+            level = self.by_bet.get(bet)
+            if level is None:
+                level = self.by_bet[bet] = [0, 0.0, 0.0]
+            level[0] += rounds
+            level[1] += wagered
+            level[2] += won
+        return self
+
+    def summary(self):
+        """Сводка: RTP, доля выигрышей, квантили множителя и разбивка по ставкам"""
+        p50, p90, p99 = self.multipliers.quantiles(STATS_QUANTILES)
+        return {
+            'rounds': self.rounds,
+            'wins': self.wins,
+            'losses': self.rounds - self.wins,
+            'total_wagered': round(self.wagered, 2),
+            'total_won': round(self.won, 2),
+            'rtp': round(self.won / self.wagered * 100, 4) if self.wagered else 0.0,
+            'win_rate': round(self.wins / self.rounds * 100, 2) if self.rounds else 0.0,
+            'biggest_win': self.biggest_win,
+            'multipliers': {'p50': p50, 'p90': p90, 'p99': p99, 'max': self.multipliers.max},
+            'by_bet': {
+                str(bet): {
+                    'rounds': rounds,
+                    'wagered': round(wagered, 2),
+                    'won': round(won, 2),
+                    'rtp': round(won / wagered * 100, 4) if wagered else 0.0
+                }
+                for bet, (rounds, wagered, won) in sorted(self.by_bet.items())
+            }
+        }
+
+    def to_dict(self):
+        return {'rounds': self.rounds, 'wins': self.wins, 'wagered': self.wagered, 'won': self.won,
+                'biggest_win': self.biggest_win, 'multipliers': self.multipliers.to_dict(),
+                'by_bet': [[bet, *level] for bet, level in self.by_bet.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.rounds = data['rounds']
+        stats.wins = data['wins']
+        stats.wagered = data['wagered']
+        stats.won = data['won']
+        stats.biggest_win = data['biggest_win']
+        stats.multipliers = QuantileSketch.from_dict(data['multipliers'])
+        stats.by_bet = {bet: [rounds, wagered, won] for bet, rounds, wagered, won in data['by_bet']}
+        return stats
+
+
+class WindowedStats:
+    """Кольцо накопителей по интервалам времени для скользящих окон
+
+    Раунд попадает в интервал floor(now / width); устаревший интервал
+    переиспользуется при первой записи. Окно - слияние не более
+    len(buckets) накопителей, независимо от числа сыгранных раундов.
+    """
+
+    def __init__(self, width=STATS_BUCKET_SECONDS, buckets=STATS_WINDOW_BUCKETS):
+        self.width = width
+        self._epochs = [None] * buckets
+        self._buckets = [None] * buckets
+
+    @property
+    def span(self):
+        return self.width * len(self._buckets)
+
+    def add(self, now, bet, win, multiplier):
+        epoch = int(now // self.width)
+        index = epoch % len(self._buckets)
+        if self._epochs[index] != epoch:
+            self._epochs[index] = epoch
+            self._buckets[index] = RoundStats()
+        self._buckets[index].add(bet, win, multiplier)
+
+    def first_epoch(self, now, seconds):
+        """Самый старый интервал окна из последних seconds секунд"""
+        return int(now // self.width) - max(1, math.ceil(min(seconds, self.span) / self.width)) + 1
+
+    def buckets(self, now, seconds):
+        """(интервал, накопитель) за последние seconds секунд"""
+        newest = int(now // self.width)
+        oldest = self.first_epoch(now, seconds)
+        return [
+            (epoch, stats) for epoch, stats in zip(self._epochs, self._buckets)
+            if epoch is not None and oldest <= epoch <= newest
+        ]
+
+    def to_dict(self, now):
+        return [[epoch, stats.to_dict()] for epoch, stats in self.buckets(now, self.span)]
+
+
+class StatsAggregator:
+    """Глобальная статистика раундов процесса с окнами и слиянием воркеров
+
+    Раунды учитываются по мере проведения (спины и crash-ставки). С общим
+    бэкендом сессий воркер раз в STATS_PUBLISH_INTERVAL публикует снимок
+    своих накопителей, а запрос статистики сливает свой накопитель со
+    снимками остальных воркеров.
+    """
+
+    def __init__(self, backend, publish_interval=STATS_PUBLISH_INTERVAL):
+        self.backend = backend
+        self.publish_interval = publish_interval
+        self.total = RoundStats()
+        self.recent = WindowedStats()
+        self._lock = threading.Lock()
+        self._published = 0.0
+
+    def record(self, session, bet, win, multiplier, now=None):
+        """Учитывает проведённый раунд в накопителях сессии, процесса и окна"""
+        now = time.time() if now is None else now
+        with session.lock:
+            session.stats.add(bet, win, multiplier)
+        with self._lock:
+            self.total.add(bet, win, multiplier)
+            self.recent.add(now, bet, win, multiplier)
+            publish = self.backend.shared and now - self._published >= self.publish_interval
+            if publish:
+                self._published = now
+        if publish:
+            self.publish(now)
+
+    def _snapshot(self, now):
+        with self._lock:
+            return {'total': self.total.to_dict(), 'recent': self.recent.to_dict(now)}
+
+    def publish(self, now=None):
+        """Снимок накопителей воркера в общий бэкенд"""
+        now = time.time() if now is None else now
+        try:
+            self.backend.publish_stats(worker_id(), json_backend.dumps_text(self._snapshot(now)), now)
+        except sqlite3.Error as e:
+            log_event(logging.WARNING, 'Не удалось опубликовать статистику воркера', error=str(e))
+
+    def report(self, window=STATS_DEFAULT_WINDOW, now=None):
+        """Итог и скользящее окно по всем воркерам"""
+        now = time.time() if now is None else now
+        oldest = self.recent.first_epoch(now, window)
+        total = RoundStats()
+        windowed = RoundStats()
+        with self._lock:
+            total.merge(self.total)
+            for _, stats in self.recent.buckets(now, window):
+                windowed.merge(stats)
+        workers = 1
+        if self.backend.shared:
+            me = worker_id()
+            for worker, payload in self.backend.worker_stats():
+                if worker == me:
+                    continue
+                workers += 1
+                snapshot = json_backend.loads(payload)
+                total.merge(RoundStats.from_dict(snapshot['total']))
+                for epoch, stats in snapshot['recent']:
+                    if epoch >= oldest:
+                        windowed.merge(RoundStats.from_dict(stats))
+        return {
+            'total': total.summary(),
+            'window': windowed.summary(),
+            'windowSeconds': min(window, self.recent.span),
+            'workers': workers
+        }
+
+
+# ==================== СЕССИИ ====================
+
+class GameHistory:
+    """Кольцевой буфер истории раундов фиксированной ёмкости
+
+    Поля раундов хранятся в отдельных array.array, поэтому добавление
+    выполняется за O(1) без создания словаря на каждый спин. Раунды
+    нумеруются с 1, номер раунда служит курсором для пагинации.
+    """
+
+    __slots__ = ('capacity', 'count', '_timestamp', '_bet', '_win', '_multiplier', '_result')
+
+    def __init__(self, capacity=HISTORY_DEPTH):
+        self.capacity = max(1, capacity)
+        self.count = 0
+        self._timestamp = array('q')
+        self._bet = array('d')
+        self._win = array('d')
+        self._multiplier = array('d')
+        self._result = array('b')
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def first(self):
+        """Номер самого старого раунда, который ещё хранится в буфере"""
+        return max(1, self.count - self.capacity + 1)
+
+    def append(self, timestamp, bet, win, multiplier, result):
+        """Добавляет раунд и возвращает его номер"""
+        code = RESULT_TYPES.index(result)
+        if self.count < self.capacity:
+            # Буфер ещё растёт - память выделяется только под сыгранные раунды
+            self._timestamp.append(timestamp)
+            self._bet.append(bet)
+            self._win.append(win)
+            self._multiplier.append(multiplier)
+            self._result.append(code)
+        else:
+            i = self.count % self.capacity
+            self._timestamp[i] = timestamp
+            self._bet[i] = bet
+            self._win[i] = win
+            self._multiplier[i] = multiplier
+            self._result[i] = code
+        self.count += 1
+        return self.count
+
+    def restore(self, rounds):
+        """Заполняет буфер сохранёнными раундами (round, timestamp, bet, win, multiplier, result)"""
+        rounds = rounds[-self.capacity:]
+        if not rounds:
+            return
+        last = rounds[-1][0]
+        size = min(last, self.capacity)
+        for column in (self._timestamp, self._bet, self._win, self._multiplier, self._result):
+            column.extend([0] * (size - len(column)))
+        for round_no, timestamp, bet, win, multiplier, result in rounds:
+            i = (round_no - 1) % self.capacity
+            self._timestamp[i] = timestamp
+            self._bet[i] = bet
+            self._win[i] = win
+            self._multiplier[i] = multiplier
+            self._result[i] = RESULT_TYPES.index(result)
+        self.count = last
+
+    def entry(self, round_no):
+        """Раунд в формате API"""
+        i = (round_no - 1) % self.capacity
+        return {
+            'id': f'game_{round_no}',
+            'round': round_no,
+            'timestamp': self._timestamp[i],
+            'bet': self._bet[i],
+            'win': self._win[i],
+            'multiplier': self._multiplier[i],
+            'result': RESULT_TYPES[self._result[i]]
+        }
+
+    def page(self, since=None, before=None, limit=HISTORY_PAGE_LIMIT):
+        """Страница истории от новых раундов к старым
+
+        since  - вернуть только раунды новее указанного номера
+        before - вернуть только раунды старше указанного номера
+        Возвращает (раунды, курсор следующей страницы или None).
+        """
+        upper = self.count if before is None else min(before - 1, self.count)
+        lower = self.first if since is None else max(since + 1, self.first)
+        stop = max(lower, upper - limit + 1)
+        entries = [self.entry(n) for n in range(upper, stop - 1, -1)]
+        next_cursor = stop if entries and stop > lower else None
+        return entries, next_cursor
+
+
+class GameSession:
+    """Состояние одной игровой сессии (баланс, история, статистика)"""
+
+    __slots__ = (
+        'token', 'session_id', 'balance', 'currency', 'history',
+        'total_spins', 'total_wins', 'total_losses', 'biggest_win',
+        'total_wagered', 'total_won', 'seed', 'model', 'pending_win', 'active_round',
+        'last_seen', 'lock', 'version', 'stats'
+    )
+
+    def __init__(self, token, session_id):
+        self.token = token
+        self.session_id = session_id
+        self.balance = DEFAULT_BALANCE
+        self.currency = DEFAULT_CURRENCY
+        self.history = GameHistory()
+        self.total_spins = 0
+        self.total_wins = 0
+        self.total_losses = 0
+        self.biggest_win = 0.0
+        self.total_wagered = 0.0
+        self.total_won = 0.0
+        self.seed = session_seed(token)
+        self.model = OUTCOME_MODEL
+        self.pending_win = 0.0  # выигрыш активного раунда, ещё не зачисленный на баланс
+        self.active_round = 0
+        self.last_seen = time.monotonic()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.stats = RoundStats()  # раунды, проведённые этим процессом
+
+    @classmethod
+    def restore(cls, version, row, rounds):
+        """Сессия из сохранённого снимка и последних раундов"""
+        session = cls(row['token'], row['session_id'])
+        session.apply(version, row, rounds)
+        for _, _, bet, win, multiplier, _ in rounds or ():
+            session.stats.add(bet, win, multiplier)
+        return session
+
+    def apply(self, version, row, rounds):
+        """Заменяет состояние снимком из хранилища (rounds=None - история не меняется)"""
+        for name, value in row.items():
+            setattr(self, name, value)
+        if rounds is not None:
+            self.history = GameHistory()
+            self.history.restore(rounds)
+        self.total_spins = max(self.total_spins, self.history.count)
+        self.version = version
+
+    def row(self):
+        """Снимок сохраняемых полей"""
+        return {name: getattr(self, name) for name in _SESSION_COLUMNS}
+
+    def statistics(self):
+        """Снимок статистики сессии"""
+        with self.lock:
+            return {
+                'total_spins': self.total_spins,
+                'total_wins': self.total_wins,
+                'total_losses': self.total_losses,
+                'biggest_win': self.biggest_win,
+                'total_wagered': self.total_wagered,
+                'total_won': self.total_won,
+                'rtp': round(self.total_won / self.total_wagered * 100, 4) if self.total_wagered else 0.0,
+                **{key: value for key, value in self.stats.summary().items() if key in ('multipliers', 'by_bet')}
+            }
+
+
+class SessionStore:
+    """Хранилище сессий по токену с вытеснением неактивных сессий
+
+    Глобальная блокировка удерживается только на время поиска в словаре,
+    все изменения состояния выполняются под блокировкой самой сессии.
+    С журналом состояния вытесненные и ещё не загруженные сессии
+    поднимаются из базы при первом обращении.
+
+    Сессии в памяти - кэш над бэкендом состояния. Изменения проходят через
+    transact: оптимистичная проверка версии в бэкенде и повтор при
+    конфликте, поэтому несколько воркеров с общим бэкендом не теряют
+    обновлений. При общем бэкенде версия сверяется на каждом обращении;
+    с привязкой сессий к воркеру (X-Affinity-Key) перечитывать почти не нужно.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_ttl=SESSION_IDLE_TTL, journal=None, backend=None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.journal = journal
+        self.backend = backend if backend is not None else MemorySessionBackend()
+        self.idempotency = IdempotencyCache()
+        self._sessions = OrderedDict()  # token -> GameSession, от старых к новым
+        self._by_session_id = {}
+        self._lock = threading.Lock()
+        self.get_or_create(DEFAULT_TOKEN, DEFAULT_SESSION_ID)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get_or_create(self, token, session_id=None):
+        """Возвращает сессию по токену, создавая её при первом обращении"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(token)
+            cached = session is not None
+            if not cached:
+                session = self._load(token, session_id)
+                self._sessions[token] = session
+                self._by_session_id[session.session_id] = token
+                self._evict(now)
+            else:
+                self._sessions.move_to_end(token)
+            session.last_seen = now
+        if cached and self.backend.shared:
+            self.sync(session)
+        return session
+
+    def sync(self, session):
+        """Перечитывает сессию, если её изменил другой воркер"""
+        if self.backend.version(session.token) != session.version:
+            with session.lock:
+                self._refresh(session)
+
+    def _refresh(self, session):
+        saved = self.backend.load(token=session.token)
+        if saved is not None:
+            session.apply(*saved)
+
+    def transact(self, session, step, key=None, operation=None):
+        """Атомарное изменение сессии с оптимистичной проверкой версии
+
+        step(session) -> (изменения полей, строка раунда или None, результат)
+        вычисляет изменения, не трогая сессию; при конфликте версий сессия
+        перечитывается из бэкенда и step вызывается заново. С ключом
+        идемпотентности повтор той же операции (operation - имя и параметры)
+        возвращает первый результат без изменений, а повтор ключа с другой
+        операцией - IdempotencyMismatch. С общим бэкендом квитанция пишется
+        вместе с изменениями, и повтор ключа на другом воркере её находит.
+        Возвращает (результат, применено ли изменение).
+        """
+        with session.lock:
+            receipt = None
+            if key is not None:
+                fingerprint = operation_fingerprint(operation)
+                result = self._receipt(session.token, key, fingerprint)
+                if result is not None:
+                    return result, False
+            for _ in range(SESSION_CAS_RETRIES):
+                changes, round_row, result = step(session)
+                if not changes:
+                    return result, False
+                if key is not None:
+                    receipt = (key, fingerprint, result)
+                version = self.backend.compare_and_set(session.token, session.version, changes, round_row, receipt)
+                if version is not None:
+                    break
+                self._refresh(session)
+                if receipt is not None and self.backend.shared:
+                    # Конфликт мог создать повтор того же ключа на другом воркере
+                    result = self._receipt(session.token, key, fingerprint)
+                    if result is not None:
+                        return result, False
+            else:
+                raise SessionConflict(f'session {session.session_id} is busy, retry later')
+            for name, value in changes.items():
+                setattr(session, name, value)
+            session.version = version
+            if round_row is not None:
+                session.history.append(*round_row[1:])
+            if self.journal is not None:
+                if round_row is not None:
+                    self.journal.record_round(session, *round_row)
+                else:
+                    self.journal.touch(session)
+            if key is not None:
+                self.idempotency.put((session.token, key), fingerprint, result)
+        return result, True
+
+    def forget(self, session, key):
+        """Забывает квитанцию операции, отменённой после проводки: повтор ключа проведёт её заново"""
+        self.idempotency.discard((session.token, key))
+        self.backend.discard_receipt(session.token, key)
+
+    def _receipt(self, token, key, fingerprint):
+        """Сохранённый результат операции с ключом: из памяти процесса, затем из общего бэкенда"""
+        result = self.idempotency.get((token, key), fingerprint)
+        if result is None and self.backend.shared:
+            saved = self.backend.receipt(token, key, self.idempotency.ttl)
+            if saved is not None:
+                if saved[0] != fingerprint:
+                    raise IdempotencyMismatch(f'idempotency key {key!r} was used for a different request')
+                result = saved[1]
+                self.idempotency.put((token, key), fingerprint, result)
+        return result
+
+    def find_by_session_id(self, session_id):
+        """Ищет сессию по sessionId, выданному в /api/game/enter"""
+        with self._lock:
+            token = self._by_session_id.get(session_id)
+        if token is None:
+            saved = self.backend.load(session_id=session_id)
+            if saved is None and self.journal is not None:
+                saved = self.journal.load(session_id=session_id)
+                saved = (0, *saved) if saved else None
+            token = saved[1]['token'] if saved else None
+        return self.get_or_create(token) if token else None
+
+    def _load(self, token, session_id):
+        """Сессия из бэкенда, журнала или новая; новая регистрируется в бэкенде"""
+        saved = self.backend.load(token=token)
+        if saved is not None:
+            return GameSession.restore(*saved)
+        saved = self.journal.load(token=token) if self.journal is not None else None
+        if saved is not None:
+            session = GameSession.restore(0, *saved)
+            rounds = saved[1]
+        else:
+            session = GameSession(token, session_id or f'session_{token}')
+            rounds = ()
+        if self.backend.insert(session.row(), rounds):
+            return session
+        # Сессию одновременно создал другой воркер - берём его версию
+        return GameSession.restore(*self.backend.load(token=token))
+
+    def _evict(self, now):
+        """Удаляет просроченные сессии и держит размер хранилища в пределах лимита"""
+        while self._sessions:
+            token, oldest = next(iter(self._sessions.items()))
+            expired = now - oldest.last_seen > self.idle_ttl
+            if not expired and len(self._sessions) <= self.max_sessions:
+                break
+            if token == DEFAULT_TOKEN:
+                # Сессия по умолчанию никогда не вытесняется
+                self._sessions.move_to_end(token)
+                if len(self._sessions) == 1:
+                    break
+                continue
+            del self._sessions[token]
+            self._by_session_id.pop(oldest.session_id, None)
+            self.backend.discard(token)
+
+
+sessions = SessionStore(journal=state_journal, backend=get_session_backend())
+stats_aggregator = StatsAggregator(sessions.backend)
+
+
+def session_keys():
+    """(token, sessionId) текущего запроса из query-строки, заголовков или JSON-тела"""
+    token = request.args.get('token') or request.headers.get('X-Session-Token')
+    session_id = request.args.get('sessionId') or request.headers.get('X-Session-Id')
+    if not token and not session_id and request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            token = body.get('token')
+            session_id = body.get('sessionId')
+    return token, session_id
+
+
+def current_session():
+    """Определяет сессию текущего запроса по token/sessionId"""
+    token, session_id = session_keys()
+    session = None
+    if token:
+        session = sessions.get_or_create(token)
+    elif session_id:
+        session = sessions.find_by_session_id(session_id)
+    if session is None:
+        session = sessions.get_or_create(DEFAULT_TOKEN)
+    g.session = session
+    return session
+
+
+@app.after_request
+def session_affinity_headers(response):
+    """Подсказки балансировщику для привязки сессии к воркеру"""
+    session = g.get('session')
+    if session is not None:
+        response.headers['X-Affinity-Key'] = affinity_key(session.token)
+        response.headers['X-Worker-Id'] = worker_id()
+    return response
+
+
+# ==================== ЗАПИСЬ ТРАФИКА ====================
+
+class TrafficCapture:
+    """Запись входящих HTTP запросов и WebSocket кадров для повторного прогона
+
+    Каждая запись - строка JSON с короткими ключами: t - время (секунды эпохи),
+    k - вид (http, ws_open, ws, ws_close), s - сессия (token или sessionId),
+    c - id WebSocket соединения, r - шаблон маршрута, st и d - статус и время
+    обработки на сервере. Файл только дописывается (O_APPEND), поэтому
+    несколько воркеров и последовательные запуски пишут в один файл.
+    Запросы не ждут диска: строки копятся в памяти, фоновый поток дописывает
+    их пачкой одним write раз в CAPTURE_FLUSH_INTERVAL. Прогон - replay.py.
+    """
+
+    def __init__(self, path, flush_interval=CAPTURE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.worker = worker_id()
+        self.records = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._connections = 0
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name='traffic-capture', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _append(self, record):
+        record['t'] = round(time.time(), 4)
+        try:
+            line = json_backend.dumps(record) + b'\n'
+        except TypeError:
+            return
+        with self._lock:
+            self._pending.append(line)
+
+    def http(self, response, duration):
+        """Запрос текущего контекста Flask с итогом обработки"""
+        path = request.path
+        if path.startswith(CAPTURE_SKIP_PREFIXES):
+            return
+        if request.query_string:
+            path = f'{path}?{request.query_string.decode("latin-1")}'
+        token, session_id = session_keys()
+        record = {
+            'k': 'http', 's': token or session_id, 'm': request.method, 'p': path,
+            'host': request.host, 'r': g.get('route'), 'st': response.status_code,
+            'd': round(duration, 6)
+        }
+        headers = {name: request.headers[name] for name in CAPTURE_HEADERS if name in request.headers}
+        if headers:
+            record['h'] = headers
+        body = request.get_data(cache=True)
+        if body:
+            try:
+                record['b'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                record['b64'] = base64.b64encode(body).decode('ascii')
+        self._append(record)
+
+    def ws_open(self, path, conn):
+        """Новое соединение; возвращает его id для последующих кадров"""
+        with self._lock:
+            self._connections += 1
+            connection = f'{self.worker}-{self._connections}'
+        self._append({'k': 'ws_open', 'c': connection, 's': conn.default_token, 'p': path or '/'})
+        return connection
+
+    def ws_frame(self, connection, conn, data, duration):
+        """Декодированный входящий кадр (сообщение или пачка)"""
+        token = data.get('token') if isinstance(data, dict) else None
+        self._append({'k': 'ws', 'c': connection, 's': token or conn.default_token,
+                      'm': data, 'd': round(duration, 6)})
+
+    def ws_close(self, connection):
+        self._append({'k': 'ws_close', 'c': connection})
+
+    def flush(self):
+        """Дописывает накопленные строки в файл одним write"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+        data = b''.join(pending)
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+        self.records += len(pending)
+        return len(pending)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                log_event(logging.ERROR, 'Ошибка записи трафика', error=str(e), path=self.path)
+
+    def close(self):
+        """Дописывает хвост записи при остановке процесса"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join(timeout=5)
+        self.flush()
+        os.close(self._fd)
+
+
+traffic_capture = TrafficCapture(CAPTURE_FILE) if CAPTURE_FILE else None
+
+
+@app.after_request
+def capture_request(response):
+    """Запись запроса в файл трафика, если запись включена"""
+    if traffic_capture is not None:
+        started = g.get('request_started')
+        traffic_capture.http(response, time.perf_counter() - started if started is not None else 0.0)
+    return response
+
+
+# ==================== PUSH-ОБНОВЛЕНИЯ ====================
+
+SUBSCRIBER_QUEUE_LIMIT = 256
+
+
+class Subscriber:
+    """Очередь push-событий одного WebSocket соединения
+
+    События публикуются из любых потоков, а отправляются корутиной на
+    event loop соединения. Обновления баланса и тики crash-раунда
+    схлопываются до последнего значения; события раундов копятся в ограниченной очереди, и если клиент
+    не успевает читать, старые события отбрасываются с отметкой dropped.
+    Пока предыдущая пачка отправляется, новые события ждут в очереди и
+    уходят следующим кадром одной пачкой - {"type": "events", "events": [...]},
+    чтобы клиент не путал её с массивом ответов на пачку запросов.
+    """
+
+    __slots__ = ('loop', 'wakeup', 'lock', 'events', 'balance', 'tick', 'dropped', 'scheduled')
+
+    def __init__(self, loop, limit=SUBSCRIBER_QUEUE_LIMIT):
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=limit)
+        self.balance = None
+        self.tick = None
+        self.dropped = 0
+        self.scheduled = False
+
+    def push(self, event):
+        """Добавляет событие; будит отправителя не чаще одного раза на пачку"""
+        with self.lock:
+            if event.__class__ is BalanceEvent:
+                self.balance = event
+            elif event.__class__ is CrashTick:
+                self.tick = event
+            else:
+                if len(self.events) == self.events.maxlen:
+                    self.dropped += 1
+                self.events.append(event)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def drain(self):
+        """Забирает накопленные события одной пачкой"""
+        with self.lock:
+            batch = list(self.events)
+            self.events.clear()
+            if self.balance is not None:
+                batch.append(self.balance)
+                self.balance = None
+            if self.tick is not None:
+                batch.append(self.tick)
+                self.tick = None
+            if self.dropped:
+                batch.append({'type': 'dropped', 'count': self.dropped})
+                self.dropped = 0
+            self.scheduled = False
+        return batch
+
+    async def pump(self, send):
+        """Отправляет события по мере появления, пока соединение открыто"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch = self.drain()
+            if batch:
+                await send(batch[0] if len(batch) == 1 else {'type': 'events', 'events': batch})
+
+
+class SessionBroker:
+    """Рассылка событий сессии всем подписанным WebSocket соединениям"""
+
+    def __init__(self):
+        self._subscribers = {}  # token -> frozenset(Subscriber)
+        self._lock = threading.Lock()
+
+    def subscribe(self, token, subscriber):
+        with self._lock:
+            self._subscribers[token] = self._subscribers.get(token, frozenset()) | {subscriber}
+
+    def unsubscribe(self, token, subscriber):
+        with self._lock:
+            remaining = self._subscribers.get(token, frozenset()) - {subscriber}
+            if remaining:
+                self._subscribers[token] = remaining
+            else:
+                self._subscribers.pop(token, None)
+
+    def subscriber_count(self, token=None):
+        if token is not None:
+            return len(self._subscribers.get(token, ()))
+        return sum(len(subs) for subs in self._subscribers.values())
+
+    def publish(self, token, event):
+        """Публикует событие; без подписчиков стоит одно обращение к словарю"""
+        subscribers = self._subscribers.get(token)
+        if subscribers:
+            for subscriber in subscribers:
+                subscriber.push(event)
+
+
+broker = SessionBroker()
 
-app = Flask(__name__)
-CORS(app)  # Включаем CORS для всех запросов
 
-# Настройки для Vercel
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+def publish_balance(session, now):
+    """Публикует текущий баланс сессии"""
+    broker.publish(session.token, BalanceEvent(session.balance, session.currency, now))
 
-# Глобальные переменные для состояния игры
-game_state = {
-    'balance': 1000000.0,
-    'currency': 'EUR',
-    'session_id': 'offline_session_12345',
-    'token': 'offline_mock_token_12345',
-    'game_history': [],
-    'statistics': {
-        'total_spins': 0,
-        'total_wins': 0,
-        'total_losses': 0,
-        'biggest_win': 0.0,
-        'total_wagered': 0.0,
-        'total_won': 0.0
-    }
-}
 
-def generate_game_result():
-    """Генерирует результат игрового спина"""
-    # 70% шанс выигрыша, 30% проигрыша
-    is_win = random.random() < 0.7
-    
-    if is_win:
-        # Случайный множитель от 1.0 до 50.0
-        multiplier = round(random.uniform(1.0, 50.0), 2)
-        win_amount = round(multiplier * 1.0, 2)  # Ставка 1.0
+def spin_params():
+    """Ставка и цель автокешаута из запроса спина"""
+    params = request.args.to_dict()
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            params.update(body)
+    bet = validate_bet(params.get('bet', params.get('stake', DEFAULT_BET)))
+    target = params.get('autoCashout', params.get('target'))
+    if target is not None:
+        try:
+            target = float(target)
+        except (TypeError, ValueError):
+            raise OutcomeError('autoCashout must be a number')
+    return bet, target
+
+
+def idempotency_key():
+    """Ключ идемпотентности запроса: заголовок Idempotency-Key или idempotencyKey в теле"""
+    key = request.headers.get('Idempotency-Key')
+    if not key and request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            key = body.get('idempotencyKey')
+    return str(key) if key else None
+
+
+class LedgerError(OutcomeError):
+    """Операция не проходит по балансу сессии"""
+
+
+def generate_game_result(session, bet=DEFAULT_BET, target=None, key=None):
+    """Генерирует результат игрового спина из потока случайных чисел сессии
+
+    В одной транзакции сессии зачисляется невыведенный выигрыш предыдущего
+    раунда, списывается ставка, а выигрыш нового раунда становится
+    ожидающим выплаты (pending_win) до вывода или следующего спина.
+    """
+    def step(session):
+        round_no = session.total_spins + 1
+        available = session.balance + session.pending_win
+        if bet > available:
+            raise LedgerError('insufficient balance')
+        game_result = play_round(get_outcome_model(session.model), session.seed, round_no, bet, target)
+        game_result['timestamp'] = int(time.time())
+        win_amount = game_result['win']
+        game_result['balance'] = round(available - bet, 2)
+        game_result['pendingWin'] = win_amount
         
-        # Обновляем статистику
-        game_state['statistics']['total_wins'] += 1
-        game_state['statistics']['biggest_win'] = max(game_state['statistics']['biggest_win'], win_amount)
-        game_state['statistics']['total_won'] += win_amount
+        # Проводки раунда и статистика
+        changes = {
+            'balance': game_result['balance'],
+            'pending_win': win_amount,
+            'active_round': round_no,
+            'total_spins': round_no,
+            'total_wagered': session.total_wagered + bet
+        }
+        if win_amount > 0:
+            changes['total_wins'] = session.total_wins + 1
+            changes['biggest_win'] = max(session.biggest_win, win_amount)
+            changes['total_won'] = session.total_won + win_amount
+        else:
+            changes['total_losses'] = session.total_losses + 1
         
-        result_type = 'big_win' if multiplier > 10 else 'win'
-    else:
-        multiplier = 0.0
-        win_amount = 0.0
-        result_type = 'lose'
-        game_state['statistics']['total_losses'] += 1
+        # Строка истории
+        round_row = (
+            round_no, game_result['timestamp'], bet, win_amount,
+            game_result['multiplier'], game_result['result']
+        )
+        return changes, round_row, game_result
     
-    # Обновляем общую статистику
-    game_state['statistics']['total_spins'] += 1
-    game_state['statistics']['total_wagered'] += 1.0  # Ставка 1.0
+    game_result, applied = sessions.transact(session, step, key, ('spin', bet, target))
+    if applied:
+        metrics.spins.inc()
+        stats_aggregator.record(session, bet, game_result['win'], game_result['multiplier'])
+        broker.publish(session.token, RoundEvent(
+            game_result['id'], game_result['round'], bet, game_result['win'],
+            game_result['multiplier'], game_result['result'], game_result['timestamp']
+        ))
+        publish_balance(session, game_result['timestamp'])
+    return game_result
+
+
+def settle_cashout(session, key=None):
+    """Вывод выигрыша активного раунда на баланс с push-уведомлением подписчиков
+
+    Без активного раунда или после проигрышного спина выводить нечего -
+    возвращается нулевая сумма без проводки, журнала и события.
+    """
+    now = int(time.time())
+    def step(session):
+        if not session.active_round or not session.pending_win:
+            return {}, None, {'round': None, 'amount': 0.0, 'balance': session.balance}
+        balance = round(session.balance + session.pending_win, 2)
+        changes = {'balance': balance, 'pending_win': 0.0, 'active_round': 0}
+        return changes, None, {'round': session.active_round, 'amount': session.pending_win, 'balance': balance}
     
-    # Добавляем в историю
-    game_result = {
-        'id': f'game_{len(game_state["game_history"]) + 1}',
-        'timestamp': int(time.time()),
-        'bet': 1.0,
-        'win': win_amount,
-        'multiplier': multiplier,
-        'result': result_type
+    result, applied = sessions.transact(session, step, key, ('cashout',))
+    if applied:
+        metrics.cashouts.inc()
+        if state_journal is not None:
+            with session.lock:
+                state_journal.record_cashout(session, now, result['amount'])
+        broker.publish(session.token, {
+            'type': 'cashout',
+            'round': result['round'],
+            'amount': result['amount'],
+            'balance': result['balance'],
+            'timestamp': now
+        })
+        publish_balance(session, now)
+    return result
+
+# ==================== CRASH-РАУНДЫ ====================
+
+CRASH_CHANNEL = '#crash'  # канал брокера для событий общих раундов
+
+
+class CrashError(OutcomeError):
+    """Ставка или вывод не подходят к фазе текущего crash-раунда"""
+
+
+class TimerWheel:
+    """Хэшированное колесо таймеров с шагом в один тик
+
+    Таймер кладётся в ячейку (тик срабатывания % число ячеек) за O(1);
+    сдвиг колеса на тик разбирает только одну ячейку. Таймеры дальше
+    одного оборота колеса остаются в ячейке до своего тика.
+    """
+
+    def __init__(self, tick=CRASH_TICK, slots=CRASH_TIMER_SLOTS):
+        self.tick = tick
+        self.current = 0
+        self._slots = [[] for _ in range(slots)]
+
+    def schedule(self, delay, callback):
+        """Вызов callback() не раньше чем через delay секунд; возвращает тик срабатывания"""
+        due = self.current + max(1, math.ceil(delay / self.tick - 1e-9))
+        self._slots[due % len(self._slots)].append((due, callback))
+        return due
+
+    def advance(self):
+        """Сдвигает колесо на один тик и возвращает сработавшие callback"""
+        self.current += 1
+        slot = self._slots[self.current % len(self._slots)]
+        if not slot:
+            return []
+        due = [callback for tick, callback in slot if tick <= self.current]
+        if due:
+            slot[:] = [timer for timer in slot if timer[0] > self.current]
+        return due
+
+
+def crash_multiplier(elapsed, growth=CRASH_GROWTH):
+    """Множитель кривой через elapsed секунд после старта, вниз до сотых"""
+    return math.floor(math.exp(growth * elapsed) * 100) / 100
+
+
+class CrashBet:
+    """Ставка сессии в общем раунде"""
+
+    __slots__ = ('session', 'amount', 'target', 'key', 'settled', 'receipt')
+
+    def __init__(self, session, amount, target, key):
+        self.session = session
+        self.amount = amount
+        self.target = target  # None - только ручной вывод
+        self.key = key
+        self.settled = False
+        self.receipt = None
+
+
+class CrashRound:
+    """Общий раунд: точка краша известна заранее, ставки индексируются по цели
+
+    После закрытия приёма ставок цели автокешаута сортируются один раз;
+    каждый тик находит новые достигнутые цели бинарным поиском и
+    выплачивает только их - O(log n + k) вместо обхода всех игроков.
+    """
+
+    __slots__ = ('round_id', 'crash_point', 'crash_time', 'growth', 'phase', 'closes', 'started',
+                 'bets', 'placing', 'targets', 'ordered', 'reached')
+
+    def __init__(self, round_id, crash_point, growth, closes):
+        self.round_id = round_id
+        self.crash_point = crash_point
+        self.crash_time = math.log(crash_point) / growth
+        self.growth = growth
+        self.phase = 'betting'
+        self.closes = closes
+        self.started = None
+        self.bets = {}      # token -> CrashBet
+        self.placing = set()  # токены, чья ставка сейчас списывается
+        self.targets = []   # отсортированные цели автокешаута
+        self.ordered = []   # ставки в порядке targets
+        self.reached = 0    # сколько целей из targets уже выплачено
+
+    def launch(self, now):
+        """Закрывает приём ставок и строит индекс целей"""
+        self.phase = 'running'
+        self.started = now
+        auto = sorted(
+            (bet for bet in self.bets.values() if bet.target is not None and not bet.settled),
+            key=lambda bet: bet.target
+        )
+        self.ordered = auto
+        self.targets = [bet.target for bet in auto]
+
+    def due(self, multiplier):
+        """Ставки, чья цель достигнута к множителю multiplier"""
+        upto = bisect_right(self.targets, multiplier)
+        due = [bet for bet in self.ordered[self.reached:upto] if not bet.settled]
+        self.reached = max(self.reached, upto)
+        return due
+
+    def describe(self, now):
+        state = {
+            'round': self.round_id,
+            'phase': self.phase,
+            'bets': len(self.bets)
+        }
+        if self.phase == 'betting':
+            state['bettingEndsIn'] = max(0.0, round(self.closes - now, 3))
+        elif self.phase == 'running':
+            state['multiplier'] = min(crash_multiplier(now - self.started, self.growth), self.crash_point)
+        else:
+            state['crashPoint'] = self.crash_point
+        return state
+
+
+class CrashEngine:
+    """Планировщик общих crash-раундов для всех сессий
+
+    Один поток двигает колесо таймеров: приём ставок -> полёт -> краш ->
+    пауза -> следующий раунд. Точка краша берётся из crash-модели исходов
+    по (seed движка, номер раунда) ещё до приёма ставок. Во время полёта
+    каждый тик рассылает множитель в канал CRASH_CHANNEL и выплачивает
+    достигнутые автокешауты; ставки проводятся через транзакции сессий,
+    как и обычные спины. Поток запускается при первом обращении.
+    """
+
+    def __init__(self, seed=None, growth=CRASH_GROWTH, tick=CRASH_TICK,
+                 betting_time=CRASH_BETTING_TIME, pause=CRASH_PAUSE):
+        self.seed = session_seed(CRASH_CHANNEL) if seed is None else seed
+        self.growth = growth
+        self.betting_time = betting_time
+        self.pause = pause
+        self.wheel = TimerWheel(tick)
+        self.model = get_outcome_model('crash')
+        self.round = None
+        self.recent = deque(maxlen=CRASH_RECENT_ROUNDS)  # точки краша прошлых раундов
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._clock = None  # время нулевого тика колеса
+        self._thread = None
+        self._stop = threading.Event()
+
+    # --- жизненный цикл ---
+
+    def start(self):
+        """Открывает первый раунд и запускает поток (повторный вызов ничего не делает)"""
+        if self._thread is not None:
+            return False
+        with self._start_lock:
+            if self._thread is not None:
+                return False
+            self.advance(time.monotonic())
+            self._stop.clear()
+            thread = threading.Thread(target=self._run, name='crash-engine', daemon=True)
+            thread.start()
+            self._thread = thread
+        return True
+
+    def stop(self):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while not self._stop.wait(max(0.0, self._clock + (self.wheel.current + 1) * self.wheel.tick
+                                     - time.monotonic())):
+            try:
+                self.advance(time.monotonic())
+            except Exception:
+                log.exception('Ошибка в планировщике crash-раундов')
+
+    def advance(self, now):
+        """Проводит все тики колеса до момента now (монотонные секунды)"""
+        if self._clock is None:
+            self._clock = now
+            self._open_round(now)
+        ticks = int((now - self._clock) / self.wheel.tick) - self.wheel.current
+        for _ in range(ticks):
+            for callback in self.wheel.advance():
+                callback()
+        if ticks > 0:
+            self._tick(self._clock + self.wheel.current * self.wheel.tick)
+
+    # --- фазы раунда ---
+
+    def _open_round(self, now):
+        round_id = (self.round.round_id if self.round is not None else 0) + 1
+        crash_point = self.model.crash_point(round_uniforms(self.seed, round_id)[0])
+        with self._lock:
+            self.round = CrashRound(round_id, crash_point, self.growth, now + self.betting_time)
+        self.wheel.schedule(self.betting_time, self._launch)
+        self._broadcast({'type': 'crash_round', 'round': round_id, 'phase': 'betting',
+                         'bettingTime': self.betting_time, 'timestamp': int(time.time())})
+
+    def _launch(self):
+        current = self.round
+        now = self._clock + self.wheel.current * self.wheel.tick
+        with self._lock:
+            current.launch(now)
+        self.wheel.schedule(current.crash_time, self._crash)
+        self._broadcast({'type': 'crash_round', 'round': current.round_id, 'phase': 'running',
+                         'bets': len(current.bets), 'timestamp': int(time.time())})
+
+    def _tick(self, now):
+        current = self.round
+        if current.phase != 'running':
+            return
+        multiplier = min(crash_multiplier(now - current.started, self.growth), current.crash_point)
+        with self._lock:
+            due = current.due(multiplier)
+            for bet in due:
+                bet.settled = True
+        self._settle_all(current, ((bet, bet.target) for bet in due))
+        self._broadcast(CrashTick(current.round_id, multiplier, round(now - current.started, 3)))
+
+    def _crash(self):
+        current = self.round
+        with self._lock:
+            # Цели между последним тиком и точкой краша ещё успевают сыграть
+            winners = current.due(current.crash_point)
+            for bet in winners:
+                bet.settled = True
+            losers = [bet for bet in current.bets.values() if not bet.settled]
+            for bet in losers:
+                bet.settled = True
+            current.phase = 'crashed'
+            self.recent.appendleft(current.crash_point)
+        try:
+            self._settle_all(current, ((bet, bet.target) for bet in winners))
+            self._settle_all(current, ((bet, 0.0) for bet in losers))
+            self._broadcast({'type': 'crash_round', 'round': current.round_id, 'phase': 'crashed',
+                             'crashPoint': current.crash_point, 'bets': len(current.bets),
+                             'losers': len(losers), 'timestamp': int(time.time())})
+        finally:
+            # Следующий раунд планируется при любой ошибке проводок, иначе движок встанет
+            self.wheel.schedule(self.pause, lambda: self._open_round(
+                self._clock + self.wheel.current * self.wheel.tick
+            ))
+
+    # --- ставки ---
+
+    def place_bet(self, session, bet, target=None, key=None):
+        """Ставка в приём текущего раунда; сумма списывается сразу
+
+        Ставка попадает в раунд только после списания. Если приём закрылся,
+        пока шло списание, сумма возвращается на баланс.
+        """
+        if target is not None and not 1.0 < target <= self.model.max_multiplier:
+            raise CrashError(f'autoCashout must be between 1.0 and {self.model.max_multiplier}')
+        self.start()
+        with self._lock:
+            current = self.round
+            if current is None or current.phase != 'betting':
+                raise CrashError('betting is closed for the current round')
+            placed = current.bets.get(session.token)
+            if placed is not None:
+                if key is not None and placed.key == key:
+                    if (placed.amount, placed.target) != (bet, target):
+                        raise IdempotencyMismatch(f'idempotency key {key!r} was used for a different request')
+                    return placed.receipt
+                raise CrashError('bet already placed in this round')
+            if session.token in current.placing:
+                raise CrashError('bet already placed in this round')
+            current.placing.add(session.token)
+        
+        def step(session):
+            available = session.balance + session.pending_win
+            if bet > available:
+                raise LedgerError('insufficient balance')
+            balance = round(available - bet, 2)
+            changes = {
+                'balance': balance,
+                'pending_win': 0.0,
+                'active_round': 0,
+                'total_wagered': session.total_wagered + bet
+            }
+            return changes, None, {
+                'round': current.round_id, 'bet': bet, 'autoCashout': target, 'balance': balance
+            }
+        
+        try:
+            receipt, applied = sessions.transact(session, step, key, ('crash_bet', bet, target))
+            if not applied:
+                # Повтор ключа уже проведённой ставки: квитанция без новой ставки
+                return receipt
+            with self._lock:
+                accepted = self.round is current and current.phase == 'betting'
+                if accepted:
+                    placed = current.bets[session.token] = CrashBet(session, bet, target, key)
+                    placed.receipt = receipt
+        finally:
+            with self._lock:
+                current.placing.discard(session.token)
+        if not accepted:
+            self._refund(session, bet)
+            if key is not None:
+                # Иначе повтор ключа получил бы квитанцию ставки, которой нет в раунде
+                sessions.forget(session, key)
+            raise CrashError('betting is closed for the current round')
+        publish_balance(session, int(time.time()))
+        return receipt
+
+    def _refund(self, session, bet):
+        """Возврат списанной ставки, не попавшей в раунд"""
+        def step(session):
+            changes = {
+                'balance': round(session.balance + bet, 2),
+                'total_wagered': session.total_wagered - bet
+            }
+            return changes, None, None
+        
+        sessions.transact(session, step)
+        publish_balance(session, int(time.time()))
+
+    def cashout(self, session):
+        """Ручной вывод по текущему множителю кривой
+
+        Граница та же, что у автовывода: множитель, равный точке краша,
+        ещё выплачивается, выше неё - раунд уже разбился.
+        """
+        with self._lock:
+            current = self.round
+            placed = current.bets.get(session.token) if current is not None else None
+            if placed is None or placed.settled:
+                raise CrashError('no active bet in the current round')
+            if current.phase != 'running':
+                raise CrashError('round is not running')
+            multiplier = crash_multiplier(time.monotonic() - current.started, self.growth)
+            if multiplier > current.crash_point:
+                raise CrashError('round has crashed')
+            placed.settled = True
+        return self._settle(current, placed, multiplier)
+
+    def _settle(self, current, placed, multiplier):
+        """Проводка исхода ставки: выигрыш на баланс и строка истории"""
+        now = int(time.time())
+        win = round(placed.amount * multiplier, 2)
+        
+        def step(session):
+            round_no = session.total_spins + 1
+            changes = {'balance': round(session.balance + win, 2), 'total_spins': round_no}
+            if win > 0:
+                changes['total_wins'] = session.total_wins + 1
+                changes['biggest_win'] = max(session.biggest_win, win)
+                changes['total_won'] = session.total_won + win
+            else:
+                changes['total_losses'] = session.total_losses + 1
+            round_row = (round_no, now, placed.amount, win, multiplier, result_type(multiplier))
+            return changes, round_row, {
+                'round': current.round_id, 'multiplier': multiplier, 'win': win,
+                'balance': changes['balance']
+            }
+        
+        session = placed.session
+        result, _ = sessions.transact(session, step)
+        metrics.spins.inc()
+        stats_aggregator.record(session, placed.amount, win, multiplier)
+        broker.publish(session.token, {
+            'type': 'crash_cashout' if win > 0 else 'crash_lost',
+            **result,
+            'timestamp': now
+        })
+        publish_balance(session, now)
+        return result
+
+    def _settle_all(self, current, outcomes):
+        """Проводки из потока раундов: ошибка одной ставки не останавливает остальные"""
+        for placed, multiplier in outcomes:
+            try:
+                self._settle(current, placed, multiplier)
+            except Exception:
+                log.exception('Не удалось провести ставку crash-раунда')
+
+    # --- состояние ---
+
+    def _broadcast(self, event):
+        broker.publish(CRASH_CHANNEL, event)
+
+    def state(self):
+        """Текущий раунд и точки краша последних раундов"""
+        self.start()
+        with self._lock:
+            current = self.round
+            state = current.describe(time.monotonic()) if current is not None else {}
+            state['recent'] = list(self.recent)
+        return state
+
+
+crash_engine = CrashEngine()
+
+# ==================== СИМУЛЯЦИЯ RTP ====================
+
+class SimulationError(ValueError):
+    """Некорректные параметры симуляции"""
+
+
+def _check_simulation(spins, seed, bet):
+    """Проверяет параметры симуляции и возвращает seed (случайный, если не задан)"""
+    if np is None:
+        raise SimulationError('numpy is required for bulk simulation')
+    if not 0 < spins <= SIMULATE_MAX_SPINS:
+        raise SimulationError(f'spins must be between 1 and {SIMULATE_MAX_SPINS}')
+    if not math.isfinite(bet) or bet <= 0:
+        raise SimulationError('bet must be a positive number')
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % (1 << 63))
+    return seed
+
+
+def iter_simulated_rounds(spins, seed, bet=1.0, model=None, target=None, chunk=SIMULATE_CHUNK):
+    """Генератор пачек спинов (номер первого раунда, множители, выигрыши)"""
+    model = model or get_outcome_model()
+    rng = np.random.default_rng(seed)
+    start = 0
+    while start < spins:
+        size = min(chunk, spins - start)
+        multipliers = model.multipliers(rng, size, target)
+        yield start, multipliers, np.round(multipliers * bet, 2)
+        start += size
+
+
+def simulate_spins(spins=SIMULATE_DEFAULT_SPINS, seed=None, bet=1.0, bins=49, model=None, target=None):
+    """Массовая симуляция спинов с агрегированной статистикой RTP
+
+    Один и тот же seed всегда даёт одинаковый результат. Память ограничена
+    размером пачки SIMULATE_CHUNK независимо от числа спинов.
+    """
+    seed = _check_simulation(spins, seed, bet)
+    model = model or get_outcome_model()
+
+    started = time.perf_counter()
+    edges = np.linspace(*model.histogram_range(target), bins + 1)
+    histogram = np.zeros(bins, dtype=np.int64)
+    wins_count = 0
+    big_wins = 0
+    total_won = 0.0
+    biggest_win = 0.0
+    biggest_round = None
+
+    for start, multipliers, wins in iter_simulated_rounds(spins, seed, bet, model, target):
+        won = multipliers > 0
+        wins_count += int(np.count_nonzero(won))
+        big_wins += int(np.count_nonzero(multipliers > BIG_WIN_MULTIPLIER))
+        total_won += float(wins.sum())
+        histogram += np.histogram(multipliers[won], bins=edges)[0]
+        best = int(wins.argmax())
+        if wins[best] > biggest_win:
+            biggest_win = float(wins[best])
+            biggest_round = start + best + 1
+
+    elapsed = time.perf_counter() - started
+    total_wagered = spins * bet
+    return {
+        'seed': seed,
+        'model': model.describe(),
+        'spins': spins,
+        'bet': bet,
+        'wins': wins_count,
+        'losses': spins - wins_count,
+        'big_wins': big_wins,
+        'hit_rate': round(wins_count / spins * 100, 4),
+        'total_wagered': round(total_wagered, 2),
+        'total_won': round(total_won, 2),
+        'rtp': round(total_won / total_wagered * 100, 4),
+        'average_win': round(total_won / max(wins_count, 1), 4),
+        'biggest_win': {
+            'amount': biggest_win,
+            'multiplier': round(biggest_win / bet, 2),
+            'round': biggest_round
+        },
+        'histogram': {
+            'edges': [round(float(e), 4) for e in edges],
+            'counts': histogram.tolist()
+        },
+        'elapsed': round(elapsed, 6),
+        'spins_per_second': int(spins / elapsed) if elapsed > 0 else None
     }
-    game_state['game_history'].insert(0, game_result)  # Добавляем в начало
+
+
+def stream_simulated_rounds(spins, seed, bet=1.0, model=None, target=None):
+    """Построчный вывод сырых раундов симуляции (NDJSON)"""
+    for start, multipliers, wins in iter_simulated_rounds(spins, seed, bet, model, target):
+        lines = []
+        for offset, (multiplier, win) in enumerate(zip(multipliers.tolist(), wins.tolist()), start + 1):
+            lines.append(
+                f'{{"round":{offset},"bet":{bet},"win":{win},"multiplier":{multiplier},'
+                f'"result":"{result_type(multiplier)}"}}\n'
+            )
+        yield ''.join(lines)
+
+# ==================== ШАБЛОНЫ ОТВЕТОВ ====================
+
+_SLOT_NONCE = secrets.token_hex(8)
+
+
+class ResponseTemplate:
+    """JSON-ответ, сериализованный один раз, с подстановкой динамических полей
+
+    В словаре-образце динамические значения обозначаются как slot('name'):
+    целым значением ('balance': slot('balance')) или фрагментом строки
+    (f'...?token={slot("token")}'). Статическая часть хранится готовыми
+    байтами, при ответе кодируются только подставляемые значения.
+    Метка слота содержит случайный ключ процесса, поэтому строка из
+    пользовательских данных (настройки) не может выдать себя за слот.
+    """
+
+    _SLOT = re.compile(
+        rf'"\{{\{{{_SLOT_NONCE}:(\w+)\}}\}}"|\{{\{{{_SLOT_NONCE}:(\w+)\}}\}}'
+    )
+
+    def __init__(self, body):
+        text = json.dumps(body, sort_keys=True, separators=(',', ':'))
+        self.parts = []  # статические байты и (имя, целое значение?)
+        pos = 0
+        for match in self._SLOT.finditer(text):
+            self.parts.append(text[pos:match.start()].encode())
+            if match.group(1):
+                self.parts.append((match.group(1), True))
+            else:
+                self.parts.append((match.group(2), False))
+            pos = match.end()
+        self.parts.append(text[pos:].encode() + b'\n')
+
+    def render(self, values):
+        out = []
+        for part in self.parts:
+            if part.__class__ is bytes:
+                out.append(part)
+            else:
+                name, whole = part
+                out.append(_encode_slot(values[name], whole))
+        return b''.join(out)
+
+
+def slot(name):
+    """Место подстановки динамического поля в ResponseTemplate"""
+    return f'{{{{{_SLOT_NONCE}:{name}}}}}'
+
+
+def _encode_slot(value, whole):
+    """JSON-кодирование подставляемого значения"""
+    kind = value.__class__
+    if kind is int or kind is float:
+        return repr(value).encode()
+    encoded = json_backend.dumps(value)
+    return encoded if whole else encoded[1:-1]
+
+
+class ResponseTemplates:
+    """Кэш шаблонов по имени; сбрасывается при изменении конфигурации"""
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._templates = {}
+
+    def render(self, name, builder, **values):
+        template = self._templates.get(name)
+        if template is None:
+            # Сборка под блокировкой: invalidate() после изменения настроек не
+            # может проскочить между чтением старых значений и записью шаблона
+            with self._lock:
+                template = self._templates.get(name)
+                if template is None:
+                    template = self._templates[name] = ResponseTemplate(builder())
+        values['timestamp'] = int(time.time())
+        return Response(template.render(values), mimetype='application/json')
+
+
+response_templates = ResponseTemplates()
+
+# Настройки игры, которые отдаёт и принимает /api/game/settings
+GAME_SETTINGS_LOCK = threading.Lock()
+GAME_SETTINGS = {
+    'soundEnabled': True,
+    'musicEnabled': True,
+    'autoplayEnabled': True,
+    'turboMode': False,
+    'language': 'en',
+    'currency': 'EUR'
+}
+
+# ==================== МАРШРУТИЗАЦИЯ ====================
+
+# Пути, общие для основного API и зеркал (путь -> имя обработчика)
+GAME_API_ROUTES = {
+    '/api/token': 'api_token',
+    '/token': 'api_token',
+    '/api/game/balance': 'game_balance',
+    '/api/game/spin': 'game_spin',
+    '/api/game/enter': 'game_enter',
+    '/api/game/cashout': 'game_cashout',
+    '/api/game/leave': 'game_leave',
+    '/api/game/history': 'game_history',
+    '/api/game/replay': 'game_replay',
+    '/api/game/settings': 'game_settings',
+    '/api/game/statistics': 'game_statistics',
+    '/api/game/statistics/global': 'game_statistics_global',
+    '/api/game/simulate': 'game_simulate',
+    '/api/crash/round': 'crash_round',
+    '/api/crash/bet': 'crash_bet',
+    '/api/crash/cashout': 'crash_cashout',
+}
+
+# Виртуальные хосты: игра обращается к ним как к /<хост>/<путь> или с заголовком Host.
+# Новый вышестоящий хост - новая запись (или алиас в MOCK_HOST_ALIASES)
+VIRTUAL_HOSTS = {
+    '': {
+        '/': 'serve_game',
+        **GAME_API_ROUTES,
+        '/frontendService/gameVoteData': 'frontend_service_game_vote_data',
+        '/frontendService/vote/game': 'frontend_service_vote_game',
+    },
+    'staging.playzia.com': {
+        '/api/token': 'staging_api_token',
+        '/api/game/balance': 'game_balance',
+        '/games/playzia-bananabonanza/offline_user': 'staging_playzia_games_offline_user',
+        '/games/playzia-bananabonanza/index.html': 'websocket_redirect',
+    },
+    'gs2.playzia.com': {
+        '/token': 'gs2_playzia_token',
+        '/api/token': 'gs2_playzia_token',
+        '/api/game/balance': 'game_balance',
+        '/api/game/spin': 'game_spin',
+    },
+    'api.playzia.staging.hizi-service.com': {
+        '/gameapi/v2/connect': 'playzia_api_v2_connect',
+        '/gameapi/v2/reconnect': 'playzia_api_v2_reconnect',
+        '/gameapi/v2/disconnect': 'playzia_api_v2_disconnect',
+        '/gameapi/bananabonanza/interface': 'playzia_api_bananabonanza_interface',
+    },
+}
+
+# Алиасы хостов: "gs3.playzia.com=gs2.playzia.com,..." - зеркало существующего хоста
+HOST_ALIASES = os.getenv('MOCK_HOST_ALIASES', '')
+
+
+@dataclass(frozen=True, slots=True)
+class Route:
+    """Скомпилированный маршрут: шаблон для метрик, обработчик и методы"""
+    pattern: str
+    handler: object
+    methods: frozenset
+    limited: bool = False
+    coalesce: bool = False
+
+
+class RouteTable:
+    """Декларативная таблица (виртуальный хост, путь) -> обработчик
+
+    Обработчики регистрируются по имени через endpoint(), а хосты ссылаются
+    на них в VIRTUAL_HOSTS. compile() раскладывает таблицу в словарь
+    "полный путь -> Route", поэтому поиск маршрута - один-два обращения
+    к словарю независимо от числа зеркальных хостов.
+    """
     
-    # Ограничиваем историю 50 записями
-    if len(game_state['game_history']) > 50:
-        game_state['game_history'] = game_state['game_history'][:50]
+    def __init__(self):
+        self.endpoints = {}
+        self.hosts = frozenset()
+        self._routes = {}
     
-    return game_result
+    def endpoint(self, *methods, limited=False, coalesce=False):
+        """Декоратор: регистрирует обработчик под именем функции
+
+        limited - горячий маршрут под лимитом сессии и ограничением
+        одновременных запросов; coalesce - одинаковые одновременные
+        GET-запросы сессии получают один общий ответ.
+        """
+        def register(handler):
+            allowed = frozenset(methods)
+            if 'GET' in allowed:
+                allowed |= {'HEAD'}
+            self.endpoints[handler.__name__] = (handler, allowed, limited, coalesce)
+            return handler
+        return register
+    
+    def compile(self, virtual_hosts, aliases=''):
+        virtual_hosts = dict(virtual_hosts)
+        for alias in filter(None, (item.strip() for item in aliases.split(','))):
+            name, _, target = alias.partition('=')
+            if target.strip() not in virtual_hosts:
+                raise ValueError(f'Unknown virtual host in alias: {alias}')
+            virtual_hosts[name.strip()] = virtual_hosts[target.strip()]
+        routes = {}
+        for host, paths in virtual_hosts.items():
+            prefix = f'/{host}' if host else ''
+            for path, name in paths.items():
+                if name not in self.endpoints:
+                    raise ValueError(f'Unknown endpoint {name!r} for {host or "default host"}{path}')
+                handler, methods, limited, coalesce = self.endpoints[name]
+                pattern = prefix + path if path != '/' or not prefix else prefix
+                routes[pattern] = Route(pattern, handler, methods, limited, coalesce)
+        self._routes = routes
+        self.hosts = frozenset(host for host in virtual_hosts if host)
+    
+    def match(self, path, host=None):
+        """Маршрут по пути; заголовок Host выбирает зеркало для путей без префикса"""
+        if host in self.hosts:
+            route = self._routes.get(f'/{host}{path}' if path != '/' else f'/{host}')
+            if route is not None:
+                return route
+        return self._routes.get(path)
+
+
+routes = RouteTable()
+READ_METHODS = frozenset(('GET', 'HEAD'))
+
+# ==================== ЗАЩИТА ОТ ПЕРЕГРУЗКИ ====================
+
+class RateLimiter:
+    """Token bucket на сессию: rate запросов в секунду со всплеском до burst
+
+    Корзины хранятся в LRU с тем же пределом, что и сессии, поэтому
+    поток новых токенов не раздувает память.
+    """
+
+    def __init__(self, rate=RATE_LIMIT_RPS, burst=RATE_LIMIT_BURST, max_keys=MAX_SESSIONS):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # ключ -> [токены, время пополнения]
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now=None):
+        """0.0, если запрос проходит, иначе через сколько секунд появится токен"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+
+class AdmissionControl:
+    """Ограничение одновременно выполняемых запросов горячих маршрутов
+
+    Сверх max_inflight запрос ждёт свободное место не дольше timeout, а
+    если ожидающих уже max_queue - сразу отклоняется. Перегрузка не копится
+    в потоках сервера, и задержка остальных клиентов остаётся ровной.
+    """
+
+    def __init__(self, max_inflight=MAX_INFLIGHT, max_queue=ADMISSION_QUEUE, timeout=ADMISSION_TIMEOUT):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.inflight = 0
+        self._waiting = 0
+        self._slots = threading.Semaphore(max_inflight) if max_inflight > 0 else None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """True - место получено (обязателен release), False - запрос сброшен"""
+        if self._slots is None:
+            return True
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    return False
+                self._waiting += 1
+            try:
+                if not self._slots.acquire(timeout=self.timeout):
+                    return False
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+        with self._lock:
+            self.inflight += 1
+        return True
+
+    def release(self):
+        if self._slots is not None:
+            with self._lock:
+                self.inflight -= 1
+            self._slots.release()
+
+
+class CoalescedCall:
+    """Результат выполняющегося запроса, который ждут одинаковые запросы"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer:
+    """Схлопывание одновременных одинаковых запросов в одно вычисление
+
+    Первый запрос с данным ключом выполняется, остальные, пришедшие пока
+    он не завершился, ждут и получают его результат (или его исключение).
+    Завершённые результаты не кэшируются - следующий запрос считает заново.
+    """
+
+    def __init__(self):
+        self._calls = {}  # ключ -> CoalescedCall
+        self._lock = threading.Lock()
+
+    def run(self, key, compute):
+        """(результат, выполнен ли этим вызовом)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = CoalescedCall()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, False
+        try:
+            call.result = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, True
+
+
+def overloaded(status, retry_after, message):
+    """Быстрый отказ 429/503 с Retry-After"""
+    response = jsonify({
+        'error': message,
+        'status': status,
+        'retryAfter': round(retry_after, 3),
+        'timestamp': int(time.time())
+    })
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def _admitted(route):
+    """Обработчик горячего маршрута внутри ограничения одновременных запросов"""
+    if not admission.acquire():
+        metrics.shed.inc()
+        return overloaded(503, admission.timeout, 'Server is overloaded')
+    try:
+        return app.make_response(route.handler())
+    finally:
+        admission.release()
+
+
+def call_limited(route):
+    """Горячий маршрут: лимит сессии, схлопывание чтений и ограничение параллелизма"""
+    token, session_id = session_keys()
+    key = token or (f'sid:{session_id}' if session_id else f'ip:{request.remote_addr}')
+    wait = rate_limiter.acquire(key)
+    if wait:
+        metrics.rate_limited.inc()
+        return overloaded(429, wait, 'Too many requests')
+    if not route.coalesce or request.method not in READ_METHODS:
+        return _admitted(route)
+    
+    def compute():
+        response = _admitted(route)
+        return response, (response.get_data(), response.status_code, list(response.headers), g.get('session'))
+    
+    (response, (body, status, headers, session)), leader = coalescer.run(
+        (route.pattern, request.method, key, request.query_string), compute
+    )
+    if leader:
+        return response
+    metrics.coalesced.inc()
+    if session is not None:
+        g.session = session
+    return Response(body, status=status, headers=headers)
+
+
+rate_limiter = RateLimiter()
+admission = AdmissionControl()
+coalescer = RequestCoalescer()
 
 # ==================== ОСНОВНЫЕ API ЭНДПОИНТЫ ====================
 
-@app.route('/api/token', methods=['GET', 'POST'])
-def api_token():
-    """Получение токена аутентификации"""
-    return jsonify({
-        'url': 'https://staging.playzia.com/games/playzia-bananabonanza/index.html?token=offline_mock_token_12345&login=offline_user&currency=EUR&gameCode=playzia-bananabonanza&mode=2&language=en',
-        'token': game_state['token'],
+def _api_token_body():
+    return {
+        'url': f'https://staging.playzia.com/games/playzia-bananabonanza/index.html?token={slot("token")}&login=offline_user&currency=EUR&gameCode=playzia-bananabonanza&mode=2&language=en',
+        'token': slot('token'),
         'login': 'offline_user',
-        'balance': game_state['balance'],
-        'currency': game_state['currency'],
+        'balance': slot('balance'),
+        'currency': slot('currency'),
         'status': 'success',
-        'timestamp': int(time.time())
-    })
+        'timestamp': slot('timestamp')
+    }
 
-@app.route('/token', methods=['GET', 'POST'])
-def token():
-    """Альтернативный эндпоинт для токена"""
-    return api_token()
+@routes.endpoint('GET', 'POST')
+def api_token():
+    """Получение токена аутентификации"""
+    session = current_session()
+    return response_templates.render(
+        'api_token', _api_token_body,
+        token=session.token, balance=session.balance, currency=session.currency
+    )
 
-@app.route('/api/game/balance', methods=['GET'])
+@routes.endpoint('GET', limited=True, coalesce=True)
 def game_balance():
     """Получение баланса игрока"""
+    session = current_session()
     return jsonify({
-        'balance': game_state['balance'],
-        'currency': game_state['currency'],
+        'balance': session.balance,
+        'currency': session.currency,
         'status': 'success',
         'timestamp': int(time.time())
     })
 
-@app.route('/api/game/spin', methods=['POST'])
+@routes.endpoint('POST', limited=True)
 def game_spin():
     """Выполнение игрового спина"""
-    game_result = generate_game_result()
+    session = current_session()
+    try:
+        game_result = generate_game_result(session, *spin_params(), key=idempotency_key())
+    except OutcomeError as e:
+        return jsonify({
+            'error': str(e),
+            'status': 400,
+            'timestamp': int(time.time())
+        }), 400
     
     return jsonify({
+        'id': game_result['id'],
+        'round': game_result['round'],
+        'bet': game_result['bet'],
         'result': game_result['result'],
         'multiplier': game_result['multiplier'],
         'win': game_result['win'],
-        'balance': game_state['balance'],
+        'pendingWin': game_result['pendingWin'],
+        'balance': game_result['balance'],
         'status': 'success',
         'timestamp': game_result['timestamp']
     })
 
-@app.route('/api/game/enter', methods=['POST'])
+@routes.endpoint('POST')
 def game_enter():
     """Вход в игру"""
+    session = current_session()
+    body = request.get_json(silent=True) if request.is_json else None
+    if isinstance(body, dict) and ('seed' in body or 'model' in body):
+        # Фиксированный seed и модель исходов для воспроизводимых прогонов
+        try:
+            model = get_outcome_model(body.get('model', session.model)).name
+            seed = int(body.get('seed', session.seed)) & ((1 << 63) - 1)
+        except (TypeError, ValueError) as e:
+            return jsonify({
+                'error': str(e),
+                'status': 400,
+                'timestamp': int(time.time())
+            }), 400
+        sessions.transact(session, lambda session: ({'model': model, 'seed': seed}, None, None))
     return jsonify({
         'status': 'success',
-        'balance': game_state['balance'],
+        'balance': session.balance,
         'gameId': 'playzia-bananabonanza',
-        'sessionId': game_state['session_id'],
+        'sessionId': session.session_id,
+        'seed': session.seed,
+        'model': session.model,
         'timestamp': int(time.time())
     })
 
-@app.route('/api/game/cashout', methods=['POST'])
+@routes.endpoint('POST', limited=True)
 def game_cashout():
     """Вывод средств"""
-    cashout_amount = round(random.uniform(10, 500), 2)
+    session = current_session()
+    cashout = settle_cashout(session, idempotency_key())
     
     return jsonify({
         'status': 'success',
-        'amount': cashout_amount,
-        'balance': game_state['balance'],
+        'round': cashout['round'],
+        'amount': cashout['amount'],
+        'balance': cashout['balance'],
         'timestamp': int(time.time())
     })
 
-@app.route('/api/game/leave', methods=['POST'])
+@routes.endpoint('POST')
 def game_leave():
     """Выход из игры"""
     return jsonify({
@@ -159,45 +3403,102 @@ def game_leave():
         'timestamp': int(time.time())
     })
 
-@app.route('/api/game/history', methods=['GET'])
+def _parse_round(value):
+    """Номер раунда из параметра запроса ('42' или 'game_42')"""
+    if not value:
+        return None
+    try:
+        return int(value.rsplit('_', 1)[-1])
+    except ValueError:
+        return None
+
+@routes.endpoint('GET', limited=True, coalesce=True)
 def game_history():
     """История игр"""
+    session = current_session()
+    since = _parse_round(request.args.get('since'))
+    before = _parse_round(request.args.get('cursor'))
+    limit = request.args.get('limit', HISTORY_PAGE_LIMIT, type=int)
+    limit = min(max(limit, 1), HISTORY_PAGE_MAX)
+    with session.lock:
+        history, next_cursor = session.history.page(since, before, limit)
+        latest = session.history.count
+    return jsonify({
+        'history': history,
+        'latest': latest,
+        'nextCursor': next_cursor,
+        'status': 'success',
+        'timestamp': int(time.time())
+    })
+
+@routes.endpoint('GET')
+def game_replay():
+    """Воспроизведение раунда по (seed, номер раунда) без хранения истории"""
+    session = current_session()
+    try:
+        round_no = _parse_round(request.args.get('round'))
+        if round_no is None or round_no < 1:
+            raise OutcomeError('round must be a positive round number')
+        seed = request.args.get('seed', session.seed, type=int)
+        model = get_outcome_model(request.args.get('model', session.model))
+        bet = validate_bet(request.args.get('bet', DEFAULT_BET))
+        target = request.args.get('target', type=float)
+        game_result = play_round(model, seed, round_no, bet, target)
+    except OutcomeError as e:
+        return jsonify({
+            'error': str(e),
+            'status': 400,
+            'timestamp': int(time.time())
+        }), 400
+    
     return jsonify({
-        'history': game_state['game_history'],
+        'replay': game_result,
+        'seed': seed,
+        'model': model.name,
         'status': 'success',
         'timestamp': int(time.time())
     })
 
-@app.route('/api/game/settings', methods=['GET', 'POST'])
+def _settings_snapshot():
+    with GAME_SETTINGS_LOCK:
+        return dict(GAME_SETTINGS)
+
+@routes.endpoint('GET', 'POST')
 def game_settings():
     """Настройки игры"""
     if request.method == 'POST':
-        # Обновляем настройки из запроса
-        new_settings = request.get_json() or {}
-        # Здесь можно добавить логику сохранения настроек
+        # Обновляем настройки из запроса (только известные ключи того же типа)
+        new_settings = request.get_json(silent=True) or {}
+        if isinstance(new_settings, dict):
+            for value in new_settings.values():
+                if isinstance(value, str) and '{{' in value:
+                    return jsonify({
+                        'error': 'setting values must not contain "{{"',
+                        'status': 400,
+                        'timestamp': int(time.time())
+                    }), 400
+            with GAME_SETTINGS_LOCK:
+                for key, value in new_settings.items():
+                    if key in GAME_SETTINGS and type(value) is type(GAME_SETTINGS[key]):
+                        GAME_SETTINGS[key] = value
+            response_templates.invalidate()
         return jsonify({
             'status': 'success',
             'message': 'Settings updated',
             'timestamp': int(time.time())
         })
     
-    return jsonify({
-        'settings': {
-            'soundEnabled': True,
-            'musicEnabled': True,
-            'autoplayEnabled': True,
-            'turboMode': False,
-            'language': 'en',
-            'currency': 'EUR'
-        },
+    return response_templates.render('game_settings', lambda: {
+        'settings': _settings_snapshot(),
         'status': 'success',
-        'timestamp': int(time.time())
+        'timestamp': slot('timestamp')
     })
 
-@app.route('/api/game/statistics', methods=['GET'])
+@routes.endpoint('GET', limited=True, coalesce=True)
 def game_statistics():
     """Статистика игрока"""
-    stats = game_state['statistics'].copy()
+    session = current_session()
+    stats = session.statistics()
     if stats['total_spins'] > 0:
         stats['win_rate'] = round((stats['total_wins'] / stats['total_spins']) * 100, 2)
         stats['average_win'] = round(stats['total_won'] / max(stats['total_wins'], 1), 2)
@@ -211,21 +3512,133 @@ def game_statistics():
         'timestamp': int(time.time())
     })
 
+@routes.endpoint('GET', limited=True, coalesce=True)
+def game_statistics_global():
+    """Статистика всех сессий: итог и скользящее окно (?window=<секунды>) по всем воркерам"""
+    window = request.args.get('window', STATS_DEFAULT_WINDOW, type=float)
+    if not math.isfinite(window) or window <= 0:
+        return jsonify({
+            'error': 'window must be a positive number',
+            'status': 400,
+            'timestamp': int(time.time())
+        }), 400
+    
+    return jsonify({
+        'statistics': stats_aggregator.report(window),
+        'status': 'success',
+        'timestamp': int(time.time())
+    })
+
+@routes.endpoint('GET', 'POST', limited=True)
+def game_simulate():
+    """Массовая симуляция спинов для проверки RTP"""
+    if np is None:
+        return jsonify({
+            'error': 'Simulation requires numpy',
+            'status': 501,
+            'timestamp': int(time.time())
+        }), 501
+    
+    params = request.args.to_dict()
+    try:
+        if request.is_json:
+            body = request.get_json(silent=True)
+            if body is not None and not isinstance(body, dict):
+                raise TypeError('JSON body must be an object')
+            params.update(body or {})
+        spins = int(params.get('spins', SIMULATE_DEFAULT_SPINS))
+        seed = params.get('seed')
+        seed = int(seed) if seed is not None else None
+        bet = float(params.get('bet', 1.0))
+        bins = min(max(int(params.get('bins', 49)), 1), 1000)
+        model = get_outcome_model(params.get('model'))
+        target = params.get('target')
+        target = float(target) if target is not None else None
+        stream = str(params.get('stream', '')).lower() in ('1', 'true', 'yes')
+        if stream:
+            seed = _check_simulation(spins, seed, bet)
+            model.histogram_range(target)  # проверка target до начала потока
+            return Response(
+                stream_simulated_rounds(spins, seed, bet, model, target),
+                mimetype='application/x-ndjson',
+                headers={'X-Simulation-Seed': str(seed)}
+            )
+        summary = simulate_spins(spins, seed, bet, bins, model, target)
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'error': str(e),
+            'status': 400,
+            'timestamp': int(time.time())
+        }), 400
+    
+    return jsonify({
+        'simulation': summary,
+        'status': 'success',
+        'timestamp': int(time.time())
+    })
+
+@routes.endpoint('GET', limited=True, coalesce=True)
+def crash_round():
+    """Текущий общий crash-раунд"""
+    return jsonify({
+        'crash': crash_engine.state(),
+        'status': 'success',
+        'timestamp': int(time.time())
+    })
+
+@routes.endpoint('POST', limited=True)
+def crash_bet():
+    """Ставка в текущий crash-раунд (autoCashout - цель автовывода)"""
+    session = current_session()
+    try:
+        receipt = crash_engine.place_bet(session, *spin_params(), key=idempotency_key())
+    except OutcomeError as e:
+        return jsonify({
+            'error': str(e),
+            'status': 400,
+            'timestamp': int(time.time())
+        }), 400
+    
+    return jsonify({
+        **receipt,
+        'status': 'success',
+        'timestamp': int(time.time())
+    })
+
+@routes.endpoint('POST', limited=True)
+def crash_cashout():
+    """Ручной вывод ставки по текущему множителю раунда"""
+    session = current_session()
+    try:
+        result = crash_engine.cashout(session)
+    except OutcomeError as e:
+        return jsonify({
+            'error': str(e),
+            'status': 400,
+            'timestamp': int(time.time())
+        }), 400
+    
+    return jsonify({
+        **result,
+        'status': 'success',
+        'timestamp': int(time.time())
+    })
+
 # ==================== FRONTEND SERVICE API ====================
 
-@app.route('/frontendService/gameVoteData', methods=['GET'])
+@routes.endpoint('GET')
 def frontend_service_game_vote_data():
     """Данные голосования за игру"""
-    return jsonify({
+    return response_templates.render('game_vote_data', lambda: {
         'gameId': 25721,
         'likeCount': 999,
         'superLikeCount': 99,
         'dislikeCount': 0,
         'status': 'success',
-        'timestamp': int(time.time())
+        'timestamp': slot('timestamp')
     })
 
-@app.route('/frontendService/vote/game', methods=['POST'])
+@routes.endpoint('POST')
 def frontend_service_vote_game():
     """Голосование за игру"""
     return jsonify({
@@ -236,28 +3649,30 @@ def frontend_service_vote_game():
 
 # ==================== PLAYZIA API V2 ====================
 
-@app.route('/api.playzia.staging.hizi-service.com/gameapi/v2/connect', methods=['GET', 'POST'])
+@routes.endpoint('GET', 'POST')
 def playzia_api_v2_connect():
     """Подключение к игровому серверу"""
+    session = current_session()
     return jsonify({
         'status': 'connected',
-        'sessionId': game_state['session_id'],
-        'token': game_state['token'],
+        'sessionId': session.session_id,
+        'token': session.token,
         'serverUrl': 'wss://ws.playzia.staging.hizi-service.com/connect',
         'timestamp': int(time.time())
     })
 
-@app.route('/api.playzia.staging.hizi-service.com/gameapi/v2/reconnect', methods=['GET', 'POST'])
+@routes.endpoint('GET', 'POST')
 def playzia_api_v2_reconnect():
     """Переподключение к серверу"""
+    session = current_session()
     return jsonify({
         'status': 'reconnected',
-        'sessionId': game_state['session_id'],
-        'token': game_state['token'],
+        'sessionId': session.session_id,
+        'token': session.token,
         'timestamp': int(time.time())
     })
 
-@app.route('/api.playzia.staging.hizi-service.com/gameapi/v2/disconnect', methods=['GET', 'POST'])
+@routes.endpoint('GET', 'POST')
 def playzia_api_v2_disconnect():
     """Отключение от сервера"""
     return jsonify({
@@ -266,96 +3681,67 @@ def playzia_api_v2_disconnect():
         'timestamp': int(time.time())
     })
 
-@app.route('/api.playzia.staging.hizi-service.com/gameapi/bananabonanza/interface', methods=['GET', 'POST'])
+@routes.endpoint('GET', 'POST')
 def playzia_api_bananabonanza_interface():
     """Игровой интерфейс API"""
-    return jsonify({
-        'gameData': {
-            'gameId': 'playzia-bananabonanza',
-            'version': '1.0.0',
-            'features': ['autoplay', 'turbo', 'gamble'],
-            'betLevels': [0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0],
-            'maxBet': 100.0,
-            'minBet': 0.1
-        },
-        'playerData': {
-            'balance': game_state['balance'],
-            'currency': game_state['currency'],
-            'sessionId': game_state['session_id']
+    session = current_session()
+    return response_templates.render(
+        'bananabonanza_interface', lambda: {
+            'gameData': {
+                'gameId': 'playzia-bananabonanza',
+                'version': '1.0.0',
+                'features': ['autoplay', 'turbo', 'gamble'],
+                'betLevels': list(BET_LEVELS),
+                'maxBet': max(BET_LEVELS),
+                'minBet': min(BET_LEVELS)
+            },
+            'playerData': {
+                'balance': slot('balance'),
+                'currency': slot('currency'),
+                'sessionId': slot('sessionId')
+            },
+            'status': 'success',
+            'timestamp': slot('timestamp')
         },
-        'status': 'success',
-        'timestamp': int(time.time())
-    })
+        balance=session.balance, currency=session.currency, sessionId=session.session_id
+    )
 
 # ==================== STAGING API ====================
 
-@app.route('/staging.playzia.com/api/token', methods=['GET', 'POST'])
+# /staging.playzia.com/api/game/balance обслуживает game_balance (см. VIRTUAL_HOSTS)
+
+@routes.endpoint('GET', 'POST')
 def staging_api_token():
     """Staging API токен"""
     return jsonify({
-        'token': 'staging_offline_mock_token_67890',
-        'status': 'success',
-        'timestamp': int(time.time())
-    })
-
-@app.route('/staging.playzia.com/api/game/balance', methods=['GET'])
-def staging_api_game_balance():
-    """Staging API баланс"""
-    return jsonify({
-        'balance': game_state['balance'],
-        'currency': game_state['currency'],
+        'token': 'staging_offline_mock_token_67890',
         'status': 'success',
         'timestamp': int(time.time())
     })
 
 # ==================== GS2 PLAYZIA API ====================
 
-@app.route('/gs2.playzia.com/token', methods=['GET', 'POST'])
+# Баланс и спин зеркалируются из основного API (см. VIRTUAL_HOSTS)
+
+@routes.endpoint('GET', 'POST')
 def gs2_playzia_token():
     """GS2 Playzia токен"""
+    session = current_session()
     return jsonify({
-        'url': 'https://staging.playzia.com/games/playzia-bananabonanza/index.html?token=offline_mock_token_12345&login=offline_user&currency=EUR&gameCode=playzia-bananabonanza&mode=2&language=en',
-        'token': game_state['token'],
+        'url': f'https://staging.playzia.com/games/playzia-bananabonanza/index.html?token={session.token}&login=offline_user&currency=EUR&gameCode=playzia-bananabonanza&mode=2&language=en',
+        'token': session.token,
         'login': 'offline_user',
         'status': 'success',
         'timestamp': int(time.time())
     })
 
-@app.route('/gs2.playzia.com/api/token', methods=['GET', 'POST'])
-def gs2_playzia_api_token():
-    """GS2 Playzia API токен"""
-    return gs2_playzia_token()
-
-@app.route('/gs2.playzia.com/api/game/balance', methods=['GET'])
-def gs2_playzia_api_game_balance():
-    """GS2 Playzia API баланс"""
-    return jsonify({
-        'balance': game_state['balance'],
-        'currency': game_state['currency'],
-        'status': 'success',
-        'timestamp': int(time.time())
-    })
-
-@app.route('/gs2.playzia.com/api/game/spin', methods=['POST'])
-def gs2_playzia_api_game_spin():
-    """GS2 Playzia API спин"""
-    game_result = generate_game_result()
-    
-    return jsonify({
-        'result': game_result['result'],
-        'multiplier': game_result['multiplier'],
-        'win': game_result['win'],
-        'balance': game_state['balance'],
-        'status': 'success',
-        'timestamp': game_result['timestamp']
-    })
-
 # ==================== ОСНОВНЫЕ ИГРОВЫЕ ДАННЫЕ ====================
 
-@app.route('/staging.playzia.com/games/playzia-bananabonanza/offline_user', methods=['GET'])
+@routes.endpoint('GET')
 def staging_playzia_games_offline_user():
     """Основные игровые данные для offline_user"""
-    return jsonify({
+    session = current_session()
+    return response_templates.render('offline_user', lambda: {
         'tokenData': {
             'operatorId': "internal_testoperator",
             'playerId': "offline_user_12345",
@@ -376,10 +3762,10 @@ def staging_playzia_games_offline_user():
             }]
         },
         'backendUrl': "https://api.playzia.staging.hizi-service.com/gameapi/bananabonanza/interface",
-        'refreshUrl': "https://api.playzia.staging.hizi-service.com/gameapi/v2/reconnect?token=offline_mock_token_12345",
-        'logoutUrl': "https://api.playzia.staging.hizi-service.com/gameapi/v2/disconnect?token=offline_mock_token_12345",
+        'refreshUrl': f"https://api.playzia.staging.hizi-service.com/gameapi/v2/reconnect?token={slot('token')}",
+        'logoutUrl': f"https://api.playzia.staging.hizi-service.com/gameapi/v2/disconnect?token={slot('token')}",
         'webSocketUrl': None,
-        'token': game_state['token'],
+        'token': slot('token'),
         'gameSettings': {
             'autoplayEnabled': True,
             'autoplayLossLimitRequired': False,
@@ -416,14 +3802,295 @@ def staging_playzia_games_offline_user():
         },
         'operatorProtocol': 1,
         'status': 'success',
-        'timestamp': int(time.time())
-    })
+        'timestamp': slot('timestamp')
+    }, token=session.token)
 
 # ==================== WEBSOCKET ОБРАБОТКА ====================
 
+WS_MAX_BATCH = 256
+
+
+class JsonCodec:
+    """Текстовые JSON кадры (кодировка по умолчанию)"""
+
+    name = 'json'
+    binary = False
+
+    @staticmethod
+    def dumps(data):
+        return json_backend.dumps_text(data)
+
+    @staticmethod
+    def loads(message):
+        return json_backend.loads(message)
+
+
+class MsgpackCodec:
+    """Компактные бинарные кадры msgpack"""
+
+    name = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def dumps(data):
+        return msgpack.packb(data, use_bin_type=True, default=encode_default)
+
+    @staticmethod
+    def loads(message):
+        return msgpack.unpackb(message, raw=False)
+
+
+WS_CODECS = {JsonCodec.name: JsonCodec}
+if msgpack is not None:
+    WS_CODECS[MsgpackCodec.name] = MsgpackCodec
+
+
+def negotiate_codec(path):
+    """Кодировка кадров из параметра подключения ?encoding=json|msgpack"""
+    query = urllib.parse.urlsplit(path or '').query
+    requested = urllib.parse.parse_qs(query).get('encoding', ['json'])[0]
+    return WS_CODECS.get(requested, JsonCodec)
+
+
+def decode_ws_message(message):
+    """Разбор входящего кадра: бинарные кадры - msgpack, текстовые - JSON"""
+    if isinstance(message, (bytes, bytearray)):
+        if msgpack is not None:
+            return MsgpackCodec.loads(message)
+        message = message.decode('utf-8')
+    try:
+        return json_backend.loads(message)
+    except json_backend.decode_error:
+        # Если не JSON, обрабатываем как текстовое сообщение
+        return {'type': 'text', 'message': message}
+
+
+class WsConnection:
+    """Состояние WebSocket соединения: кодировка и подписки на сессии"""
+
+    def __init__(self, websocket, path):
+        self.websocket = websocket
+        self.codec = negotiate_codec(path)
+        self.subscriber = Subscriber(asyncio.get_running_loop())
+        self.tokens = set()
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(path or '').query)
+        self.default_token = query.get('token', [DEFAULT_TOKEN])[0]
+        if 'token' in query:
+            self.subscribe(self.default_token)
+
+    async def send(self, data):
+        await self.websocket.send(self.codec.dumps(data))
+
+    async def pump(self):
+        """Доставка push-событий подписок до закрытия соединения"""
+        try:
+            await self.subscriber.pump(self.send)
+        except (websockets.exceptions.ConnectionClosed, WebSocketDisconnect):
+            pass
+
+    def subscribe(self, token):
+        if token not in self.tokens:
+            self.tokens.add(token)
+            broker.subscribe(token, self.subscriber)
+
+    def unsubscribe(self, token):
+        if token in self.tokens:
+            self.tokens.discard(token)
+            broker.unsubscribe(token, self.subscriber)
+
+    def close(self):
+        for token in list(self.tokens):
+            self.unsubscribe(token)
+
+
+def _ws_ping(conn, data, now):
+    return {
+        'type': 'pong',
+        'status': 'success',
+        'timestamp': now
+    }
+
+
+def _ws_test(conn, data, now):
+    return {
+        'type': 'test_response',
+        'status': 'success',
+        'message': 'Test message received successfully',
+        'original_message': data.get('message', ''),
+        'timestamp': now
+    }
+
+
+def _ws_hello(conn, data, now):
+    # Смена кодировки: подтверждение уходит уже в новой кодировке
+    conn.codec = WS_CODECS.get(data.get('encoding'), conn.codec)
+    return {
+        'type': 'hello',
+        'status': 'success',
+        'encoding': conn.codec.name,
+        'timestamp': now
+    }
+
+
+def _ws_subscribe(conn, data, now):
+    if data.get('channel') == 'crash':
+        # Общие crash-раунды: фазы и тики множителя
+        token = CRASH_CHANNEL
+        crash_engine.start()
+    else:
+        token = data.get('token') or conn.default_token
+    if data.get('type') == 'unsubscribe':
+        conn.unsubscribe(token)
+    else:
+        conn.subscribe(token)
+    return {
+        'type': data['type'],
+        'status': 'success',
+        'token': token,
+        'timestamp': now
+    }
+
+
+def _ws_game_action(conn, data, now):
+    session = sessions.get_or_create(data.get('token') or conn.default_token)
+    action = data.get('action', 'balance')
+    if action != 'balance':
+        # Общий с HTTP лимит сессии: автоплей через сокет не обходит ограничение
+        wait = rate_limiter.acquire(session.token)
+        if wait:
+            metrics.rate_limited.inc()
+            return {
+                'type': 'error',
+                'message': 'Too many requests',
+                'retryAfter': round(wait, 3),
+                'timestamp': now
+            }
+    if action == 'spin':
+        try:
+            bet = validate_bet(data.get('bet', DEFAULT_BET))
+            target = data.get('autoCashout')
+            result = dict(generate_game_result(
+                session, bet, float(target) if target is not None else None, data.get('idempotencyKey')
+            ))
+        except (OutcomeError, SessionConflict, IdempotencyMismatch, TypeError, ValueError) as e:
+            return {
+                'type': 'error',
+                'message': str(e),
+                'timestamp': now
+            }
+    elif action == 'cashout':
+        try:
+            result = settle_cashout(session, data.get('idempotencyKey'))
+        except (SessionConflict, IdempotencyMismatch) as e:
+            return {
+                'type': 'error',
+                'message': str(e),
+                'timestamp': now
+            }
+    elif action in ('crash_bet', 'crash_cashout'):
+        try:
+            if action == 'crash_bet':
+                bet = validate_bet(data.get('bet', DEFAULT_BET))
+                target = data.get('autoCashout')
+                result = crash_engine.place_bet(
+                    session, bet, float(target) if target is not None else None, data.get('idempotencyKey')
+                )
+            else:
+                result = crash_engine.cashout(session)
+        except (OutcomeError, SessionConflict, IdempotencyMismatch, TypeError, ValueError) as e:
+            return {
+                'type': 'error',
+                'message': str(e),
+                'timestamp': now
+            }
+    elif action == 'crash_state':
+        result = crash_engine.state()
+    else:
+        result = {'balance': session.balance, 'currency': session.currency}
+    return {
+        'type': 'game_response',
+        'status': 'success',
+        'action': action,
+        'data': result,
+        'timestamp': now
+    }
+
+
+WS_HANDLERS = {
+    'ping': _ws_ping,
+    'test': _ws_test,
+    'hello': _ws_hello,
+    'subscribe': _ws_subscribe,
+    'unsubscribe': _ws_subscribe,
+    'game_action': _ws_game_action,
+}
+
+
+def handle_ws_message(conn, data, now):
+    """Ответ на одно сообщение; поле id запроса возвращается для конвейерной обработки"""
+    if not isinstance(data, dict):
+        data = {'type': 'text', 'message': data}
+    try:
+        handler = WS_HANDLERS.get(data.get('type'))
+        if handler is not None:
+            response = handler(conn, data, now)
+        else:
+            response = {
+                'type': 'response',
+                'status': 'success',
+                'data': 'WebSocket работает в оффлайн режиме',
+                'received_type': data.get('type', 'unknown'),
+                'timestamp': now
+            }
+    except Exception as msg_error:
+        response = {
+            'type': 'error',
+            'message': f'Error processing message: {str(msg_error)}',
+            'timestamp': now
+        }
+    if 'id' in data:
+        response['id'] = data['id']
+    return response
+
+
+def ws_frame_blocks(data):
+    """Есть ли в кадре игровые действия: они ходят в бэкенд сессий и журнал
+    и могут ждать блокировок SQLite, поэтому не выполняются на event loop"""
+    if isinstance(data, dict) and data.get('type') == 'batch':
+        data = data.get('messages')
+    items = data if isinstance(data, list) else (data,)
+    return any(isinstance(item, dict) and item.get('type') == 'game_action' for item in items)
+
+
+def handle_ws_frame(conn, data, now):
+    """Ответ на кадр: массив сообщений обрабатывается пакетом и возвращается одним кадром"""
+    if isinstance(data, dict) and data.get('type') == 'batch':
+        data = data.get('messages') or []
+    if not isinstance(data, list):
+        return handle_ws_message(conn, data, now)
+    if len(data) > WS_MAX_BATCH:
+        return {
+            'type': 'error',
+            'message': f'Batch too large: {len(data)} > {WS_MAX_BATCH}',
+            'timestamp': now
+        }
+    return [handle_ws_message(conn, item, now) for item in data]
+
+
 async def websocket_handler(websocket, path):
-    """Обработчик WebSocket соединений"""
-    print(f"🔌 WebSocket подключение: {path}")
+    """Обработчик WebSocket соединений
+
+    Кодировка ответов согласуется при подключении (?encoding=msgpack) или
+    сообщением {"type": "hello", "encoding": ...}. Кадр может содержать
+    массив сообщений - ответы на него приходят одним кадром в том же порядке.
+    Подписка на сессию (?token=... или {"type": "subscribe"}) включает
+    push-уведомления о раундах, кешаутах и балансе.
+    """
+    log_event(logging.DEBUG, 'WebSocket подключение', path=path)
+    conn = WsConnection(websocket, path)
+    pump = asyncio.ensure_future(conn.pump())
+    capture = traffic_capture.ws_open(path, conn) if traffic_capture is not None else None
+    metrics.ws_connections.inc()
     
     try:
         # Отправляем приветственное сообщение
@@ -431,77 +4098,53 @@ async def websocket_handler(websocket, path):
             'type': 'connection',
             'status': 'connected',
             'message': 'WebSocket connected in offline mode',
+            'encoding': conn.codec.name,
+            'encodings': list(WS_CODECS),
+            'maxBatch': WS_MAX_BATCH,
+            'subscriptions': sorted(conn.tokens),
             'timestamp': int(time.time())
         }
-        await websocket.send(json.dumps(welcome_msg))
-        print(f"✅ Отправлено приветственное сообщение")
+        await conn.send(welcome_msg)
         
         # Обрабатываем входящие сообщения
         async for message in websocket:
+            started = time.perf_counter()
+            now = int(time.time())
+            kind = 'invalid'
+            data = None
             try:
-                print(f"📨 Получено сообщение: {message}")
-                
-                # Пытаемся распарсить JSON
-                try:
-                    data = json.loads(message)
-                    print(f"📨 WebSocket JSON сообщение: {data}")
-                except json.JSONDecodeError:
-                    # Если не JSON, обрабатываем как текстовое сообщение
-                    data = {'type': 'text', 'message': message}
-                    print(f"📨 WebSocket текстовое сообщение: {message}")
-                
-                # Обрабатываем разные типы сообщений
-                if data.get('type') == 'ping':
-                    response = {
-                        'type': 'pong',
-                        'status': 'success',
-                        'timestamp': int(time.time())
-                    }
-                elif data.get('type') == 'test':
-                    response = {
-                        'type': 'test_response',
-                        'status': 'success',
-                        'message': 'Test message received successfully',
-                        'original_message': data.get('message', ''),
-                        'timestamp': int(time.time())
-                    }
-                elif data.get('type') == 'game_action':
-                    response = {
-                        'type': 'game_response',
-                        'status': 'success',
-                        'data': 'Game action processed in offline mode',
-                        'timestamp': int(time.time())
-                    }
+                data = decode_ws_message(message)
+                kind = data.get('type', 'unknown') if isinstance(data, dict) else 'batch'
+                if ws_frame_blocks(data):
+                    # Пул потоков ASGI-адаптера: спорная запись в SQLite не держит остальные соединения
+                    response = await asyncio.get_running_loop().run_in_executor(
+                        asgi_app.executor, handle_ws_frame, conn, data, now
+                    )
                 else:
-                    response = {
-                        'type': 'response',
-                        'status': 'success',
-                        'data': 'WebSocket работает в оффлайн режиме',
-                        'received_type': data.get('type', 'unknown'),
-                        'timestamp': int(time.time())
-                    }
-                
-                print(f"📤 Отправляем ответ")
-                await websocket.send(json.dumps(response))
-                
+                    response = handle_ws_frame(conn, data, now)
             except Exception as msg_error:
-                print(f"❌ Ошибка обработки сообщения: {msg_error}")
-                error_response = {
+                response = {
                     'type': 'error',
                     'message': f'Error processing message: {str(msg_error)}',
-                    'timestamp': int(time.time())
+                    'timestamp': now
                 }
-                try:
-                    await websocket.send(json.dumps(error_response))
-                except:
-                    pass
+            await conn.send(response)
+            elapsed = time.perf_counter() - started
+            metrics.ws_messages.inc()
+            metrics.ws_latency.observe((kind if kind in WS_HANDLERS or kind == 'batch' else 'other',), elapsed)
+            if capture is not None and data is not None:
+                traffic_capture.ws_frame(capture, conn, data, elapsed)
                 
-    except websockets.exceptions.ConnectionClosed:
-        print("🔌 WebSocket соединение закрыто")
-    except Exception as e:
-        print(f"❌ Ошибка в WebSocket обработчике: {e}")
-        import traceback
-        traceback.print_exc()
+    except (websockets.exceptions.ConnectionClosed, WebSocketDisconnect):
+        log_event(logging.DEBUG, 'WebSocket соединение закрыто', path=path)
+    except Exception:
+        log.exception('Ошибка в WebSocket обработчике')
+    finally:
+        metrics.ws_connections.dec()
+        conn.close()
+        pump.cancel()
+        if capture is not None:
+            traffic_capture.ws_close(capture)
 
 def start_websocket_server():
     """Запуск WebSocket сервера в отдельном потоке"""
@@ -514,40 +4157,43 @@ def start_websocket_server():
             for port in [5001, 5002, 5003, 5004, 5005]:
                 try:
                     server = await websockets.serve(websocket_handler, "localhost", port)
-                    print(f"🔌 WebSocket сервер запущен на ws://localhost:{port}")
+                    log_event(logging.INFO, 'WebSocket сервер запущен', url=f'ws://localhost:{port}')
                     await server.wait_closed()
                     break
                 except OSError as e:
                     if "Address already in use" in str(e) or "10048" in str(e):
-                        print(f"⚠️ Порт {port} занят, пробуем следующий...")
+                        log_event(logging.WARNING, 'Порт занят, пробуем следующий', port=port)
                         continue
                     else:
                         raise e
         
         loop.run_until_complete(run_server())
     except Exception as e:
-        print(f"❌ Ошибка WebSocket сервера: {e}")
-        print("ℹ️ WebSocket сервер отключен, игра будет работать без него")
+        log_event(logging.ERROR, 'WebSocket сервер отключен, игра будет работать без него', error=str(e))
 
-@app.route('/staging.playzia.com/games/playzia-bananabonanza/index.html', methods=['GET'])
+@routes.endpoint('GET')
 def websocket_redirect():
     """Обработка WebSocket запросов - перенаправляем на обычную игру"""
     # Обычный запрос к игре
-    game_path = Path('staging.playzia.com/games/playzia-bananabonanza/index.html')
-    if game_path.exists():
-        return send_file(str(game_path))
+    asset = static_index.get(GAME_INDEX_PATH)
+    if asset is not None:
+        response = asset_response(asset)
+        response.headers['Link'] = asset_bundles.preload_links()
+        return response
     
     return jsonify({
         'error': 'Game file not found',
         'status': 404
     }), 404
 
-@app.route('/', methods=['GET'])
+@routes.endpoint('GET')
 def serve_game():
     """Обслуживание главной страницы игры"""
-    game_path = Path('staging.playzia.com/games/playzia-bananabonanza/index.html')
-    if game_path.exists():
-        return send_file(str(game_path))
+    asset = static_index.get(GAME_INDEX_PATH)
+    if asset is not None:
+        response = asset_response(asset)
+        response.headers['Link'] = asset_bundles.preload_links()
+        return response
     
     return jsonify({
         'error': 'Game file not found',
@@ -556,25 +4202,654 @@ def serve_game():
 
 # ==================== СТАТИЧЕСКИЕ ФАЙЛЫ ====================
 
-@app.route('/<path:path>')
+GAME_ROOT = 'staging.playzia.com/games/playzia-bananabonanza'
+GAME_INDEX_PATH = f'{GAME_ROOT}/index.html'
+STATIC_ROOT = Path('.')
+# Файлы, которых нет в дереве статики, ищутся уровнем выше
+STATIC_FALLBACK_ROOT = Path('..')
+STATIC_SKIP_DIRS = {'.git', '__pycache__', 'node_modules', '.vercel'}
+# Заранее собранный индекс статики (python mock_server_flask.py --build-index)
+STATIC_INDEX_FILE = os.getenv('MOCK_STATIC_INDEX', 'static_index.json')
+STATIC_INDEX_VERSION = 2
+STATIC_CACHE_BYTES = int(os.getenv('MOCK_STATIC_CACHE_MB', '64')) * 1024 * 1024
+STATIC_CACHE_FILE_LIMIT = 2 * 1024 * 1024  # большие файлы отдаются через sendfile
+STATIC_MAX_AGE = int(os.getenv('MOCK_STATIC_MAX_AGE', '0'))
+# Пути с хэшем сборки в имени каталога не меняются - кэшируются навсегда
+FINGERPRINTED_PATH = re.compile(r'(^|/)res/[0-9a-f]{16,}/')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Предварительное сжатие текстовой статики
+COMPRESSIBLE_EXTENSIONS = {'.html', '.js', '.css', '.json', '.svg', '.atlas', '.txt', '.xml', '.map'}
+COMPRESS_MIN_SIZE = 1024
+
+# Манифесты ресурсов игры (assets_manifests / post_load_assets_manifests в src/app.js)
+ASSET_MANIFESTS = {
+    'base': 'assets/renderer/base/manifest.json',
+    'celebration': 'assets/renderer/celebration/manifest.json'
+}
+BUNDLE_ITEM_TYPES = {'json', 'atlas', 'spine_atlas'}
+BUNDLE_ITEM_LIMIT = 256 * 1024  # крупные файлы остаются отдельными запросами
+PRELOAD_MANIFEST = 'base'  # его ресурсы нужны до первого спина
+PRELOAD_LINK_LIMIT = 6  # манифест и первые JSON/atlas ресурсы
+COMPRESS_CACHE_DIR = Path(os.getenv(
+    'MOCK_COMPRESS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'banana_bonanza_precompressed')
+))
+
+
+def _file_digest(path):
+    """Хэш содержимого файла (blake2b-128, hex)"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def contained_path(root, url):
+    """Путь файла url внутри root или None, если url выходит за пределы root (../, симлинки)"""
+    base = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(base, *url.split('/')))
+    if path != base and not path.startswith(base + os.sep):
+        return None
+    return path
+
+
+def private_files(index_file=STATIC_INDEX_FILE):
+    """Абсолютные пути служебных файлов сервера, которые не отдаются как статика
+
+    Журнал состояния, общая база сессий, запись трафика и сохранённый индекс
+    по умолчанию лежат в рабочем каталоге - то есть в дереве статики.
+    """
+    paths = {index_file, os.getenv('MOCK_CAPTURE', '')}
+    databases = [STATE_DB]
+    kind, _, path = SESSION_BACKEND.partition(':')
+    if kind == 'sqlite':
+        databases.append(path)
+    for database in databases:
+        if database:
+            paths.update(database + suffix for suffix in ('', '-wal', '-shm', '-journal'))
+    paths.discard('')
+    return {os.path.realpath(path) for path in paths}
+
+
+class AssetBlob:
+    """Уникальное содержимое файла, общее для всех зеркальных путей
+
+    Одинаковые файлы из разных деревьев (assets/... и
+    staging.playzia.com/.../assets/...) указывают на один блоб: читается
+    один файл, в памяти и в кэше сжатия хранится одна копия, ETag общий.
+    """
+
+    __slots__ = ('path', 'size', 'variants', '_digest')
+
+    def __init__(self, path, size, digest=None):
+        self.path = path
+        self.size = size
+        self.variants = None  # encoding -> AssetVariant, заполняет Precompressor
+        self._digest = digest
+
+    @property
+    def cache_key(self):
+        return self.path
+
+    @property
+    def digest(self):
+        """Хэш содержимого; вычисляется при первом обращении"""
+        if self._digest is None:
+            self._digest = _file_digest(self.path)
+        return self._digest
+
+    @property
+    def etag(self):
+        return f'"{self.digest}"'
+
+
+class StaticAsset:
+    """Запись индекса статики: URL-путь с заранее вычисленными метаданными"""
+
+    __slots__ = ('url', 'blob', 'mtime_ns', 'last_modified', 'mimetype', 'cache_control', 'compressible')
+
+    def __init__(self, url, blob, mtime_ns):
+        self.url = url
+        self.blob = blob
+        self.mtime_ns = mtime_ns
+        self.last_modified = datetime.fromtimestamp(mtime_ns // 1_000_000_000, timezone.utc)
+        self.mimetype = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+        if FINGERPRINTED_PATH.search(url):
+            self.cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            self.cache_control = f'public, max-age={STATIC_MAX_AGE}, must-revalidate'
+        self.compressible = (
+            blob.size >= COMPRESS_MIN_SIZE and os.path.splitext(url)[1].lower() in COMPRESSIBLE_EXTENSIONS
+        )
+
+    @property
+    def etag(self):
+        return self.blob.etag
+
+
+class StaticIndex:
+    """Индекс URL-путь -> файл, построенный один раз при первом обращении
+
+    Попадание в индекс не требует ни одного stat; файл, добавленный после
+    старта, заносится в индекс при первом обращении (add), удалённый -
+    убирается (discard), rebuild() пересобирает индекс целиком. Хэшируются только файлы с
+    совпадающим размером - остальные заведомо уникальны. Если рядом лежит
+    заранее собранный индекс (save) и его файлы не изменились с момента
+    сборки, он загружается вместо обхода дерева.
+    """
+
+    def __init__(self, root=STATIC_ROOT, index_file=STATIC_INDEX_FILE):
+        self.root = root
+        self.index_file = index_file
+        self._assets = None
+        self._lock = threading.Lock()
+
+    @property
+    def assets(self):
+        """URL -> StaticAsset; строится при первом обращении"""
+        if self._assets is None:
+            with self._lock:
+                if self._assets is None:
+                    started = time.perf_counter()
+                    source = 'file' if self._load() else 'scan'
+                    if source == 'scan':
+                        self.rebuild()
+                    startup.record('static_index', time.perf_counter() - started, source=source)
+        return self._assets
+
+    def _scan(self):
+        """(url, путь, размер, mtime_ns) всех файлов дерева"""
+        files = []
+        private = private_files(self.index_file)
+        stack = [(str(self.root), '')]
+        while stack:
+            directory, prefix = stack.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                url = prefix + entry.name
+                if entry.is_dir(follow_symlinks=True):
+                    if entry.name not in STATIC_SKIP_DIRS:
+                        stack.append((entry.path, url + '/'))
+                elif entry.is_file(follow_symlinks=True):
+                    if os.path.realpath(entry.path) in private:
+                        continue  # журнал, база сессий, запись трафика и сам индекс
+                    stat = entry.stat()
+                    files.append((url, entry.path, stat.st_size, stat.st_mtime_ns))
+        return sorted(files)
+
+    def rebuild(self):
+        files = self._scan()
+        by_size = {}
+        for url, path, size, mtime_ns in files:
+            by_size.setdefault(size, []).append(path)
+
+        blobs = {}  # путь -> блоб
+        for size, paths in by_size.items():
+            if len(paths) == 1:
+                blobs[paths[0]] = AssetBlob(paths[0], size)
+                continue
+            by_digest = {}
+            for path in paths:
+                digest = _file_digest(path)
+                if digest not in by_digest:
+                    by_digest[digest] = AssetBlob(path, size, digest)
+                blobs[path] = by_digest[digest]
+
+        self._assets = {
+            url: StaticAsset(url, blobs[path], mtime_ns)
+            for url, path, size, mtime_ns in files
+        }
+
+    def _load(self):
+        """Загружает сохранённый индекс; False, если его нет, он несовместим или устарел
+
+        Размер и mtime каждой записи сверяются с диском: файл, изменённый
+        или удалённый после --build-index, означает, что индекс собран для
+        другого дерева, и его хэшам верить нельзя - дерево обходится заново.
+        Файлы, появившиеся после сборки, подхватывает add().
+        """
+        try:
+            with open(self.index_file, 'rb') as f:
+                saved = json_backend.loads(f.read())
+        except (OSError, ValueError):
+            return False
+        if not isinstance(saved, dict) or saved.get('version') != STATIC_INDEX_VERSION:
+            return False
+        blobs = {}  # хэш -> блоб
+        assets = {}
+        private = private_files(self.index_file)
+        for url, path, size, mtime_ns, digest in saved['files']:
+            if os.path.realpath(path) in private:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                return False
+            blob = blobs.get(digest)
+            if blob is None:
+                blob = blobs[digest] = AssetBlob(path, size, digest)
+            assets[url] = StaticAsset(url, blob, mtime_ns)
+        self._assets = assets
+        return True
+
+    def save(self, path=None):
+        """Сохраняет индекс с хэшами всех файлов для быстрого холодного старта"""
+        self.rebuild()
+        files = [
+            [url, asset.blob.path, asset.blob.size,
+             asset.mtime_ns, asset.blob.digest]
+            for url, asset in sorted(self._assets.items())
+        ]
+        with open(path or self.index_file, 'wb') as f:
+            f.write(json_backend.dumps({'version': STATIC_INDEX_VERSION, 'files': files}))
+        return len(files)
+
+    def get(self, url):
+        return self.assets.get(url)
+
+    def add(self, url):
+        """Заносит в индекс файл, появившийся после построения; None, если файла нет"""
+        if any(part in STATIC_SKIP_DIRS for part in url.split('/')):
+            return None
+        path = contained_path(self.root, url)
+        if path is None or path in private_files(self.index_file):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        asset = self.assets[url] = StaticAsset(url, AssetBlob(path, stat.st_size), stat.st_mtime_ns)
+        return asset
+
+    def discard(self, url):
+        """Убирает запись о файле, удалённом после построения индекса"""
+        self.assets.pop(url, None)
+
+    def manifest(self):
+        """Манифест содержимого: URL -> хэш и канонический путь блоба"""
+        files = {}
+        canonical = {}
+        unique_bytes = 0
+        for url, asset in sorted(self.assets.items()):
+            blob = asset.blob
+            if blob.path not in canonical:
+                canonical[blob.path] = url
+                unique_bytes += blob.size
+            files[url] = {
+                'digest': blob.digest,
+                'size': blob.size,
+                'mimetype': asset.mimetype,
+                'canonical': canonical[blob.path]
+            }
+        total_bytes = sum(entry['size'] for entry in files.values())
+        return {
+            'files': files,
+            'fileCount': len(files),
+            'blobCount': len(canonical),
+            'totalBytes': total_bytes,
+            'uniqueBytes': unique_bytes,
+            'duplicateBytes': total_bytes - unique_bytes
+        }
+
+
+class StaticCache:
+    """LRU содержимого горячих блобов с ограничением по суммарному размеру"""
+
+    def __init__(self, max_bytes=STATIC_CACHE_BYTES, file_limit=STATIC_CACHE_FILE_LIMIT):
+        self.max_bytes = max_bytes
+        self.file_limit = min(file_limit, max_bytes)
+        self.size = 0
+        self._data = OrderedDict()  # cache_key -> bytes
+        self._lock = threading.Lock()
+
+    def get(self, body):
+        """Содержимое блоба из кэша (с загрузкой) или None для больших файлов"""
+        if body.size > self.file_limit:
+            return None
+        key = body.cache_key
+        with self._lock:
+            data = self._data.get(key)
+            if data is not None:
+                self._data.move_to_end(key)
+                metrics.static_hits.inc()
+                return data
+        metrics.static_misses.inc()
+        with open(body.path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, evicted = self._data.popitem(last=False)
+                    self.size -= len(evicted)
+        return data
+
+
+class AssetVariant:
+    """Сжатая копия блоба (gzip/br) в дисковом кэше"""
+
+    __slots__ = ('path', 'size', 'encoding', 'etag')
+
+    def __init__(self, blob, encoding, path, size):
+        self.path = str(path)
+        self.size = size
+        self.encoding = encoding
+        self.etag = f'"{blob.digest}-{encoding}"'
+
+    @property
+    def cache_key(self):
+        return self.path
+
+
+def _gzip(data):
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+# Порядок задаёт предпочтение при равном q в Accept-Encoding
+COMPRESSORS = {}
+if brotli is not None:
+    COMPRESSORS['br'] = ('br', lambda data: brotli.compress(data, quality=11))
+COMPRESSORS['gzip'] = ('gz', _gzip)
+
+
+class Precompressor:
+    """Однократное сжатие статики в дисковый кэш по хэшу содержимого
+
+    Сжатые копии переживают перезапуск: при совпадении хэша файл
+    повторно не сжимается. Сжатие не выполняется на каждый запрос -
+    только один раз на блоб (при прогреве или при первом обращении).
+    """
+
+    def __init__(self, cache_dir=COMPRESS_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+
+    def variants(self, asset):
+        """Сжатые варианты файла; пустой словарь, если сжатие не выгодно"""
+        if not asset.compressible:
+            return {}
+        blob = asset.blob
+        if blob.variants is None:
+            with self._lock:
+                if blob.variants is None:
+                    blob.variants = self._build(blob)
+        return blob.variants
+
+    def _build(self, blob):
+        variants = {}
+        data = None
+        for encoding, (suffix, compress) in COMPRESSORS.items():
+            path = self.cache_dir / f'{blob.digest}.{suffix}'
+            try:
+                size = path.stat().st_size
+            except OSError:
+                if data is None:
+                    with open(blob.path, 'rb') as f:
+                        data = f.read()
+                try:
+                    self.cache_dir.mkdir(parents=True, exist_ok=True)
+                    tmp_path = path.with_suffix(f'.{suffix}.tmp{threading.get_ident()}')
+                    tmp_path.write_bytes(compress(data))
+                    os.replace(tmp_path, path)
+                    size = path.stat().st_size
+                except OSError:
+                    continue  # каталог кэша недоступен на запись - отдаём без сжатия
+            if size < blob.size * 0.9:
+                variants[encoding] = AssetVariant(blob, encoding, path, size)
+        return variants
+
+    def warm(self, index):
+        """Сжимает всю статику индекса заранее (при старте или сборке)"""
+        started = time.perf_counter()
+        count = 0
+        for asset in list(index.assets.values()):
+            if asset.compressible:
+                count += bool(self.variants(asset))
+        return count, time.perf_counter() - started
+
+
+class AssetBundle:
+    """Собранный бандл манифеста: JSON-тело и его сжатые копии в памяти"""
+
+    __slots__ = ('data', 'etag', 'files', 'variants')
+
+    def __init__(self, data, etag, files):
+        self.data = data
+        self.etag = etag
+        self.files = files
+        self.variants = {}  # encoding -> bytes
+        for encoding, (_, compress) in COMPRESSORS.items():
+            compressed = compress(data)
+            if len(compressed) < len(data) * 0.9:
+                self.variants[encoding] = compressed
+
+
+class AssetBundles:
+    """Склейка мелких JSON/atlas ресурсов манифеста в один сжатый ответ
+
+    Игра загружает layout и атласы из манифеста по одному запросу на файл.
+    Бандл отдаёт их все сразу в виде {"./assets/...": содержимое}; JSON
+    вставляется как есть, текстовые .atlas - строкой. Бандлы собираются при
+    первом обращении и живут в памяти, как и индекс статики.
+    """
+
+    def __init__(self, index, root=GAME_ROOT, manifests=ASSET_MANIFESTS):
+        self.index = index
+        self.root = root
+        self.manifests = manifests
+        self._bundles = {}  # (manifest, variant) -> AssetBundle
+        self._links = None
+        self._lock = threading.Lock()
+
+    def _read(self, path):
+        """Содержимое файла игры по относительному пути ('./assets/...')"""
+        asset = self.index.get(f'{self.root}/{path.removeprefix("./")}')
+        if asset is None or asset.blob.size > BUNDLE_ITEM_LIMIT:
+            return None
+        data = static_cache.get(asset.blob)
+        if data is None:
+            with open(asset.blob.path, 'rb') as f:
+                data = f.read()
+        return data
+
+    def items(self, name, variant='desktop'):
+        """Относительные пути JSON/atlas ресурсов манифеста (без повторов)"""
+        data = self._read('./' + self.manifests[name])
+        if data is None:
+            return []
+        paths = []
+        for item in json_backend.loads(data).get('items', ()):
+            if item.get('type') not in BUNDLE_ITEM_TYPES:
+                continue
+            path = item.get('path')
+            if isinstance(path, dict):
+                path = path.get(variant) or path.get('desktop')
+            if not isinstance(path, str):
+                continue
+            paths.append(path)
+            if item['type'] == 'spine_atlas':
+                # pixi-spine догружает текстовый атлас рядом со скелетом
+                paths.append(os.path.splitext(path)[0] + '.atlas')
+        return list(dict.fromkeys(paths))
+
+    def get(self, name, variant='desktop'):
+        """Бандл манифеста; KeyError для неизвестного манифеста"""
+        if name not in self.manifests:
+            raise KeyError(name)
+        key = (name, variant)
+        bundle = self._bundles.get(key)
+        if bundle is None:
+            with self._lock:
+                bundle = self._bundles.get(key)
+                if bundle is None:
+                    bundle = self._bundles[key] = self._build(name, variant)
+        return bundle
+
+    def _build(self, name, variant):
+        parts = []
+        digest = hashlib.blake2b(digest_size=16)
+        for path in self.items(name, variant):
+            data = self._read(path)
+            if data is None:
+                continue
+            if path.endswith('.json'):
+                try:
+                    json_backend.loads(data)
+                except json_backend.decode_error:
+                    continue
+                value = data.strip()
+            else:
+                value = json_backend.dumps(data.decode('utf-8'))
+            parts.append(json_backend.dumps(path) + b':' + value)
+            digest.update(path.encode('utf-8'))
+            digest.update(data)
+        header = json_backend.dumps({'manifest': name, 'variant': variant})[:-1]
+        body = header + b',"files":{' + b','.join(parts) + b'}}'
+        return AssetBundle(body, f'"{digest.hexdigest()}"', len(parts))
+
+    def preload_links(self):
+        """Заголовок Link: rel=preload для поздно обнаруживаемых ресурсов стартовой страницы
+
+        Скрипты и стили index.html браузер находит сам при разборе страницы;
+        подсказка нужна только тому, что запрашивает уже выполненный код:
+        манифест PRELOAD_MANIFEST и первые его JSON/atlas ресурсы (layout идёт
+        первым). Подсказок не больше PRELOAD_LINK_LIMIT - длинный Link
+        раздувает заголовки и отнимает полосу у самих скриптов. Пути
+        разрешаются от каталога игры (/<root>/), поэтому подсказки верны и для
+        index.html, и для той же страницы, отданной на /.
+        """
+        if self._links is None:
+            base = f'/{self.root}/'
+            paths = [self.manifests[PRELOAD_MANIFEST], *self.items(PRELOAD_MANIFEST)]
+            self._links = ', '.join(
+                f'<{urllib.parse.urljoin(base, path)}>; rel=preload; as=fetch; crossorigin'
+                for path in paths[:PRELOAD_LINK_LIMIT]
+            )
+        return self._links
+
+    def warm(self):
+        """Собирает все бандлы заранее (вместе с прогревом сжатой статики)"""
+        for name in self.manifests:
+            self.get(name)
+        self.preload_links()
+
+
+static_index = StaticIndex()
+static_cache = StaticCache()
+precompressor = Precompressor()
+asset_bundles = AssetBundles(static_index)
+
+
+def negotiate_variant(asset):
+    """Лучший сжатый вариант файла по Accept-Encoding клиента"""
+    if not asset.compressible or 'HTTP_ACCEPT_ENCODING' not in request.environ:
+        return None
+    variants = precompressor.variants(asset)
+    if not variants:
+        return None
+    encoding = request.accept_encodings.best_match(list(variants))
+    return variants.get(encoding)
+
+
+def asset_response(asset):
+    """Ответ с файлом из индекса: горячие файлы из памяти, большие через sendfile
+
+    Поддерживает If-None-Match / If-Modified-Since (304 без чтения файла)
+    и Range-запросы (206) для перемотки аудио-спрайтов.
+    """
+    variant = negotiate_variant(asset)
+    body = variant or asset.blob
+    headers = {
+        'ETag': body.etag,
+        'Cache-Control': asset.cache_control
+    }
+    if asset.compressible:
+        headers['Vary'] = 'Accept-Encoding'
+    if not is_resource_modified(request.environ, body.etag, last_modified=asset.last_modified):
+        response = Response(status=304, headers=headers)
+        response.last_modified = asset.last_modified
+        return response
+    
+    if variant is not None:
+        headers['Content-Encoding'] = variant.encoding
+    data = static_cache.get(body)
+    if data is not None:
+        response = Response(data, mimetype=asset.mimetype, headers=headers)
+    else:
+        response = Response(
+            wrap_file(request.environ, open(body.path, 'rb')),
+            mimetype=asset.mimetype,
+            headers=headers,
+            direct_passthrough=True
+        )
+        response.content_length = body.size
+    response.last_modified = asset.last_modified
+    return response.make_conditional(request.environ, accept_ranges=True, complete_length=body.size)
+
+
+@app.route('/api/assets/bundle/<name>', methods=['GET'])
+def assets_bundle(name):
+    """Все JSON/atlas ресурсы манифеста одним сжатым ответом (?variant=mobile)"""
+    try:
+        bundle = asset_bundles.get(name, request.args.get('variant', 'desktop'))
+    except KeyError:
+        return jsonify({
+            'error': 'Unknown asset manifest',
+            'manifest': name,
+            'status': 404,
+            'timestamp': int(time.time())
+        }), 404
+    
+    headers = {
+        'ETag': bundle.etag,
+        'Cache-Control': f'public, max-age={STATIC_MAX_AGE}, must-revalidate',
+        'Vary': 'Accept-Encoding',
+        'X-Bundle-Files': str(bundle.files)
+    }
+    if not is_resource_modified(request.environ, bundle.etag):
+        return Response(status=304, headers=headers)
+    data = bundle.data
+    encoding = request.accept_encodings.best_match(list(bundle.variants))
+    if encoding is not None:
+        data = bundle.variants[encoding]
+        headers['Content-Encoding'] = encoding
+    return Response(data, mimetype='application/json', headers=headers)
+
+@app.route('/api/assets/manifest', methods=['GET'])
+def assets_manifest():
+    """Манифест статики с хэшами содержимого и каноническими путями"""
+    return jsonify({
+        'manifest': static_index.manifest(),
+        'status': 'success',
+        'timestamp': int(time.time())
+    })
+
 def serve_static_files(path):
     """Обслуживание статических файлов"""
-    # Проверяем существование файла с оригинальным путем
-    file_path = Path(path)
-    if file_path.exists() and file_path.is_file():
-        return send_file(str(file_path))
+    asset = static_index.get(path)
+    if asset is None:
+        # Файл мог появиться после построения индекса
+        asset = static_index.add(path)
+    if asset is not None:
+        try:
+            return asset_response(asset)
+        except FileNotFoundError:
+            # Файл удалён после построения индекса (или устаревший static_index.json)
+            static_index.discard(path)
     
-    # Если файл не найден, попробуем найти в разных местах
-    possible_paths = [
-        path,
-        f'./{path}',
-        f'../{path}'
-    ]
-    
-    for possible_path in possible_paths:
-        test_path = Path(possible_path)
-        if test_path.exists() and test_path.is_file():
-            return send_file(str(test_path))
+    # Файлы вне дерева ищем уровнем выше, как и раньше, но не за его пределами
+    test_path = contained_path(STATIC_FALLBACK_ROOT, path)
+    if test_path is not None and os.path.isfile(test_path) and test_path not in private_files():
+        return send_file(test_path)
     
     # Если файл не найден, возвращаем 404
     return jsonify({
@@ -583,6 +4858,26 @@ def serve_static_files(path):
         'status': 404
     }), 404
 
+routes.compile(VIRTUAL_HOSTS, HOST_ALIASES)
+
+DISPATCH_METHODS = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE']
+
+@app.route('/', defaults={'path': ''}, methods=DISPATCH_METHODS)
+@app.route('/<path:path>', methods=DISPATCH_METHODS)
+def dispatch(path):
+    """Единая точка входа: таблица виртуальных хостов, затем статика"""
+    route = routes.match('/' + path, request.host.split(':', 1)[0])
+    if route is not None:
+        if request.method not in route.methods:
+            raise MethodNotAllowed(valid_methods=sorted(route.methods))
+        g.route = route.pattern
+        if route.limited:
+            return call_limited(route)
+        return route.handler()
+    if request.method not in READ_METHODS:
+        raise MethodNotAllowed(valid_methods=sorted(READ_METHODS))
+    return serve_static_files(path)
+
 # ==================== ОБРАБОТКА ОШИБОК ====================
 
 @app.errorhandler(404)
@@ -594,6 +4889,24 @@ def not_found(error):
         'timestamp': int(time.time())
     }), 404
 
+@app.errorhandler(SessionConflict)
+def session_conflict(error):
+    """Обработка исчерпанных повторов оптимистичного обновления сессии"""
+    return jsonify({
+        'error': str(error),
+        'status': 409,
+        'timestamp': int(time.time())
+    }), 409
+
+@app.errorhandler(IdempotencyMismatch)
+def idempotency_mismatch(error):
+    """Повтор ключа идемпотентности с другой операцией или параметрами"""
+    return jsonify({
+        'error': str(error),
+        'status': 422,
+        'timestamp': int(time.time())
+    }), 422
+
 @app.errorhandler(500)
 def internal_error(error):
     """Обработка 500 ошибок"""
@@ -603,31 +4916,332 @@ def internal_error(error):
         'timestamp': int(time.time())
     }), 500
 
+# ==================== ASGI ====================
+
+ASGI_THREADS = int(os.getenv('MOCK_ASGI_THREADS', '32'))
+ASGI_QUEUE = int(os.getenv('MOCK_ASGI_QUEUE', '1024'))  # запросов в очереди пула сверх потоков
+ASGI_BUFFER_LIMIT = 64 * 1024  # ответы до этого размера отдаются за один переход в поток
+
+
+class WebSocketDisconnect(Exception):
+    """Клиент закрыл ASGI WebSocket соединение"""
+
+
+class AsgiWebSocket:
+    """ASGI WebSocket с интерфейсом соединения websockets (send, recv, async for)
+
+    Позволяет использовать websocket_handler без изменений как в отдельном
+    websockets-сервере, так и внутри ASGI-приложения.
+    """
+
+    def __init__(self, scope, receive, send):
+        query = scope.get('query_string', b'').decode('latin-1')
+        self.path = scope.get('path', '/') + (f'?{query}' if query else '')
+        self._receive = receive
+        self._send = send
+        self.closed = False
+
+    async def accept(self):
+        message = await self._receive()
+        if message['type'] != 'websocket.connect':
+            raise WebSocketDisconnect()
+        await self._send({'type': 'websocket.accept'})
+
+    async def recv(self):
+        message = await self._receive()
+        if message['type'] == 'websocket.disconnect':
+            self.closed = True
+            raise WebSocketDisconnect()
+        text = message.get('text')
+        return text if text is not None else message.get('bytes')
+
+    async def send(self, data):
+        if self.closed:
+            raise WebSocketDisconnect()
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            await self._send({'type': 'websocket.send', 'bytes': bytes(data)})
+        else:
+            await self._send({'type': 'websocket.send', 'text': data})
+
+    async def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            await self._send({'type': 'websocket.close', 'code': code})
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except WebSocketDisconnect:
+            raise StopAsyncIteration
+
+
+class AsgiApp:
+    """ASGI-приложение: HTTP-маршруты Flask и WebSocket-протокол на одном порту
+
+    Flask-обработчики выполняются в ограниченном пуле потоков, WebSocket
+    соединения обслуживаются корутинами на event loop воркера. Когда очередь
+    пула переполнена, HTTP-запрос получает 503 прямо на event loop.
+    on_startup выполняется в пуле по lifespan.startup - в том экземпляре
+    модуля, который обслуживает запросы (uvicorn импортирует его заново).
+    """
+
+    def __init__(self, wsgi_app, ws_handler, threads=ASGI_THREADS, queue=ASGI_QUEUE, on_startup=None):
+        self.wsgi_app = wsgi_app
+        self.ws_handler = ws_handler
+        self.on_startup = on_startup
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.max_pending = threads + queue
+        self.pending = 0  # меняется только на event loop
+
+    async def __call__(self, scope, receive, send):
+        kind = scope['type']
+        if kind == 'http':
+            await self._http(scope, receive, send)
+        elif kind == 'websocket':
+            websocket = AsgiWebSocket(scope, receive, send)
+            try:
+                await websocket.accept()
+            except WebSocketDisconnect:
+                return
+            await self.ws_handler(websocket, websocket.path)
+            await websocket.close()
+        elif kind == 'lifespan':
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.on_startup is not None:
+                    try:
+                        await asyncio.get_running_loop().run_in_executor(self.executor, self.on_startup)
+                    except Exception:
+                        log.exception('Ошибка подготовки сервера, статика загрузится при первом обращении')
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _environ(scope, body):
+        """WSGI environ из ASGI scope"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        path = scope.get('raw_path') or scope['path'].encode('utf-8')
+        path = path.split(b'?', 1)[0].decode('latin-1')
+        root_path = scope.get('root_path', '')
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path,
+            'PATH_INFO': path[len(root_path):] if root_path and path.startswith(root_path) else path,
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'CONTENT_LENGTH': str(len(body)),
+        }
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').upper().replace('-', '_')
+            value = raw_value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def _run_wsgi(self, environ):
+        """Выполняет Flask-запрос в потоке; небольшие ответы сразу буферизуются"""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers
+            ]
+            return lambda data: None
+
+        result = self.wsgi_app(environ, start_response)
+        length = next((v for n, v in response['headers'] if n == b'content-length'), None)
+        if length is not None and int(length) <= ASGI_BUFFER_LIMIT:
+            try:
+                response['body'] = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            return response, None
+        return response, result
+
+    async def _http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        if self.pending >= self.max_pending:
+            metrics.shed.inc()
+            await send({
+                'type': 'http.response.start',
+                'status': 503,
+                'headers': [(b'content-type', b'application/json'), (b'retry-after', b'1')]
+            })
+            await send({'type': 'http.response.body', 'body': json_backend.dumps({
+                'error': 'Server is overloaded',
+                'status': 503,
+                'timestamp': int(time.time())
+            })})
+            return
+
+        loop = asyncio.get_running_loop()
+        environ = self._environ(scope, bytes(body))
+        self.pending += 1
+        try:
+            response, result = await loop.run_in_executor(self.executor, self._run_wsgi, environ)
+        finally:
+            self.pending -= 1
+        await send({
+            'type': 'http.response.start',
+            'status': response['status'],
+            'headers': response['headers']
+        })
+        if result is None:
+            await send({'type': 'http.response.body', 'body': response['body']})
+            return
+
+        # Потоковый ответ (файлы, NDJSON симуляции) читается по частям в пуле потоков
+        iterator = iter(result)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+asgi_app = AsgiApp(app, websocket_handler)
+startup.mark('app_setup')
+
 # ==================== ЗАПУСК СЕРВЕРА ====================
 
 # Для Vercel - экспортируем app
 # Vercel будет автоматически использовать переменную app
+# Для ASGI-серверов - asgi_app, например:
+#   uvicorn mock_server_flask:asgi_app --workers 4
+
+def create_app(preload=False):
+    """Фабрика приложения для WSGI и serverless окружений
+
+    Модуль при импорте не строит индекс статики и не загружает WebSocket-стек;
+    индекс строится при первом обращении к статике или сразу при preload=True
+    (долгоживущий сервер). Разбивка холодного старта - /debug/startup и /metrics.
+    """
+    if preload:
+        static_index.assets
+    log_event(logging.INFO, 'Приложение готово', **startup.report()['phases'])
+    return app
+
+
+def prepare_server():
+    """Подготовка долгоживущего сервера (Flask или lifespan ASGI)
+
+    Индекс статики строится сразу; кэш сжатой статики и бандлы манифестов
+    прогреваются в фоне, чтобы первые запросы не ждали сжатия.
+    """
+    create_app(preload=True)
+    threading.Thread(target=precompressor.warm, args=(static_index,), daemon=True).start()
+    threading.Thread(target=asset_bundles.warm, daemon=True).start()
+
+
+asgi_app.on_startup = prepare_server
+
+
+def parse_args():
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description='Мок сервер Banana Bonanza')
+    parser.add_argument('--asgi', action='store_true',
+                        help='HTTP и WebSocket на одном порту через uvicorn')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='число процессов uvicorn в режиме --asgi')
+    parser.add_argument('--precompress', action='store_true',
+                        help='сжать статику (gzip/br) в дисковый кэш и выйти')
+    parser.add_argument('--build-index', action='store_true',
+                        help=f'сохранить индекс статики в {STATIC_INDEX_FILE} и выйти')
+    parser.add_argument('--capture', metavar='PATH', default=CAPTURE_FILE or None,
+                        help='дописывать входящий трафик в файл для replay.py (MOCK_CAPTURE)')
+    return parser.parse_args()
 
 if __name__ == '__main__':
-    print("🎮 Запуск Flask мок сервера для Banana Bonanza")
-    print("🌐 HTTP сервер: http://localhost:5000")
-    print("🔌 WebSocket сервер: ws://localhost:5001")
-    print("📁 Убедитесь, что все файлы игры находятся в текущей папке")
-    print("🔄 Service Worker (sw.js) автоматически перехватывает все запросы")
-    print("📊 Полный набор API эндпоинтов включен")
-    print("\nДоступные API эндпоинты:")
-    print("  • /api/token - Получение токена")
-    print("  • /api/game/balance - Баланс игрока")
-    print("  • /api/game/spin - Игровой спин")
-    print("  • /api/game/enter - Вход в игру")
-    print("  • /api/game/cashout - Вывод средств")
-    print("  • /api/game/leave - Выход из игры")
-    print("  • /api/game/history - История игр")
-    print("  • /api/game/settings - Настройки игры")
-    print("  • /api/game/statistics - Статистика")
-    print("  • /frontendService/gameVoteData - Данные голосования")
-    print("  • /api.playzia.staging.hizi-service.com/gameapi/v2/* - Playzia API v2")
-    print("\nНажмите Ctrl+C для остановки сервера")
+    args = parse_args()
+    if args.build_index:
+        count = static_index.save()
+        log_event(logging.INFO, 'Индекс статики сохранён', files=count, path=static_index.index_file)
+        sys.exit(0)
+    if args.precompress:
+        count, elapsed = precompressor.warm(static_index)
+        log_event(logging.INFO, 'Статика сжата', files=count, seconds=round(elapsed, 2),
+                  cache_dir=str(precompressor.cache_dir))
+        sys.exit(0)
+    
+    # Несколько воркеров uvicorn импортируют модуль заново - им нужен не этот экземпляр
+    spawn_workers = args.asgi and args.workers > 1
+    if args.capture and traffic_capture is None:
+        # Воркеры включают запись по переменной окружения
+        os.environ['MOCK_CAPTURE'] = args.capture
+        if not spawn_workers:
+            traffic_capture = TrafficCapture(args.capture)
+    if args.capture:
+        log_event(logging.INFO, 'Запись трафика включена', path=args.capture)
+    
+    if args.asgi:
+        import uvicorn
+        log_event(logging.INFO, 'Запуск ASGI мок сервера для Banana Bonanza',
+                  http=f'http://localhost:{args.port}', websocket=f'ws://localhost:{args.port}')
+        # Подготовка (prepare_server) идёт в lifespan того модуля, который обслуживает запросы
+        if spawn_workers:
+            # Воркеры запускает CLI uvicorn: иначе spawn-воркеры импортируют и этот скрипт
+            # (__mp_main__), и модуль приложения - второй импорт выглядит тёплым в /debug/startup
+            import subprocess
+            sys.exit(subprocess.call([
+                sys.executable, '-m', 'uvicorn', 'mock_server_flask:asgi_app',
+                '--app-dir', os.path.dirname(os.path.abspath(__file__)),
+                '--host', args.host, '--port', str(args.port),
+                '--workers', str(args.workers), '--log-level', 'warning'
+            ]))
+        uvicorn.run(asgi_app, host=args.host, port=args.port, log_level='warning')
+        sys.exit(0)
+    
+    prepare_server()
+    
+    log_event(logging.INFO, 'Запуск Flask мок сервера для Banana Bonanza',
+              http=f'http://localhost:{args.port}', websocket='ws://localhost:5001',
+              metrics=f'http://localhost:{args.port}/metrics')
     
     # Запускаем WebSocket сервер в отдельном потоке (только для локального запуска)
     if os.getenv('VERCEL') is None:  # Не запускаем WebSocket на Vercel
@@ -635,4 +5249,4 @@ if __name__ == '__main__':
         ws_thread.start()
     
     # Запускаем Flask сервер
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host=args.host, port=args.port, debug=True)
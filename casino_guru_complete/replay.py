@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Повтор записанного трафика против мок сервера Banana Bonanza
+
+Запись включается на сервере (--capture или MOCK_CAPTURE): каждый HTTP запрос
+и WebSocket кадр дописывается строкой JSON с отметкой времени и сессией.
+Прогон разбивает запись на потоки - запросы одной сессии и кадры одного
+WebSocket соединения идут по порядку, потоки идут одновременно - и гонит их
+через ASGI-приложение в том же процессе, как benchmark.py. Темп задаётся
+--speed: 1 - как при записи, N - в N раз быстрее, 0 - без пауз. --players N
+размножает запись на N виртуальных игроков с собственными token и sessionId. Отчёт
+совместим с benchmark.py: --output сохраняет его, --compare печатает
+дельты throughput и p99 к прошлому прогону.
+
+    python mock_server_flask.py --capture traffic.jsonl
+    python replay.py traffic.jsonl --speed 1 --output replay.json
+    python replay.py traffic.jsonl --speed 0 --players 50 --compare replay.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import platform
+import sys
+import time
+import urllib.parse
+from collections import defaultdict
+
+import mock_server_flask as server
+from benchmark import (
+    AsgiClient, Recorder, _connected, compare, peak_rss_kb, percentile, print_report, rss_kb
+)
+
+NO_SESSION = '-'
+
+
+def load_capture(path, max_gap):
+    """Записи файла трафика по времени; паузы длиннее max_gap секунд сжимаются до max_gap
+
+    Файл дописывается несколькими воркерами и запусками, поэтому строки
+    сортируются по t, а оборванная последняя строка пропускается.
+    """
+    records = []
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    records.sort(key=lambda record: record['t'])
+    offset = 0.0
+    previous = records[0]['t'] if records else 0.0
+    for record in records:
+        offset += min(record['t'] - previous, max_gap)
+        previous = record['t']
+        record['t'] = offset
+    return records
+
+
+def split_streams(records):
+    """Потоки прогона: HTTP запросы по сессиям и кадры по WebSocket соединениям"""
+    streams = defaultdict(list)
+    for record in records:
+        if record['k'] == 'http':
+            streams[('http', record.get('s') or NO_SESSION)].append(record)
+        else:
+            streams[('ws', record['c'])].append(record)
+    return streams
+
+
+class VirtualPlayer:
+    """Подмена токенов и sessionId записи на собственные виртуального игрока
+
+    Переписываются только поля, по которым сервер находит сессию: заголовки
+    X-Session-Token / X-Session-Id, параметры token / sessionId query-строки
+    и одноимённые поля JSON тела или WebSocket сообщения - остальной текст
+    запроса не трогается. Сессии с записанным sessionId заводятся на сервере
+    при первой встрече: sessionId выдаёт /api/game/enter, и без этого запрос
+    только с sessionId попал бы в сессию по умолчанию.
+    """
+
+    HEADERS = {'x-session-token': 'token', 'x-session-id': 'sessionId'}
+
+    def __init__(self, index, players):
+        self.suffix = f'~vp{index}' if players > 1 else ''
+        self._session_ids = {}  # sessionId записи -> sessionId игрока
+
+    def rename_value(self, field, value):
+        """Значение поля token или sessionId для этого игрока"""
+        if not isinstance(value, str) or not value:
+            return value
+        if field == 'token':
+            return value + self.suffix
+        renamed = self._session_ids.get(value)
+        if renamed is None:
+            renamed = self._session_ids[value] = value + self.suffix
+            if server.sessions.find_by_session_id(renamed) is None:
+                # Сервер называет новую сессию session_<token>: тот же токен найдёт её и без sessionId
+                token = renamed.removeprefix('session_') if renamed.startswith('session_') else f'replay:{renamed}'
+                server.sessions.get_or_create(token, renamed)
+        return renamed
+
+    def rename_headers(self, headers):
+        return {
+            name: self.rename_value(self.HEADERS[name.lower()], value) if name.lower() in self.HEADERS else value
+            for name, value in headers.items()
+        }
+
+    def rename_path(self, path):
+        """Путь с переписанными параметрами token / sessionId"""
+        parts = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if not any(name in ('token', 'sessionId') for name, _ in query):
+            return path
+        query = [
+            (name, self.rename_value(name, value) if name in ('token', 'sessionId') else value)
+            for name, value in query
+        ]
+        return urllib.parse.urlunsplit(('', '', parts.path, urllib.parse.urlencode(query), ''))
+
+    def rename_message(self, message):
+        """JSON значение с переписанными полями token / sessionId (и в пачках сообщений)"""
+        if isinstance(message, list):
+            return [self.rename_message(item) for item in message]
+        if not isinstance(message, dict):
+            return message
+        renamed = dict(message)
+        for name in ('token', 'sessionId'):
+            if name in renamed:
+                renamed[name] = self.rename_value(name, renamed[name])
+        if isinstance(renamed.get('messages'), list):
+            renamed['messages'] = self.rename_message(renamed['messages'])
+        return renamed
+
+    def rename_body(self, body):
+        """Тело запроса: JSON объект переписывается, любое другое остаётся как есть"""
+        if not body:
+            return body
+        try:
+            message = json.loads(body)
+        except ValueError:
+            return body
+        renamed = self.rename_message(message)
+        return json.dumps(renamed) if renamed != message else body
+
+    def session(self, session):
+        """Токен виртуального игрока для запросов без сессии в записи"""
+        if not self.suffix or (session and session != NO_SESSION):
+            return None
+        return 'replay' + self.suffix
+
+
+class ReplayClock:
+    """Расписание прогона: offset записи -> момент отправки с учётом скорости"""
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.started = None
+        self.lag = []  # опоздание отправки относительно расписания, с
+
+    async def wait(self, offset):
+        if not self.speed:
+            return
+        loop = asyncio.get_running_loop()
+        delay = self.started + offset / self.speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.lag.append(max(0.0, -delay))
+
+
+def _endpoint(record):
+    return f"{record['m']} {record.get('r') or 'static'}"
+
+
+async def _http_call(client, record, path, body, headers):
+    ok, data = await client.request(record['m'], path, body, headers)
+    # Успех - тот же класс ответа, что при записи (записанный 404 остаётся 404)
+    return ok == (200 <= record['st'] < 400), data
+
+
+async def replay_http(client, recorder, clock, player, session, records):
+    """Запросы одной сессии по порядку записи"""
+    extra = player.session(session)
+    for record in records:
+        await clock.wait(record['t'])
+        headers = [(b'host', record.get('host', 'benchmark').encode('latin-1'))]
+        for name, value in player.rename_headers(record.get('h', {})).items():
+            headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+        if extra is not None:
+            headers.append((b'x-session-token', extra.encode()))
+        if 'b64' in record:
+            body = base64.b64decode(record['b64'])
+        else:
+            body = player.rename_body(record.get('b', '')).encode('utf-8')
+        path = player.rename_path(record['p'])
+        await recorder.measure(_endpoint(record), _http_call(client, record, path, body, headers))
+
+
+def _json_path(path):
+    """Путь подключения без ?encoding=: прогон читает ответы как JSON"""
+    parts = urllib.parse.urlsplit(path)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k != 'encoding']
+    return urllib.parse.urlunsplit(('', '', parts.path, urllib.parse.urlencode(query), ''))
+
+
+def _tag(message, request_id):
+    """Сообщение с id для сопоставления ответа; hello переключается на JSON"""
+    if not isinstance(message, dict):
+        return message, None
+    if message.get('type') == 'hello':
+        message['encoding'] = 'json'
+    message.setdefault('id', request_id)
+    return message, message['id']
+
+
+async def _reply(socket, request_id):
+    """Ответ на кадр: сообщение или пачка, последний элемент которой имеет request_id"""
+    while True:
+        frame = await socket.outbound.get()
+        if frame is None:
+            return False, None
+        message = json.loads(frame)
+        last = message[-1] if isinstance(message, list) and message else message
+        if isinstance(last, dict) and last.get('id') == request_id:
+            if isinstance(message, list):
+                return all(item.get('type') != 'error' for item in message if isinstance(item, dict)), message
+            return message.get('type') != 'error', message
+
+
+async def replay_socket(client, recorder, clock, player, connection, records):
+    """Кадры одного WebSocket соединения по порядку записи"""
+    socket = None
+    for n, record in enumerate(records):
+        await clock.wait(record['t'])
+        session = record.get('s')
+        if record['k'] == 'ws_close':
+            break
+        if socket is None:
+            path = record['p'] if record['k'] == 'ws_open' else f'/ws?token={session}'
+            socket = client.websocket(player.rename_path(_json_path(path)))
+            ok, _ = await recorder.measure('WS connect', _connected(socket.connect()))
+            if not ok:
+                return
+            if record['k'] == 'ws_open':
+                continue
+        message = player.rename_message(record['m'])
+        if isinstance(message, list):
+            items = [_tag(item, f'replay-{n}-{i}')[0] for i, item in enumerate(message)]
+            request_id = items[-1].get('id') if items and isinstance(items[-1], dict) else None
+            name = 'WS batch'
+        else:
+            message, request_id = _tag(message, f'replay-{n}')
+            name = f"WS {message.get('type', 'unknown')}" if isinstance(message, dict) else 'WS text'
+        if request_id is None:
+            await socket.send(message)
+            continue
+        await recorder.measure(name, _send_and_reply(socket, message, request_id))
+    if socket is not None:
+        await socket.close()
+
+
+async def _send_and_reply(socket, message, request_id):
+    await socket.send(message)
+    return await _reply(socket, request_id)
+
+
+async def run(args):
+    """Один прогон записи; возвращает отчёт в формате benchmark.py"""
+    records = load_capture(args.capture, args.max_gap)
+    streams = split_streams(records)
+    client = AsgiClient(server.asgi_app)
+    recorder = Recorder()
+    clock = ReplayClock(args.speed)
+    rss_start = rss_kb()
+    # Прогон меряет сервер на записанной нагрузке, а не лимит сессии
+    server.rate_limiter.rate = args.rate_limit
+    tasks = []
+    for index in range(args.players):
+        player = VirtualPlayer(index, args.players)
+        for (kind, key), stream in streams.items():
+            if kind == 'http':
+                tasks.append(replay_http(client, recorder, clock, player, key, stream))
+            else:
+                tasks.append(replay_socket(client, recorder, clock, player, key, stream))
+    clock.started = asyncio.get_running_loop().time()
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    server.crash_engine.stop()
+    endpoints = {name: stats.summary(elapsed) for name, stats in sorted(recorder.endpoints.items())}
+    total = sum(stats['count'] for stats in endpoints.values())
+    lag = sorted(clock.lag)
+    return {
+        'meta': {
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'json_backend': server.json_backend.name,
+            'session_backend': server.SESSION_BACKEND,
+            'asgi_threads': server.ASGI_THREADS,
+            'capture': args.capture,
+            'records': len(records),
+            'streams': len(streams),
+            'captured_s': round(records[-1]['t'], 3) if records else 0.0,
+            'speed': args.speed,
+            'players': args.players,
+            'rate_limit': args.rate_limit,
+            'schedule_lag_p99_ms': round(percentile(lag, 0.99) * 1000, 3)
+        },
+        'elapsed_s': round(elapsed, 3),
+        'requests': total,
+        'throughput': round(total / elapsed, 1) if elapsed else 0.0,
+        'rss_kb': {'start': rss_start, 'end': rss_kb(), 'peak': peak_rss_kb()},
+        'endpoints': endpoints
+    }
+
+
+def parse_args():
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description='Повтор записанного трафика мок сервера Banana Bonanza')
+    parser.add_argument('capture', help='файл записи (mock_server_flask.py --capture)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='темп: 1 - как при записи, N - в N раз быстрее, 0 - без пауз')
+    parser.add_argument('--players', type=int, default=1,
+                        help='виртуальных игроков: запись повторяется N раз с разными токенами')
+    parser.add_argument('--max-gap', type=float, default=5.0,
+                        help='паузы записи длиннее N секунд сжимаются до N')
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help='лимит запросов сессии в секунду (0 - без лимита)')
+    parser.add_argument('--output', help='сохранить отчёт в JSON')
+    parser.add_argument('--compare', help='JSON отчёт прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='допуск регрессии throughput/p99, %%')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='код возврата 1 при регрессии')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.run(run(args))
+    meta = report['meta']
+    print(f"Запись: {meta['records']} записей, {meta['streams']} потоков, {meta['captured_s']} с; "
+          f"скорость {meta['speed'] or 'макс'}, игроков {meta['players']}, "
+          f"опоздание p99 {meta['schedule_lag_p99_ms']} мс")
+    print_report(report)
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nОтчёт сохранён: {args.output}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,34 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_server_flask as server  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    """Тесты гоняют много запросов одной сессии подряд - лимит сессии им не нужен"""
+    monkeypatch.setattr(server.rate_limiter, 'rate', 0)
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+@pytest.fixture
+def token():
+    """Свежий токен: у каждого теста своя сессия в общем хранилище модуля"""
+    return f'test-{uuid.uuid4().hex}'
+
+
+def first_round(model, bet, win, seed_from=1):
+    """Seed, при котором первый раунд модели выигрывает (win=True) или проигрывает"""
+    for seed in range(seed_from, seed_from + 10000):
+        if (server.play_round(model, seed, 1, bet)['win'] > 0) == win:
+            return seed
+    raise AssertionError('no suitable seed')
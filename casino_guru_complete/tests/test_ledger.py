@@ -0,0 +1,107 @@
+import pytest
+
+import mock_server_flask as server
+from conftest import first_round
+
+
+def enter(client, token, win):
+    """Сессия с uniform-моделью и seed, при котором первый спин выигрывает или проигрывает"""
+    model = server.get_outcome_model('uniform')
+    seed = first_round(model, 1.0, win)
+    response = client.post(f'/api/game/enter?token={token}', json={'seed': seed, 'model': 'uniform'})
+    assert response.status_code == 200
+    return server.play_round(model, seed, 1, 1.0)
+
+
+def spin(client, token, bet=1.0, key=None):
+    headers = {'Idempotency-Key': key} if key else {}
+    return client.post(f'/api/game/spin?token={token}', json={'bet': bet}, headers=headers)
+
+
+def test_spin_debits_bet_and_keeps_win_pending(client, token):
+    expected = enter(client, token, win=True)
+    data = spin(client, token).get_json()
+    assert data['balance'] == server.DEFAULT_BALANCE - 1.0
+    assert data['pendingWin'] == expected['win'] > 0
+    session = server.sessions.get_or_create(token)
+    assert session.balance == server.DEFAULT_BALANCE - 1.0
+    assert session.pending_win == expected['win']
+    assert session.active_round == 1
+
+
+def test_next_spin_credits_pending_win(client, token):
+    expected = enter(client, token, win=True)
+    spin(client, token)
+    data = spin(client, token).get_json()
+    assert data['balance'] == round(server.DEFAULT_BALANCE - 1.0 + expected['win'] - 1.0, 2)
+
+
+def test_cashout_moves_pending_win_to_balance(client, token):
+    expected = enter(client, token, win=True)
+    spin(client, token)
+    data = client.post(f'/api/game/cashout?token={token}').get_json()
+    assert data['round'] == 1
+    assert data['amount'] == expected['win']
+    assert data['balance'] == round(server.DEFAULT_BALANCE - 1.0 + expected['win'], 2)
+    session = server.sessions.get_or_create(token)
+    assert (session.pending_win, session.active_round) == (0.0, 0)
+
+
+def test_cashout_after_losing_spin_is_noop(client, token):
+    enter(client, token, win=False)
+    spin(client, token)
+    cashouts = server.metrics.cashouts.value
+    data = client.post(f'/api/game/cashout?token={token}').get_json()
+    assert (data['round'], data['amount']) == (None, 0.0)
+    assert data['balance'] == server.DEFAULT_BALANCE - 1.0
+    assert server.metrics.cashouts.value == cashouts
+
+
+def test_insufficient_balance(client, token):
+    session = server.sessions.get_or_create(token)
+    server.sessions.transact(session, lambda session: ({'balance': 0.5}, None, None))
+    response = spin(client, token)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'insufficient balance'
+
+
+def test_idempotent_spin_replay_returns_first_result(client, token):
+    first = spin(client, token, key='spin-1').get_json()
+    again = spin(client, token, key='spin-1').get_json()
+    assert again == first
+    session = server.sessions.get_or_create(token)
+    assert session.total_spins == 1
+    assert session.balance == server.DEFAULT_BALANCE - 1.0
+
+
+def test_idempotent_cashout_replay_pays_once(client, token):
+    enter(client, token, win=True)
+    spin(client, token)
+    first = client.post(f'/api/game/cashout?token={token}', headers={'Idempotency-Key': 'out-1'}).get_json()
+    again = client.post(f'/api/game/cashout?token={token}', headers={'Idempotency-Key': 'out-1'}).get_json()
+    assert again['balance'] == first['balance']
+    assert server.sessions.get_or_create(token).balance == first['balance']
+
+
+@pytest.mark.parametrize('other', [
+    lambda client, token: spin(client, token, bet=2.0, key='key-1'),
+    lambda client, token: client.post(f'/api/game/cashout?token={token}', headers={'Idempotency-Key': 'key-1'}),
+])
+def test_idempotency_key_reused_for_other_request(client, token, other):
+    spin(client, token, key='key-1')
+    response = other(client, token)
+    assert response.status_code == 422
+    assert server.sessions.get_or_create(token).total_spins == 1
+
+
+def test_idempotency_receipt_is_shared_between_workers(tmp_path, token):
+    path = str(tmp_path / 'shared.db')
+    stores = [server.SessionStore(backend=server.SqliteSessionBackend(path)) for _ in range(2)]
+    step = lambda session: ({'balance': session.balance - 1.0}, None, {'balance': session.balance - 1.0})
+    first, applied = stores[0].transact(stores[0].get_or_create(token), step, 'key-1', ('debit',))
+    again, replayed = stores[1].transact(stores[1].get_or_create(token), step, 'key-1', ('debit',))
+    assert (applied, replayed) == (True, False)
+    assert again == first
+    assert stores[1].get_or_create(token).balance == server.DEFAULT_BALANCE - 1.0
+    with pytest.raises(server.IdempotencyMismatch):
+        stores[1].transact(stores[1].get_or_create(token), step, 'key-1', ('credit',))
@@ -0,0 +1,87 @@
+import pytest
+
+import mock_server_flask as server
+
+
+def debit(amount):
+    def step(session):
+        balance = session.balance - amount
+        return {'balance': balance}, None, balance
+    return step
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_cas_conflict_rereads_session_and_retries(tmp_path, token, shared):
+    if shared:
+        path = str(tmp_path / 'shared.db')
+        mine = server.SessionStore(backend=server.SqliteSessionBackend(path))
+        other = server.SessionStore(backend=server.SqliteSessionBackend(path))
+    else:
+        mine, other = server.SessionStore(), None
+    session = mine.get_or_create(token)
+    # Сессию меняют в обход этого экземпляра: версия в памяти устарела
+    if other is not None:
+        other.transact(other.get_or_create(token), debit(100.0))
+    else:
+        assert mine.backend.compare_and_set(token, session.version, {'balance': session.balance - 100.0})
+    calls = []
+
+    def step(session):
+        calls.append(session.balance)
+        return debit(1.0)(session)
+
+    balance, applied = mine.transact(session, step)
+    assert applied
+    assert calls == [server.DEFAULT_BALANCE, server.DEFAULT_BALANCE - 100.0]
+    assert balance == session.balance == server.DEFAULT_BALANCE - 101.0
+    assert mine.backend.load(token=token)[1]['balance'] == server.DEFAULT_BALANCE - 101.0
+
+
+def test_cas_gives_up_after_retries(monkeypatch, token):
+    store = server.SessionStore()
+    session = store.get_or_create(token)
+    monkeypatch.setattr(store.backend, 'compare_and_set', lambda *args, **kwargs: None)
+    with pytest.raises(server.SessionConflict):
+        store.transact(session, debit(1.0))
+    assert session.balance == server.DEFAULT_BALANCE
+
+
+def test_conflict_maps_to_409(client, token, monkeypatch):
+    client.post(f'/api/game/enter?token={token}')
+    monkeypatch.setattr(server.sessions.backend, 'compare_and_set', lambda *args, **kwargs: None)
+    response = client.post(f'/api/game/spin?token={token}', json={'bet': 1.0})
+    assert response.status_code == 409
+
+
+def history(client, token, **params):
+    query = ''.join(f'&{name}={value}' for name, value in params.items())
+    return client.get(f'/api/game/history?token={token}{query}').get_json()
+
+
+def test_history_pages_newest_first_with_cursor(client, token):
+    for _ in range(7):
+        client.post(f'/api/game/spin?token={token}', json={'bet': 1.0})
+    page = history(client, token, limit=3)
+    assert [entry['round'] for entry in page['history']] == [7, 6, 5]
+    assert page['latest'] == 7
+    page = history(client, token, limit=3, cursor=page['nextCursor'])
+    assert [entry['round'] for entry in page['history']] == [4, 3, 2]
+    page = history(client, token, limit=3, cursor=page['nextCursor'])
+    assert [entry['round'] for entry in page['history']] == [1]
+    assert page['nextCursor'] is None
+
+
+def test_history_since_returns_only_newer_rounds(client, token):
+    for _ in range(5):
+        client.post(f'/api/game/spin?token={token}', json={'bet': 1.0})
+    page = history(client, token, since=3)
+    assert [entry['round'] for entry in page['history']] == [5, 4]
+    assert page['nextCursor'] is None
+
+
+def test_history_keeps_only_depth(client, token):
+    session = server.sessions.get_or_create(token)
+    for _ in range(server.HISTORY_DEPTH + 5):
+        server.generate_game_result(session)
+    rounds = [entry['round'] for entry in history(client, token, limit=server.HISTORY_PAGE_MAX)['history']]
+    assert rounds == list(range(server.HISTORY_DEPTH + 5, 5, -1))
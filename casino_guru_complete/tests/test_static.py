@@ -0,0 +1,88 @@
+import pytest
+
+import mock_server_flask as server
+
+CONTENT = bytes(range(256)) * 16  # 4 КБ, не сжимается
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """Отдельное дерево статики с индексом и кэшем"""
+    root = tmp_path / 'site'
+    (root / 'sounds').mkdir(parents=True)
+    (root / 'sounds' / 'sprite.bin').write_bytes(CONTENT)
+    (tmp_path / 'outside.txt').write_text('secret')
+    monkeypatch.setattr(server, 'static_index', server.StaticIndex(root, str(tmp_path / 'index.json')))
+    monkeypatch.setattr(server, 'static_cache', server.StaticCache())
+    monkeypatch.setattr(server, 'STATIC_FALLBACK_ROOT', root)
+    return root
+
+
+@pytest.fixture(params=['memory', 'sendfile'])
+def served(request, tree, monkeypatch):
+    """Файл из кэша в памяти и файл, отдаваемый потоком с диска"""
+    if request.param == 'sendfile':
+        monkeypatch.setattr(server, 'static_cache', server.StaticCache(file_limit=1024))
+    return '/sounds/sprite.bin'
+
+
+def test_full_response_has_validators(client, served):
+    response = client.get(served)
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.headers['ETag'] == server.static_index.get(served[1:]).etag
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'Last-Modified' in response.headers
+
+
+def test_matching_etag_gives_304(client, served):
+    etag = client.get(served).headers['ETag']
+    response = client.get(served, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+
+def test_stale_etag_gives_full_body(client, served):
+    response = client.get(served, headers={'If-None-Match': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+
+def test_if_modified_since_gives_304(client, served):
+    last_modified = client.get(served).headers['Last-Modified']
+    assert client.get(served, headers={'If-Modified-Since': last_modified}).status_code == 304
+
+
+def test_range_request(client, served):
+    response = client.get(served, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(CONTENT)}'
+
+
+def test_unsatisfiable_range(client, served):
+    response = client.get(served, headers={'Range': f'bytes={len(CONTENT) + 10}-'})
+    assert response.status_code == 416
+
+
+def test_file_added_after_index_is_served(client, tree):
+    assert client.get('/sounds/sprite.bin').status_code == 200
+    (tree / 'late.txt').write_text('late')
+    response = client.get('/late.txt')
+    assert response.status_code == 200
+    assert response.data == b'late'
+
+
+def test_deleted_file_gives_404(client, tree):
+    assert client.get('/sounds/sprite.bin').status_code == 200
+    (tree / 'sounds' / 'sprite.bin').unlink()
+    server.static_cache._data.clear()
+    assert client.get('/sounds/sprite.bin').status_code == 404
+    assert server.static_index.get('sounds/sprite.bin') is None
+
+
+@pytest.mark.parametrize('path', ['/../outside.txt', '/sounds/../../outside.txt'])
+def test_paths_outside_root_are_not_served(client, tree, path):
+    assert client.get(path).status_code == 404
+    assert not any('outside' in url for url in server.static_index.assets)
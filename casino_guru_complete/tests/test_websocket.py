@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import mock_server_flask as server
+from benchmark import AsgiClient
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+async def connect(path='/ws'):
+    socket = AsgiClient(server.asgi_app).websocket(path)
+    welcome = await socket.connect()
+    assert welcome['type'] == 'connection'
+    return socket
+
+
+async def frame(socket):
+    return json.loads(await socket.outbound.get())
+
+
+def test_batch_replies_in_one_frame_in_order():
+    async def scenario():
+        socket = await connect()
+        await socket.send([{'type': 'ping', 'id': 'a'}, {'type': 'test', 'id': 'b', 'message': 'x'}, {'type': 'ping'}])
+        reply = await frame(socket)
+        await socket.close()
+        return reply
+
+    reply = run(scenario())
+    assert isinstance(reply, list)
+    assert [item['type'] for item in reply] == ['pong', 'test_response', 'pong']
+    assert [item.get('id') for item in reply] == ['a', 'b', None]
+
+
+def test_batch_envelope_is_same_as_array():
+    async def scenario():
+        socket = await connect()
+        await socket.send({'type': 'batch', 'messages': [{'type': 'ping', 'id': 1}, {'type': 'ping', 'id': 2}]})
+        reply = await frame(socket)
+        await socket.close()
+        return reply
+
+    assert [item['id'] for item in run(scenario())] == [1, 2]
+
+
+def test_oversized_batch_is_rejected():
+    async def scenario():
+        socket = await connect()
+        await socket.send([{'type': 'ping'}] * (server.WS_MAX_BATCH + 1))
+        reply = await frame(socket)
+        await socket.close()
+        return reply
+
+    reply = run(scenario())
+    assert reply['type'] == 'error'
+    assert 'Batch too large' in reply['message']
+
+
+def test_spin_pushes_round_and_balance_to_subscriber(token):
+    async def scenario():
+        socket = await connect(f'/ws?token={token}')
+        await socket.send({'type': 'game_action', 'action': 'spin', 'bet': 1.0, 'token': token, 'id': 's'})
+        # Push-события могут обогнать ответ на сам спин
+        reply, events = None, []
+        while reply is None or len(events) < 2:
+            message = await frame(socket)
+            if message.get('id') == 's':
+                reply = message
+            else:
+                events.extend(message['events'] if message.get('type') == 'events' else [message])
+        await socket.close()
+        return reply, events
+
+    reply, events = run(scenario())
+    assert reply['type'] == 'game_response' and reply['data']['round'] == 1
+    kinds = {event['type']: event for event in events}
+    assert kinds['round']['round'] == 1
+    assert kinds['balance']['balance'] == reply['data']['balance']
+
+
+def test_coalesced_pushes_use_events_envelope():
+    async def scenario():
+        subscriber = server.Subscriber(asyncio.get_running_loop())
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        pump = asyncio.ensure_future(subscriber.pump(send))
+        subscriber.push({'type': 'round', 'round': 1})
+        subscriber.push(server.BalanceEvent(10.0, 'EUR', 0))
+        subscriber.push(server.BalanceEvent(9.0, 'EUR', 0))
+        await asyncio.sleep(0.05)
+        subscriber.push({'type': 'cashout', 'round': 1})
+        await asyncio.sleep(0.05)
+        pump.cancel()
+        return sent
+
+    first, second = run(scenario())
+    assert first['type'] == 'events'
+    assert [event['type'] if isinstance(event, dict) else event.type for event in first['events']] == ['round', 'balance']
+    assert first['events'][1].balance == 9.0  # обновления баланса схлопнуты до последнего
+    assert second == {'type': 'cashout', 'round': 1}
+
+
+def test_slow_subscriber_drops_oldest_events():
+    async def scenario():
+        subscriber = server.Subscriber(asyncio.get_running_loop(), limit=3)
+        for n in range(5):
+            subscriber.push({'type': 'round', 'round': n})
+        return subscriber.drain()
+
+    batch = run(scenario())
+    assert [event['round'] for event in batch[:-1]] == [2, 3, 4]
+    assert batch[-1] == {'type': 'dropped', 'count': 2}